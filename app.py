@@ -1,25 +1,46 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, Response, render_template, request, redirect, url_for, flash, jsonify, make_response, session, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from flask_bcrypt import Bcrypt
 from models.usuario import db, Usuario
 from cache_manager import CacheManager
+from fragment_cache import FragmentCache
 
 from datetime import datetime
+from functools import wraps
+import hashlib
+import json
 import math
 import os
-import statistics 
 import sqlite3 # Adicionado para conexão local
 
 # Configurações e Modelos
 from config import Config
-from services.config_manager import carregar_regras_acao, salvar_regras_acao, salvar_configuracao
+from connection import get_stats_pool
+from sql_metrics import monitor_sql
+from services.config_manager import (
+    carregar_regras_acao, salvar_regras_acao, salvar_configuracao,
+    importar_configuracoes_json, exportar_configuracoes_json
+)
 from services.learning_service import ensinar_lote
-from services.report_service import gerar_estrutura_relatorio
+from services.sankhya_service import get_stats_pool_sankhya
+from services.curve_service import (
+    buscar_curvas, get_stats_curvas, reduzir_curva, iniciar_espelhamento,
+    empacotar_series_binario, MAX_PONTOS_PADRAO, MIME_CURVAS_BINARIO
+)
+from services.curve_features import PARAMETROS_CURVA, PARAMETROS_CONFORMIDADE
+from services.report_service import (
+    obter_arvore_relatorio,
+    projetar_relatorio,
+    obter_no_massa,
+    obter_nos_massa,
+    obter_no_lote
+)
 
 # --- IMPORTAÇÃO: SERVIÇO DE ETL ---
 from services.etl_service import (
     processar_carga_dados, 
     carregar_referencias_estaticas,
+    invalidar_particoes,
     get_catalogo_codigo,
     _MAPA_GRUPOS
 )
@@ -38,29 +59,30 @@ def preparar_planilha_sharepoint(forcar_download=False):
     """
     Garante que a planilha venha do SharePoint e define CAMINHO_REG403
     apontando para o arquivo cacheado localmente.
+    Retorna (caminho, baixado): caminho é None se não há planilha; baixado
+    indica se um arquivo novo foi transferido nesta chamada.
     """
     if not baixar_excel_sharepoint:
-        return None
+        return None, False
 
     caminho_cache = os.path.abspath(CACHE_PLANILHA_SHAREPOINT)
 
     # Se já temos um cache e não foi solicitado força de download, reutiliza.
     if not forcar_download and os.path.exists(caminho_cache) and os.path.getsize(caminho_cache) > 0:
         os.environ["CAMINHO_REG403"] = caminho_cache
-        return caminho_cache
+        return caminho_cache, False
 
     try:
-        caminho_baixado = baixar_excel_sharepoint(nome_destino=CACHE_PLANILHA_SHAREPOINT)
+        caminho_baixado, baixado = baixar_excel_sharepoint(nome_destino=CACHE_PLANILHA_SHAREPOINT)
         if caminho_baixado:
             caminho_abs = os.path.abspath(caminho_baixado)
             os.environ["CAMINHO_REG403"] = caminho_abs
-            return caminho_abs
+            return caminho_abs, baixado
     except Exception as e:
         print(f"⚠️ Falha ao baixar planilha do SharePoint: {e}")
 
-    return None
+    return None, False
 
-from connection import connect_to_database
 
 app = Flask(__name__)
 app.config.from_object(Config)
@@ -203,7 +225,7 @@ iniciar_tabela_aprendizado()
 print("\n=== REOSCORE V13 (MODULARIZED & SIDECAR) ===")
 
 # Certifica que o ETL vai usar somente a planilha baixada do SharePoint
-caminho_sharepoint_inicial = preparar_planilha_sharepoint(forcar_download=False)
+caminho_sharepoint_inicial, _ = preparar_planilha_sharepoint(forcar_download=False)
 if caminho_sharepoint_inicial:
     print(f"   > Planilha SharePoint configurada em: {caminho_sharepoint_inicial}")
 else:
@@ -214,6 +236,98 @@ carregar_referencias_estaticas()
 # Inicializa o gerenciador com TTL de 30 min e Max 500MB
 cache_service = CacheManager(ttl_minutes=30, max_size_mb=500)
 
+# Partials HTMX já renderizados (invalidados a cada nova versão do snapshot)
+fragment_cache = FragmentCache(max_itens=256, max_size_mb=32, comprimir=True)
+
+# ==========================================
+# 1.1 CACHE HTTP (ETag / Last-Modified POR VERSÃO DO SNAPSHOT)
+# ==========================================
+def _args_normalizados():
+    """Parâmetros da query ordenados, sem espaços extras e sem valores vazios."""
+    return tuple(sorted(
+        (k, v.strip()) for k, v in request.args.items(multi=True) if v and v.strip()
+    ))
+
+def _etag_snapshot(dados_cache):
+    """
+    Validador da view atual: versão do snapshot + rota + parâmetros normalizados
+    + usuário (o layout mostra nome/perfil) + tipo de resposta (HTMX ou página).
+    """
+    partes = (
+        dados_cache.get('versao'),
+        dados_cache['ultimo_update'].isoformat(),
+        request.path,
+        _args_normalizados(),
+        bool(request.headers.get('HX-Request')),
+        current_user.get_id(), current_user.username, current_user.role,
+    )
+    return hashlib.sha1(repr(partes).encode('utf-8')).hexdigest()
+
+def resposta_condicional(view):
+    """
+    Responde 304 sem filtrar nem renderizar quando o cliente já tem a versão
+    atual da view. Sem snapshot válido (ou com mensagens flash pendentes)
+    a view roda normalmente, sem validadores.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        dados_cache = cache_service.get()
+        if not dados_cache or session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        etag = _etag_snapshot(dados_cache)
+        # Muda também quando a versão é renovada sem nova carga (recálculo de score)
+        modificado_em = (dados_cache.get('modificado_em') or dados_cache['ultimo_update']).replace(microsecond=0)
+
+        nao_modificado = False
+        if request.if_none_match:
+            nao_modificado = request.if_none_match.contains(etag)
+        elif request.if_modified_since:
+            nao_modificado = request.if_modified_since.replace(tzinfo=None) >= modificado_em
+
+        if nao_modificado:
+            resp = make_response('', 304)
+        else:
+            resp = make_response(view(*args, **kwargs))
+            if resp.status_code != 200:
+                return resp
+
+        resp.set_etag(etag)
+        resp.last_modified = modificado_em
+        resp.headers['Cache-Control'] = 'private, no-cache'
+        resp.vary.add('HX-Request')
+        resp.vary.add('Cookie')
+        return resp
+    return wrapper
+
+def cache_fragmento(view):
+    """
+    Serve partials HTMX a partir do FragmentCache quando a mesma combinação
+    (versão do snapshot, rota, filtros, ordenação, página) já foi renderizada.
+    Os partials não dependem do usuário, então o fragmento é compartilhado.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not request.headers.get('HX-Request'):
+            return view(*args, **kwargs)
+
+        dados_cache = cache_service.get()
+        if not dados_cache:
+            return view(*args, **kwargs)
+
+        versao = (dados_cache.get('versao'), dados_cache['ultimo_update'])
+        chave = (request.path, _args_normalizados())
+
+        html = fragment_cache.get(versao, chave)
+        if html is not None:
+            return html
+
+        rv = view(*args, **kwargs)
+        if isinstance(rv, str):
+            fragment_cache.set(versao, chave, rv)
+        return rv
+    return wrapper
+
 # ==========================================
 # 2. ROTAS DE AUTENTICAÇÃO
 # ==========================================
@@ -274,10 +388,12 @@ def rota_atualizar():
         # --- PASSO 1: TENTATIVA DE DOWNLOAD VIA SHAREPOINT ---
         if baixar_excel_sharepoint:
             print("--- ☁️ Iniciando Sync com SharePoint ---")
-            caminho_baixado = preparar_planilha_sharepoint(forcar_download=True)
+            caminho_baixado, baixado = preparar_planilha_sharepoint(forcar_download=True)
             
-            if caminho_baixado:
+            if caminho_baixado and baixado:
                 flash("✅ Planilha baixada do SharePoint com sucesso!", "success")
+            elif caminho_baixado:
+                flash("ℹ️ Planilha do SharePoint sem alterações. Mantida a cópia local.", "info")
             else:
                 flash("⚠️ Falha no download do SharePoint (verifique logs). Usando cache anterior.", "warning")
         else:
@@ -285,6 +401,8 @@ def rota_atualizar():
         # -----------------------------------------------------
 
         # --- PASSO 2: EXECUÇÃO DO ETL (BANCO + PLANILHA) ---
+        # Atualização manual: nada de partições antigas em memória, tudo vem do banco
+        invalidar_particoes()
         resultado = processar_carga_dados()
         
         if resultado:
@@ -294,6 +412,7 @@ def rota_atualizar():
 
             # Atualiza o cache na memória
             cache_service.set(resultado)
+            iniciar_espelhamento(resultado['dados'], ao_atualizar=cache_service.substituir_ensaios)
             
             # Pega estatísticas para feedback
             stats = cache_service.get_stats()
@@ -309,6 +428,8 @@ def rota_atualizar():
 
 @app.route('/')
 @login_required
+@resposta_condicional
+@cache_fragmento
 def dashboard():
     # Tenta pegar dados do cache
     dados_cache = cache_service.get()
@@ -324,6 +445,7 @@ def dashboard():
             resultado['dados'] = aplicar_sobreposicao_local(resultado['dados'])
             
             cache_service.set(resultado)
+            iniciar_espelhamento(resultado['dados'], ao_atualizar=cache_service.substituir_ensaios)
             dados_cache = resultado 
         else:
             dados_cache = {'dados': [], 'materiais': [], 'ultimo_update': None} 
@@ -410,6 +532,9 @@ def dashboard():
 # 4. ROTAS DE CONFIGURAÇÃO (ADMIN)
 # ==========================================
 
+# Parâmetros que podem receber limites na configuração de cada massa
+PARAMETROS_CONFIG = ['Ts2', 'T90', 'Viscosidade'] + PARAMETROS_CURVA + PARAMETROS_CONFORMIDADE
+
 @app.route('/config')
 @login_required
 def pagina_config():
@@ -536,6 +661,9 @@ def pagina_config():
         audit_status=request.args.get('audit_status', ''),
         audit_data=request.args.get('audit_data', ''),
 
+        # Parâmetros configuráveis (medidos + derivados da curva)
+        parametros_config=PARAMETROS_CONFIG,
+
         # Dados Usuários
         usuarios=usuarios_lista
     )
@@ -657,7 +785,10 @@ def salvar_config():
     if current_user.role != 'admin':
         return redirect(url_for('dashboard'))
 
-    cod = request.form.get('cod_sankhya')
+    cod = (request.form.get('cod_sankhya') or '').strip()
+    if not cod.isdigit() or int(cod) not in get_catalogo_codigo():
+        flash(f"Produto inválido: '{cod}' não está no catálogo.", "danger")
+        return redirect(url_for('pagina_config'))
     
     def f(val): return float(val.replace(',', '.')) if val and val.strip() else None
     def i(val): return int(val) if val and val.strip() else 0
@@ -695,9 +826,7 @@ def salvar_config():
     if tempo_baixa: specs['baixa_tempo_total'] = tempo_baixa
 
     # --- 2. CAPTURA DE PARÂMETROS (LIMITES) ---
-    params = ['Ts2', 'T90', 'Viscosidade']
-    
-    for p in params:
+    for p in PARAMETROS_CONFIG:
         # Peso é compartilhado (vem de um input só)
         peso_v = i(request.form.get(f"alta_{p}_peso"))
         
@@ -757,6 +886,119 @@ def salvar_config():
     flash(f"Configuração do produto {cod} salva (Sincronizada Cinza/Preto)!", "success")
     return redirect(url_for('pagina_config', q=cod))
 
+@app.route('/api/config/exportar')
+@login_required
+def exportar_config():
+    """Specs de todas as massas no formato do config_massas.json (backup/migração)."""
+    if current_user.role != 'admin':
+        return redirect(url_for('dashboard'))
+    return Response(
+        exportar_configuracoes_json(),
+        mimetype='application/json',
+        headers={'Content-Disposition': 'attachment; filename=config_massas.json'}
+    )
+
+@app.route('/api/config/importar', methods=['POST'])
+@login_required
+def importar_config():
+    """Importa um config_massas.json (backup/migração) para o banco de specs."""
+    if current_user.role != 'admin':
+        return redirect(url_for('dashboard'))
+
+    arquivo = request.files.get('arquivo')
+    if not arquivo or not arquivo.filename:
+        flash("Selecione um arquivo JSON para importar.", "warning")
+        return redirect(url_for('pagina_config'))
+
+    try:
+        qtd = importar_configuracoes_json(arquivo, substituir=bool(request.form.get('substituir')))
+    except ValueError as e:
+        flash(f"Arquivo de configuração inválido: {e}", "danger")
+        return redirect(url_for('pagina_config'))
+
+    carregar_referencias_estaticas()
+    flash(f"{qtd} configurações importadas do arquivo!", "success")
+    return redirect(url_for('pagina_config'))
+
+@app.route('/api/cache/stats')
+@login_required
+def api_cache_stats():
+    return jsonify({
+        'snapshot': cache_service.get_stats(),
+        'fragmentos': fragment_cache.get_stats(),
+        'curvas': get_stats_curvas(),
+        'pool_sql': get_stats_pool(),
+        'pool_sankhya': get_stats_pool_sankhya()
+    })
+
+@app.route('/api/sql/stats')
+@login_required
+def api_sql_stats():
+    return jsonify(monitor_sql.get_stats())
+
+def _expandir_ids_grafico(dados_cache, selected_parent_ids):
+    """Mapeia cada COD_ENSAIO filho das linhas selecionadas para o Ensaio (linha) pai."""
+    selecionados = set(selected_parent_ids)
+    map_id_to_parent = {}
+    for cached in dados_cache['dados']:
+        cached_id = int(cached.id_ensaio)
+        if cached_id in selecionados:
+            ids_filhos = getattr(cached, 'ids_agrupados', []) or [cached_id]
+            for child_id in ids_filhos:
+                map_id_to_parent[int(child_id)] = cached
+    return map_id_to_parent
+
+def _serie_grafico(curva, parent, max_pontos):
+    """
+    Classifica a curva (reometria x viscosidade, ALTA/BAIXA) e devolve
+    (grupo, serie), com a curva já reduzida para o gráfico.
+    """
+    c_temp = curva['temp_plato']
+    c_grupo = curva['cod_grupo']
+
+    # Classificação
+    dados_grupo = _MAPA_GRUPOS.get(c_grupo, {})
+    tipo_maquina = dados_grupo.get('tipo', 'INDEFINIDO')
+    
+    is_viscosity = False
+    
+    if tipo_maquina == 'VISCOSIMETRO': is_viscosity = True
+    elif tipo_maquina == 'REOMETRO': is_viscosity = False
+    else:
+        if 90 <= c_temp <= 115: is_viscosity = True
+        elif c_temp >= 120: is_viscosity = False
+        else: is_viscosity = (getattr(parent, 'tipo_ensaio', '').upper() == 'VISCOSIDADE')
+
+    cod_s = parent.massa.cod_sankhya if parent.massa else '??'
+    batch_s = parent.batch if parent.batch else '0'
+
+    # --- Classificação do Subtipo para o Filtro ---
+    temp_type = 'GERAL'
+    if not is_viscosity:
+        temp_type = 'ALTA' if c_temp >= 175 else 'BAIXA'
+
+    tempo, torque = reduzir_curva(curva['tempo'], curva['torque'], max_pontos)
+    serie = {
+        'label': f"{cod_s} - Batch {batch_s}",
+        'tempType': temp_type,
+        'tempo': tempo,
+        'torque': torque
+    }
+    return ('viscosidade' if is_viscosity else 'reometria'), serie
+
+def _dataset_chartjs(serie):
+    return {
+        'label': serie['label'],
+        'tempType': serie['tempType'], # <--- Enviando para o Frontend
+        'data': [{'x': x, 'y': y} for x, y in zip(serie['tempo'].tolist(), serie['torque'].tolist())],
+        'pointRadius': 0,
+        'borderWidth': 2,
+        'tension': 0.4,
+        'fill': False,
+        # Cores dinâmicas
+        'borderColor': '#dc3545' if serie['tempType'] == 'ALTA' else '#0d6efd'
+    }
+
 @app.route('/api/grafico')
 @login_required
 def api_grafico():
@@ -767,6 +1009,10 @@ def api_grafico():
 
         ids_str = request.args.get('ids', '')
         modo_lote = request.args.get('mode', '') == 'lote' 
+        # Pontos por curva após a redução LTTB (0 = curva completa)
+        max_pontos = request.args.get('max_points', MAX_PONTOS_PADRAO, type=int)
+        # 'bin' = float32 empacotado + cabeçalho JSON (ver curve_service)
+        formato_binario = request.args.get('format', '') == 'bin'
         
         if not ids_str: return jsonify({})
 
@@ -779,106 +1025,33 @@ def api_grafico():
         if len(selected_parent_ids) > limite:
             return jsonify({'error': f'Muitos dados ({len(selected_parent_ids)}). Limite é {limite}.'}), 400
 
-        all_ids_to_fetch = set()
-        map_id_to_parent = {} 
-
         # 2. Expandir IDs
-        for cached in dados_cache['dados']:
-            cached_id = int(cached.id_ensaio)
-            if cached_id in selected_parent_ids:
-                ids_filhos = getattr(cached, 'ids_agrupados', []) or [cached_id]
-                for child_id in ids_filhos:
-                    c_id_int = int(child_id)
-                    all_ids_to_fetch.add(c_id_int)
-                    map_id_to_parent[c_id_int] = cached
-
-        if not all_ids_to_fetch:
+        map_id_to_parent = _expandir_ids_grafico(dados_cache, selected_parent_ids)
+
+        if not map_id_to_parent:
             return jsonify({'error': 'IDs não encontrados no cache.'}), 404
 
-        # 3. Busca SQL
-        conn = connect_to_database()
-        cursor = conn.cursor()
-        
-        lista_ids = list(all_ids_to_fetch)
-        placeholders = ','.join('?' * len(lista_ids))
-        
-        query = f'''
-            SELECT 
-                V.COD_ENSAIO, 
-                V.TEMPO, 
-                V.TORQUE, 
-                E.TEMP_PLATO_INF,
-                E.COD_GRUPO
-            FROM dbo.ENSAIO_VALORES V
-            JOIN dbo.ENSAIO E ON V.COD_ENSAIO = E.COD_ENSAIO
-            WHERE V.COD_ENSAIO IN ({placeholders})
-            ORDER BY V.COD_ENSAIO, V.TEMPO
-        '''
-        
-        cursor.execute(query, lista_ids)
-        rows = cursor.fetchall()
-        conn.close()
+        # 3. Curvas (cache em memória; só os IDs ausentes vão ao SQL)
+        curvas = buscar_curvas(map_id_to_parent.keys())
 
-        if not rows:
+        if not curvas:
             return jsonify({'error': 'Nenhum ponto de curva encontrado.'}), 404
 
         # 4. Processamento
-        datasets_reo = {}
-        datasets_visc = {}
+        grupos = {'reometria': [], 'viscosidade': []}
         
-        for row in rows:
-            c_id = int(row[0])
-            c_time = float(row[1])
-            c_val = float(row[2])
-            c_temp = float(row[3]) if row[3] else 0
-            c_grupo = row[4]
-            
+        for c_id in sorted(curvas):
             parent = map_id_to_parent.get(c_id)
             if not parent: continue
-            
-            # Classificação
-            dados_grupo = _MAPA_GRUPOS.get(c_grupo, {})
-            tipo_maquina = dados_grupo.get('tipo', 'INDEFINIDO')
-            
-            is_viscosity = False
-            
-            if tipo_maquina == 'VISCOSIMETRO': is_viscosity = True
-            elif tipo_maquina == 'REOMETRO': is_viscosity = False
-            else:
-                if 90 <= c_temp <= 115: is_viscosity = True
-                elif c_temp >= 120: is_viscosity = False
-                else: is_viscosity = (getattr(parent, 'tipo_ensaio', '').upper() == 'VISCOSIDADE')
+            nome_grupo, serie = _serie_grafico(curvas[c_id], parent, max_pontos)
+            grupos[nome_grupo].append(serie)
 
-            target_dict = datasets_visc if is_viscosity else datasets_reo
-            
-            if c_id not in target_dict:
-                cod_s = parent.massa.cod_sankhya if parent.massa else '??'
-                batch_s = parent.batch if parent.batch else '0'
-                label = f"{cod_s} - Batch {batch_s}"
-                
-                # --- NOVO: Classificação do Subtipo para o Filtro ---
-                temp_type = 'GERAL'
-                if not is_viscosity:
-                    temp_type = 'ALTA' if c_temp >= 175 else 'BAIXA'
-                # ----------------------------------------------------
-
-                target_dict[c_id] = {
-                    'label': label,
-                    'tempType': temp_type, # <--- Enviando para o Frontend
-                    'data': [],
-                    'pointRadius': 0,
-                    'borderWidth': 2,
-                    'tension': 0.4,
-                    'fill': False,
-                    # Cores dinâmicas
-                    'borderColor': '#dc3545' if temp_type == 'ALTA' else '#0d6efd'
-                }
-            
-            target_dict[c_id]['data'].append({'x': c_time, 'y': c_val})
+        if formato_binario:
+            return Response(empacotar_series_binario(grupos), mimetype=MIME_CURVAS_BINARIO)
 
         return jsonify({
-            'reometria': list(datasets_reo.values()),
-            'viscosidade': list(datasets_visc.values())
+            nome_grupo: [_dataset_chartjs(serie) for serie in series]
+            for nome_grupo, series in grupos.items()
         })
         
     except Exception as e:
@@ -886,6 +1059,89 @@ def api_grafico():
         return jsonify({'error': str(e)}), 500
 
 
+# Curvas por consulta ao banco no modo streaming e teto de linhas selecionadas
+TAMANHO_LOTE_STREAM = 50
+LIMITE_LINHAS_STREAM = 3000
+
+@app.route('/api/grafico/stream', methods=['GET', 'POST'])
+@login_required
+def api_grafico_stream():
+    """
+    Variante em streaming do /api/grafico (NDJSON): as curvas são buscadas em
+    lotes de TAMANHO_LOTE_STREAM IDs e cada dataset é enviado em uma linha
+    assim que fica pronto; a última linha é {"fim": true, "total": n,
+    "ignoradas": k} (k curvas que não puderam ser montadas, ex.: NaN/vazias).
+    Erro ao buscar as curvas vira uma linha {"error": ...}. Aceita 'ids' ou um recorte por material/período
+    (codigo_filter, date_start, date_end). Listas longas de IDs vêm por POST.
+    """
+    dados_cache = cache_service.get()
+    if not dados_cache:
+        return jsonify({'error': 'Cache vazio. Atualize os dados.'}), 400
+
+    max_pontos = request.values.get('max_points', MAX_PONTOS_PADRAO, type=int)
+    ids_str = request.values.get('ids', '')
+    f_cod = request.values.get('codigo_filter', '').strip()
+    d_start = request.values.get('date_start', '')
+    d_end = request.values.get('date_end', '')
+
+    if ids_str:
+        selected_parent_ids = [int(x) for x in ids_str.split(',') if x.isdigit()]
+    elif f_cod:
+        ensaios = [e for e in dados_cache['dados'] if str(e.massa.cod_sankhya) == f_cod]
+        try:
+            if d_start:
+                inicio = datetime.strptime(d_start, '%Y-%m-%d')
+                ensaios = [e for e in ensaios if e.data_hora and e.data_hora >= inicio]
+            if d_end:
+                fim = datetime.strptime(d_end, '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+                ensaios = [e for e in ensaios if e.data_hora and e.data_hora <= fim]
+        except ValueError:
+            return jsonify({'error': 'Data inválida (use AAAA-MM-DD).'}), 400
+        selected_parent_ids = [int(e.id_ensaio) for e in ensaios]
+    else:
+        return jsonify({'error': 'Informe ids ou codigo_filter.'}), 400
+
+    if len(selected_parent_ids) > LIMITE_LINHAS_STREAM:
+        return jsonify({'error': f'Muitos dados ({len(selected_parent_ids)}). Limite é {LIMITE_LINHAS_STREAM}.'}), 400
+
+    map_id_to_parent = _expandir_ids_grafico(dados_cache, selected_parent_ids)
+    if not map_id_to_parent:
+        return jsonify({'error': 'IDs não encontrados no cache.'}), 404
+
+    ids_ordenados = sorted(map_id_to_parent)
+
+    def gerar():
+        enviados = 0
+        ignoradas = 0
+        for i in range(0, len(ids_ordenados), TAMANHO_LOTE_STREAM):
+            try:
+                curvas = buscar_curvas(ids_ordenados[i:i + TAMANHO_LOTE_STREAM])
+            except Exception as e:
+                print(f"ERRO API STREAM: {e}")
+                yield json.dumps({'error': str(e)}) + '\n'
+                return
+
+            for c_id in sorted(curvas):
+                try:
+                    nome_grupo, serie = _serie_grafico(curvas[c_id], map_id_to_parent[c_id], max_pontos)
+                    # allow_nan=False: NaN não é JSON válido para o navegador
+                    linha = json.dumps({'grupo': nome_grupo, 'dataset': _dataset_chartjs(serie)}, allow_nan=False)
+                except Exception as e:
+                    print(f"⚠️ API STREAM: curva {c_id} ignorada ({e})")
+                    ignoradas += 1
+                    continue
+                yield linha + '\n'
+                enviados += 1
+
+        yield json.dumps({'fim': True, 'total': enviados, 'ignoradas': ignoradas}) + '\n'
+
+    return Response(
+        stream_with_context(gerar()),
+        mimetype='application/x-ndjson',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+
 @app.route('/auditoria')
 @login_required
 def pagina_auditoria():
@@ -969,6 +1225,8 @@ def salvar_correcao():
 
 @app.route('/relatorios')
 @login_required
+@resposta_condicional
+@cache_fragmento
 def pagina_relatorios():
     dados_cache = cache_service.get()
     if not dados_cache: return redirect(url_for('dashboard'))
@@ -978,8 +1236,9 @@ def pagina_relatorios():
     sort_by = request.args.get('sort', 'nome')
     order = request.args.get('order', 'asc')
 
-    relatorio_estruturado = gerar_estrutura_relatorio(
-        dados_cache['dados'], busca=busca, ordenar_por=sort_by, ordem=order
+    # Árvore completa é montada uma vez por versão do cache; aqui só projetamos
+    relatorio_estruturado = projetar_relatorio(
+        obter_arvore_relatorio(dados_cache), busca=busca, ordenar_por=sort_by, ordem=order
     )
     
     context = {
@@ -997,18 +1256,15 @@ def pagina_relatorios():
 # Rota da Lista de Lotes (Agora com Filtros e Ordenação)
 @app.route('/relatorios/detalhes/<int:cod_sankhya>')
 @login_required
+@resposta_condicional
+@cache_fragmento
 def detalhes_lotes_massa(cod_sankhya):
     dados_cache = cache_service.get()
     if not dados_cache: return redirect(url_for('dashboard'))
     
-    # Filtra os dados brutos
-    lista_filtrada = [e for e in dados_cache['dados'] if e.massa.cod_sankhya == cod_sankhya]
-    
-    # Gera a árvore (com os novos KPIs de lote)
-    relatorio = gerar_estrutura_relatorio(lista_filtrada)
-    if not relatorio: return "Material não encontrado ou sem dados."
-    
-    massa_node = relatorio[0]
+    # Recorte da árvore memoizada (com os KPIs de lote já calculados)
+    massa_node = obter_no_massa(obter_arvore_relatorio(dados_cache), cod_sankhya)
+    if not massa_node: return "Material não encontrado ou sem dados."
     
     # --- Lógica de Ordenação e Filtro da Lista de Lotes ---
     lotes_lista = list(massa_node['lotes'].values())
@@ -1049,16 +1305,23 @@ def detalhes_lotes_massa(cod_sankhya):
 
 @app.route('/relatorios/lote/<int:cod_sankhya>/<path:numero_lote>')
 @login_required
+@resposta_condicional
 def detalhe_lote_view(cod_sankhya, numero_lote):
     dados_cache = cache_service.get()
     if not dados_cache: return "Cache vazio."
     
-    # 1. Recupera Ensaios do Lote
+    # 1. Recupera o nó do Lote na árvore memoizada. O mesmo cod pode aparecer
+    # sob mais de uma descrição: os ensaios vêm de todos os nós; os KPIs, do primeiro.
+    encontrados = []
+    for massa_node in obter_nos_massa(obter_arvore_relatorio(dados_cache), cod_sankhya):
+        no = obter_no_lote(massa_node, numero_lote)
+        if no: encontrados.append((massa_node, no))
+    if not encontrados: return "Lote não encontrado."
+    dados_massa, lote_node = encontrados[0]
+
     ensaios_do_lote = [
-        e for e in dados_cache['dados'] 
-        if e.massa.cod_sankhya == cod_sankhya and str(e.lote) == str(numero_lote)
+        e for _, no in encontrados for e in no['batches'] if e.massa.cod_sankhya == cod_sankhya
     ]
-    
     if not ensaios_do_lote: return "Lote não encontrado."
 
     # 2. Lógica de Ordenação da Tabela
@@ -1085,41 +1348,23 @@ def detalhe_lote_view(cod_sankhya, numero_lote):
     elif sort_by == 'score':
         ensaios_do_lote.sort(key=lambda x: x.score_final, reverse=reverse)
 
-    # 3. Gera Árvore para KPIs (Score Geral, Aprovação)
-    arvore = gerar_estrutura_relatorio(ensaios_do_lote)
-    dados_lote = arvore[0]['lotes'][numero_lote]
-    dados_massa = arvore[0]
-
-    # 4. Cálculo Robusto de Médias (Corrigindo Viscosidade Zerada)
-    coleta = {
-        'alta': {'Ts2': [], 'T90': []},
-        'baixa': {'Ts2': [], 'T90': []},
-        'visc': []
-    }
+    # 3. KPIs (Score Geral, Aprovação) já vêm no nó; copia para não alterar a árvore compartilhada
+    dados_lote = dict(lote_node)
 
-    for e in ensaios_do_lote:
-        temp = e.temp_plato or 0
-        contexto = 'alta' if temp >= 175 else 'baixa'
-        vals = e.valores_medidos
-        
-        if vals.get('Ts2') and vals['Ts2'] > 0: coleta[contexto]['Ts2'].append(vals['Ts2'])
-        if vals.get('T90') and vals['T90'] > 0: coleta[contexto]['T90'].append(vals['T90'])
-        
-        # Correção aqui: Só adiciona se for maior que 0
-        if vals.get('Viscosidade') and vals['Viscosidade'] > 0.1: 
-            coleta['visc'].append(vals['Viscosidade'])
+    # 4. Médias por contexto (estatísticas já agregadas no nó do lote; ignora valores zerados)
+    st = dados_lote['estatisticas']
 
-    def media_segura(lista):
-        return statistics.mean(lista) if lista else 0
+    def media_segura(stat):
+        return stat['media'] if stat['n'] else 0
 
     dados_lote['medias_detalhadas'] = {
-        'alta_ts2': media_segura(coleta['alta']['Ts2']),
-        'alta_t90': media_segura(coleta['alta']['T90']),
-        'baixa_ts2': media_segura(coleta['baixa']['Ts2']),
-        'baixa_t90': media_segura(coleta['baixa']['T90']),
-        'visc': media_segura(coleta['visc']),
-        'tem_alta': bool(coleta['alta']['Ts2'] or coleta['alta']['T90']),
-        'tem_baixa': bool(coleta['baixa']['Ts2'] or coleta['baixa']['T90'])
+        'alta_ts2': media_segura(st['alta']['ts2']),
+        'alta_t90': media_segura(st['alta']['t90']),
+        'baixa_ts2': media_segura(st['baixa']['ts2']),
+        'baixa_t90': media_segura(st['baixa']['t90']),
+        'visc': media_segura(st['visc']),
+        'tem_alta': bool(st['alta']['ts2']['n'] or st['alta']['t90']['n']),
+        'tem_baixa': bool(st['baixa']['ts2']['n'] or st['baixa']['t90']['n'])
     }
 
     return render_template(
@@ -13,11 +13,16 @@ class CacheManager:
             'dados': [],
             'materiais': [],
             'ultimo_update': None,
-            'total_registros_brutos': 0
+            'total_registros_brutos': 0,
+            'versao': 0,
+            'modificado_em': None
         }
         self.ttl = timedelta(minutes=ttl_minutes)
         self.max_size_mb = max_size_mb
         self.lock = Lock()
+        # Versão do snapshot: muda a cada set() para que caches derivados
+        # (relatórios, etc.) saibam quando precisam ser reconstruídos.
+        self.versao = 0
     
     def get(self):
         """Retorna cache se válido, None se expirado."""
@@ -49,9 +54,44 @@ class CacheManager:
                 size_mb = sys.getsizeof(dados) / (1024 * 1024)
                 print(f"   Reduzido para {size_mb:.1f}MB")
             
+            self.versao += 1
+            dados['versao'] = self.versao
+            dados['modificado_em'] = self._proximo_modificado_em()
             self.cache = dados
             print(f"💾 Cache atualizado: {len(dados['dados'])} registros ({size_mb:.1f}MB)")
     
+    def substituir_ensaios(self, lista_origem, substitutos):
+        """
+        Publica ensaios recalculados fora do snapshot (ex.: espelhamento de
+        curvas). 'substitutos' é {id(ensaio original): ensaio novo}. Só vale se
+        o snapshot ainda for o de 'lista_origem'; se um set() o trocou nesse
+        meio tempo, nada muda e retorna False. Quem já leu o snapshot
+        continua com a lista antiga, intacta.
+        """
+        with self.lock:
+            if self.cache['dados'] is not lista_origem or not substitutos:
+                return False
+            novo = dict(self.cache)
+            novo['dados'] = [substitutos.get(id(e), e) for e in lista_origem]
+            self.versao += 1
+            novo['versao'] = self.versao
+            # ultimo_update fica como está: ele conta a idade (TTL) do snapshot
+            novo['modificado_em'] = self._proximo_modificado_em()
+            self.cache = novo
+            return True
+
+    def _proximo_modificado_em(self):
+        """
+        Instante da versão nova (Last-Modified). O cabeçalho tem resolução de
+        segundos: avança pelo menos 1s sobre o anterior para que
+        If-Modified-Since não confunda a versão nova com a anterior.
+        """
+        agora = datetime.now()
+        anterior = self.cache.get('modificado_em')
+        if anterior:
+            agora = max(agora, anterior.replace(microsecond=0) + timedelta(seconds=1))
+        return agora
+
     def invalidate(self):
         """Força recarga no próximo acesso."""
         with self.lock:
@@ -72,5 +112,6 @@ class CacheManager:
                 'registros': len(self.cache['dados']),
                 'idade_minutos': idade.seconds // 60,
                 'tamanho_mb': round(size_mb, 2),
-                'ultimo_update': self.cache['ultimo_update']
+                'ultimo_update': self.cache['ultimo_update'],
+                'versao': self.versao
             }
\ No newline at end of file
@@ -1,24 +1,33 @@
-import pyodbc, os
+import pyodbc, os, time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from threading import Condition
 from dotenv import load_dotenv
+from sql_metrics import CursorInstrumentado
 
 load_dotenv()
 
 username = os.getenv('USERNAME_DB')
 password = os.getenv('PASSWORD_DB')
-server = os.getenv('SERVER')  
-database = os.getenv('DATABASE')  
-dsn = os.getenv('DSN')  
+server = os.getenv('SERVER')
+database = os.getenv('DATABASE')
+dsn = os.getenv('DSN')
 
+# Pool de conexões do SQL Server. Dimensionar para o pico de uso simultâneo:
+# requisições em paralelo (1 conexão cada, mais o fan-out de consultar_por_ids)
+# + ETL_PARALELISMO partições do ETL + 1 do espelhamento de curvas.
+POOL_TAMANHO = int(os.getenv('DB_POOL_SIZE', '10'))
+POOL_ESPERA_MAX = float(os.getenv('DB_POOL_TIMEOUT', '30'))      # segundos esperando uma conexão livre
+POOL_OCIOSA_MAX = float(os.getenv('DB_POOL_IDLE_TIMEOUT', '300')) # conexões paradas há mais tempo são fechadas
+POOL_VERIFICAR_APOS = 30 # conexões paradas há mais que isso passam por um SELECT 1 antes de serem entregues
 
-def connect_to_database():
+
+def _nova_conexao():
     connection_string = (
         "DRIVER={ODBC Driver 18 for SQL Server};"
         f"SERVER={server};DATABASE={database};UID={username};PWD={password};"
         "Encrypt=no;TrustServerCertificate=yes;"
     )
-    #connection = pyodbc.connect(connection_string)
-
-
     #query = "SELECT * FROM dbo_ENSAIO"
     #engine = create_engine(f"mssql+pyodbc://{username}:%s@{server}/{database}?TrustServerCertificate=yes&driver={dsn}" % password)
 
@@ -28,3 +37,245 @@ def connect_to_database():
     return connection
 
 
+def _fechar(conn):
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class PoolConexoes:
+    """
+    Pool de conexões pyodbc com tamanho máximo, verificação de saúde na
+    retirada e descarte de conexões ociosas há muito tempo.
+    """
+
+    def __init__(self, tamanho=5, espera_max=30, ociosa_max=300):
+        self.tamanho = tamanho
+        self.espera_max = espera_max
+        self.ociosa_max = ociosa_max
+        self.livres = [] # [(conexao, instante em que foi devolvida)]
+        self.em_uso = 0
+        self.cond = Condition()
+
+        self.criadas = 0
+        self.reaproveitadas = 0
+        self.esperas = 0
+        self.descartadas = 0
+        self.timeouts = 0
+
+    def _saudavel(self, conn):
+        try:
+            conn.cursor().execute("SELECT 1").fetchall()
+            return True
+        except Exception:
+            return False
+
+    def _contar(self, metrica):
+        with self.cond:
+            setattr(self, metrica, getattr(self, metrica) + 1)
+
+    def obter(self):
+        """Retira uma conexão do pool (ou abre uma nova, se houver vaga)."""
+        with self.cond:
+            inicio = time.monotonic()
+            while not self.livres and self.em_uso >= self.tamanho:
+                restante = self.espera_max - (time.monotonic() - inicio)
+                if restante <= 0:
+                    self.timeouts += 1
+                    raise TimeoutError(f"Pool de conexões esgotado ({self.tamanho} em uso)")
+                self.esperas += 1
+                self.cond.wait(restante)
+
+            agora = time.monotonic()
+            candidata = None
+            while self.livres:
+                conn, devolvida_em = self.livres.pop()
+                if agora - devolvida_em > self.ociosa_max:
+                    self.descartadas += 1
+                    _fechar(conn)
+                    continue
+                candidata = (conn, devolvida_em)
+                break
+            self.em_uso += 1
+
+        # Verificação e abertura fora do lock: não bloqueiam as outras threads
+        try:
+            if candidata:
+                conn, devolvida_em = candidata
+                if agora - devolvida_em <= POOL_VERIFICAR_APOS or self._saudavel(conn):
+                    self._contar('reaproveitadas')
+                    return conn
+                self._contar('descartadas')
+                _fechar(conn)
+
+            conn = _nova_conexao()
+            self._contar('criadas')
+            return conn
+        except Exception:
+            with self.cond:
+                self.em_uso -= 1
+                self.cond.notify()
+            raise
+
+    def devolver(self, conn, descartar=False):
+        """Devolve a conexão ao pool; 'descartar' fecha (ex.: após erro de conexão)."""
+        if not descartar:
+            try:
+                conn.rollback() # encerra transação pendente antes de reaproveitar
+            except Exception:
+                descartar = True
+
+        with self.cond:
+            self.em_uso -= 1
+            if descartar or len(self.livres) >= self.tamanho:
+                self.descartadas += 1
+                _fechar(conn)
+            else:
+                self.livres.append((conn, time.monotonic()))
+            self.cond.notify()
+
+    def vagas(self):
+        """Quantas conexões podem ser retiradas agora sem esperar."""
+        with self.cond:
+            return max(len(self.livres), self.tamanho - self.em_uso)
+
+    def get_stats(self):
+        with self.cond:
+            return {
+                'tamanho': self.tamanho,
+                'em_uso': self.em_uso,
+                'livres': len(self.livres),
+                'criadas': self.criadas,
+                'reaproveitadas': self.reaproveitadas,
+                'esperas': self.esperas,
+                'timeouts': self.timeouts,
+                'descartadas': self.descartadas
+            }
+
+
+_POOL = PoolConexoes(POOL_TAMANHO, POOL_ESPERA_MAX, POOL_OCIOSA_MAX)
+
+
+class _ConexaoDoPool:
+    """
+    Conexão emprestada do pool. Se comporta como a conexão pyodbc, mas
+    close() devolve a conexão ao pool em vez de fechá-la.
+    """
+
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, nome):
+        return getattr(self._conn, nome)
+
+    def cursor(self):
+        return CursorInstrumentado(self._conn.cursor(), 'sqlserver')
+
+    def close(self, descartar=False):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            _POOL.devolver(conn, descartar=descartar)
+
+
+def connect_to_database():
+    """Conexão do pool; chamar close() devolve ao pool."""
+    return _ConexaoDoPool(_POOL.obter())
+
+
+@contextmanager
+def conexao():
+    """
+    Uso: with conexao() as conn: ...
+    Erros de banco descartam a conexão (pode ter caído); os demais apenas a devolvem.
+    """
+    conn = connect_to_database()
+    try:
+        yield conn
+    except pyodbc.Error:
+        conn.close(descartar=True)
+        raise
+    finally:
+        conn.close()
+
+
+def get_stats_pool():
+    return _POOL.get_stats()
+
+
+# --- CONSULTAS COM LISTAS GRANDES DE IDS ---
+
+# O SQL Server aceita ~2100 parâmetros por comando; listas IN muito longas também compilam mal
+IDS_POR_CONSULTA = 1000
+# Acima disso os IDs vão para uma tabela temporária (#ids_consulta) em vez de vários IN
+IDS_LIMITE_TABELA_TEMP = int(os.getenv('DB_IDS_LIMITE_TEMP', '10000'))
+# Teto de consultas IN em paralelo (cada uma usa uma conexão do pool); na hora,
+# limitado também às conexões livres, deixando uma para as outras requisições
+IDS_PARALELISMO = max(1, int(os.getenv('DB_IDS_PARALELISMO', '2')))
+LINHAS_POR_FETCH = 5000
+
+
+def _consultar_lote_in(query, coluna, ids, params):
+    filtro = f"{coluna} IN ({','.join('?' * len(ids))})"
+    with conexao() as conn:
+        cursor = conn.cursor()
+        cursor.execute(query.format(filtro=filtro), list(params) + list(ids))
+        return cursor.fetchall()
+
+
+def _consultar_tabela_temp(query, coluna, ids, params):
+    """
+    Gerador: a conexão (e a #ids_consulta nela) fica presa até as linhas serem
+    todas lidas ou o gerador ser fechado. Quem consome deve ir até o fim ou
+    chamar close(); se parar antes, a tabela temporária é recriada na próxima
+    vez que essa conexão do pool fizer uma consulta destas.
+    """
+    with conexao() as conn:
+        cursor = conn.cursor()
+        cursor.execute("IF OBJECT_ID('tempdb..#ids_consulta') IS NOT NULL DROP TABLE #ids_consulta")
+        cursor.execute("CREATE TABLE #ids_consulta (id BIGINT PRIMARY KEY)")
+        cursor.fast_executemany = True
+        cursor.executemany("INSERT INTO #ids_consulta (id) VALUES (?)", [(i,) for i in ids])
+        cursor.fast_executemany = False
+
+        cursor.execute(query.format(filtro=f"{coluna} IN (SELECT id FROM #ids_consulta)"), list(params))
+        while True:
+            linhas = cursor.fetchmany(LINHAS_POR_FETCH)
+            if not linhas:
+                break
+            yield from linhas
+        cursor.execute("DROP TABLE #ids_consulta")
+
+
+def consultar_por_ids(query, coluna, ids, params=()):
+    """
+    Executa 'query' filtrando 'coluna' pelos 'ids' e devolve as linhas em
+    stream (gerador). A query deve conter o marcador {filtro} no WHERE, ex.:
+        "SELECT ... FROM dbo.ENSAIO_VALORES V WHERE {filtro} ORDER BY V.COD_ENSAIO"
+    'params' são parâmetros posicionais que aparecem antes do {filtro}.
+
+    Até IDS_LIMITE_TABELA_TEMP IDs: consultas IN de IDS_POR_CONSULTA IDs,
+    executadas em paralelo (até IDS_PARALELISMO, sem passar das conexões
+    livres do pool) e devolvidas na ordem dos IDs (ordenados).
+    Acima disso: um único comando com join em uma tabela temporária, em
+    uma conexão que fica presa enquanto o gerador não for consumido.
+    """
+    ids = sorted({int(i) for i in ids})
+    if not ids:
+        return
+
+    if len(ids) > IDS_LIMITE_TABELA_TEMP:
+        yield from _consultar_tabela_temp(query, coluna, ids, params)
+        return
+
+    lotes = [ids[i:i + IDS_POR_CONSULTA] for i in range(0, len(ids), IDS_POR_CONSULTA)]
+    paralelo = min(IDS_PARALELISMO, _POOL.vagas() - 1, len(lotes))
+    if paralelo <= 1:
+        for lote in lotes:
+            yield from _consultar_lote_in(query, coluna, lote, params)
+        return
+
+    with ThreadPoolExecutor(max_workers=paralelo) as executor:
+        futuros = [executor.submit(_consultar_lote_in, query, coluna, lote, params) for lote in lotes]
+        for futuro in futuros:
+            yield from futuro.result()
@@ -1,8 +1,16 @@
+import hashlib
+import numpy as np
 import pandas as pd
 import os
+import pickle
+import re
 import shutil
 import tempfile
+import time
 import warnings
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 # Carrega as variáveis do arquivo .env
@@ -13,6 +21,10 @@ warnings.simplefilter("ignore")
 
 CACHE_PADRAO_SHAREPOINT = os.path.abspath("cache_reg403_sharepoint.xlsx")
 
+# Mapa de lotes já processado, gravado ao lado da planilha (<planilha>.lotes.pkl)
+SUFIXO_CACHE_MAPA = ".lotes.pkl"
+VERSAO_CACHE_MAPA = 2
+
 def _resolver_caminho_planilha():
     """
     Retorna o caminho local para o arquivo baixado via SharePoint.
@@ -28,6 +40,282 @@ def _resolver_caminho_planilha():
 
     return None
 
+# Abas que o sistema vai procurar: as de ano (ex.: '2025'), descobertas no arquivo
+PADRAO_ABA_ANO = re.compile(r'^\d{4}$')
+# Abas alteradas lidas ao mesmo tempo
+PLANILHA_PARALELISMO = max(1, int(os.getenv("PLANILHA_PARALELISMO", "4")))
+
+# Linha do cabeçalho real (a 1ª linha tem só títulos visuais)
+LINHA_CABECALHO = 2
+
+
+def _abrir_calamine(caminho):
+    """Leitor em Rust (python-calamine), bem mais rápido que o openpyxl. None se não instalado."""
+    try:
+        from python_calamine import CalamineWorkbook
+    except ImportError:
+        return None
+    return CalamineWorkbook.from_path(caminho)
+
+
+def _celula_calamine(valor):
+    # O calamine devolve '' para células vazias e float para qualquer número
+    if valor == '':
+        return None
+    if isinstance(valor, float) and valor.is_integer():
+        return int(valor)
+    return valor
+
+
+def _localizar_colunas(cabecalho):
+    """
+    Índices das colunas LOTE, MASSA e REOMETRO (ALTA) no cabeçalho da aba,
+    ou None se a aba não tiver LOTE/MASSA.
+    """
+    nomes = [str(c).strip().upper() if c is not None else '' for c in cabecalho]
+
+    i_lote = nomes.index('LOTE') if 'LOTE' in nomes else None
+    if 'MASSA' in nomes:
+        i_massa = nomes.index('MASSA')
+    elif len(nomes) > 3:
+        # Correção específica para abas onde a coluna MASSA pode estar deslocada (3ª coluna)
+        i_massa = 2
+    else:
+        i_massa = None
+    if i_lote is None or i_massa is None:
+        return None
+
+    # Procura por colunas que contenham "REOMETRO" (ex: "REOMETRO (ALTA)")
+    i_equip = next((i for i, n in enumerate(nomes) if "REOMETRO" in n and "ALTA" in n), None)
+    return i_lote, i_massa, i_equip
+
+
+def _linhas_aba(livro, aba, calamine):
+    """
+    Cabeçalho e linhas de dados da aba, só com as colunas LOTE, MASSA e
+    REOMETRO (ALTA) -> (lotes, massas, equipamentos), ou None.
+    """
+    if calamine:
+        linhas = livro.get_sheet_by_name(aba).to_python(skip_empty_area=False)
+        if len(linhas) < LINHA_CABECALHO:
+            return None
+        colunas = _localizar_colunas(linhas[LINHA_CABECALHO - 1])
+        if colunas is None:
+            return None
+        dados = linhas[LINHA_CABECALHO:]
+        pegar = lambda i: [_celula_calamine(l[i]) if i < len(l) else None for l in dados]
+    else:
+        ws = livro[aba]
+        cabecalho = next(ws.iter_rows(min_row=LINHA_CABECALHO, max_row=LINHA_CABECALHO, values_only=True), None)
+        if cabecalho is None:
+            return None
+        colunas = _localizar_colunas(cabecalho)
+        if colunas is None:
+            return None
+        # max_col corta as colunas à direita das que interessam: não viram células
+        dados = list(ws.iter_rows(min_row=LINHA_CABECALHO + 1,
+                                  max_col=max(i for i in colunas if i is not None) + 1,
+                                  values_only=True))
+        pegar = lambda i: [l[i] if i < len(l) else None for l in dados]
+
+    i_lote, i_massa, i_equip = colunas
+    return pegar(i_lote), pegar(i_massa), (pegar(i_equip) if i_equip is not None else [None] * len(dados))
+
+
+def _mapa_da_aba(lotes, massas, equipamentos):
+    """Monta {lote: {'massa', 'equipamento'}} com operações vetorizadas do pandas."""
+    df = pd.DataFrame({'LOTE': lotes, 'MASSA': massas, 'EQUIP': equipamentos})
+
+    # Limpeza dos dados
+    df = df.dropna(subset=['LOTE', 'MASSA'])
+    lote = df['LOTE'].astype(str).str.strip().str.upper()
+    massa = df['MASSA'].astype(str).str.strip()
+
+    # Equipamento: CINZA / PRETO quando a coluna REOMETRO (ALTA) tiver valor
+    texto_equip = df['EQUIP'].astype(str).str.upper()
+    tem_equip = df['EQUIP'].notna()
+    equip = np.select(
+        [tem_equip & texto_equip.str.contains("CINZA", regex=False),
+         tem_equip & texto_equip.str.contains("PRETO", regex=False)],
+        ["CINZA", "PRETO"],
+        default=None
+    )
+
+    # Filtra lixo (lotes com menos de 3 caracteres)
+    validos = (lote.str.len() > 2).to_numpy()
+
+    # Lotes repetidos: vale a última linha, como na leitura linha a linha
+    return {
+        l: {'massa': m, 'equipamento': e}
+        for l, m, e in zip(lote.to_numpy()[validos], massa.to_numpy()[validos], equip[validos])
+    }
+
+
+def abas_de_ano(nomes):
+    """Nomes de aba que são um ano, em ordem crescente."""
+    return sorted((n for n in nomes if PADRAO_ABA_ANO.match(n.strip())), key=lambda n: int(n.strip()))
+
+
+def ler_abas(caminho, abas=None):
+    """
+    Lê as abas pedidas (None = todas as abas de ano) do arquivo .xlsx e
+    devolve {aba: mapa_da_aba}.
+    Usa o python-calamine se disponível; senão o openpyxl em modo somente
+    leitura (stream das linhas, sem carregar estilos nem o arquivo inteiro).
+    """
+    calamine = True
+    livro = _abrir_calamine(caminho)
+    if livro is None:
+        from openpyxl import load_workbook
+        calamine = False
+        livro = load_workbook(caminho, read_only=True, data_only=True)
+
+    resultado = {}
+    try:
+        nomes = livro.sheet_names if calamine else livro.sheetnames
+        for aba in (abas_de_ano(nomes) if abas is None else abas):
+            if aba not in nomes:
+                continue
+            try:
+                colunas = _linhas_aba(livro, aba, calamine)
+                if colunas is None:
+                    # Se mesmo assim não achar LOTE/MASSA, pula a aba
+                    continue
+                resultado[aba] = _mapa_da_aba(*colunas)
+            except Exception as e:
+                print(f"⚠️ Aviso na aba '{aba}': {e}")
+    finally:
+        if not calamine:
+            livro.close()
+    return resultado
+
+
+def _assinatura(caminho):
+    st = os.stat(caminho)
+    return st.st_size, st.st_mtime_ns
+
+
+def _hash_arquivo(caminho):
+    h = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(bloco)
+    return h.hexdigest()
+
+
+def _ler_cache_mapa(caminho):
+    try:
+        with open(caminho + SUFIXO_CACHE_MAPA, 'rb') as f:
+            cache = pickle.load(f)
+        if cache.get('versao') == VERSAO_CACHE_MAPA:
+            return cache
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"⚠️ Cache do mapa de lotes ilegível, será refeito: {e}")
+    return None
+
+
+def _gravar_cache_mapa(caminho, cache):
+    destino = caminho + SUFIXO_CACHE_MAPA
+    try:
+        temporario = destino + '.tmp'
+        with open(temporario, 'wb') as f:
+            pickle.dump(cache, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporario, destino) # troca atômica: leitores nunca veem arquivo pela metade
+    except Exception as e:
+        print(f"⚠️ Não foi possível gravar o cache do mapa de lotes: {e}")
+
+
+def _juntar_abas(abas):
+    """Mapa final: abas mais novas sobrescrevem lotes repetidos das mais antigas."""
+    mapa = {}
+    for aba in abas_de_ano(abas):
+        mapa.update(abas[aba]['mapa'])
+    return mapa
+
+
+def _mapa_em_cache(caminho):
+    """
+    Cache salvo para esta planilha e se ela não mudou desde o
+    processamento. Tamanho + mtime iguais bastam; se só o mtime mudou
+    (ex.: o mesmo arquivo baixado de novo do SharePoint), confere o SHA-256
+    do conteúdo. Retorna (cache ou None, inalterada, (tamanho, mtime), hash ou None).
+    """
+    assinatura = _assinatura(caminho)
+    cache = _ler_cache_mapa(caminho)
+    if cache and cache['assinatura'] == assinatura:
+        return cache, True, assinatura, cache['hash']
+
+    conteudo = _hash_arquivo(caminho)
+    if cache and cache['assinatura'][0] == assinatura[0] and cache['hash'] == conteudo:
+        cache['assinatura'] = assinatura
+        _gravar_cache_mapa(caminho, cache)
+        return cache, True, assinatura, conteudo
+    return cache, False, assinatura, conteudo
+
+
+# --- DIGITAIS POR ABA (LEITURA INCREMENTAL) ---
+
+_ATRIBUTO_REL_ID = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id'
+# Células de texto compartilhado: <c r="B3" t="s"><v>12</v></c> -> 12
+_CELULA_TEXTO = re.compile(rb'<(?:\w+:)?c\b[^>]*?\bt="s"[^>]*>\s*<(?:\w+:)?v>(\d+)<')
+
+
+def _partes_das_abas(zf):
+    """{nome da aba: parte XML no zip}, via xl/workbook.xml e seus relacionamentos."""
+    rels = ET.fromstring(zf.read('xl/_rels/workbook.xml.rels'))
+    alvos = {r.get('Id'): r.get('Target') for r in rels}
+    partes = {}
+    for sheet in ET.fromstring(zf.read('xl/workbook.xml')).iter():
+        if sheet.tag.endswith('}sheet'):
+            alvo = alvos.get(sheet.get(_ATRIBUTO_REL_ID)) or ''
+            partes[sheet.get('name')] = alvo.lstrip('/') if alvo.startswith('/') else 'xl/' + alvo
+    return partes
+
+
+def _textos_compartilhados(zf):
+    if 'xl/sharedStrings.xml' not in zf.namelist():
+        return []
+    raiz = ET.fromstring(zf.read('xl/sharedStrings.xml'))
+    return [''.join(t.text or '' for t in si.iter() if t.tag.endswith('}t')) for si in raiz]
+
+
+def digitais_das_abas(caminho):
+    """
+    {aba de ano: digital}. A digital junta o CRC32 e o tamanho da parte XML
+    da aba (do índice do zip) com um hash dos textos compartilhados que ela
+    usa: o Excel guarda os textos em sharedStrings.xml e pode renumerá-los ao
+    salvar outra aba, sem mudar o XML desta.
+    """
+    with zipfile.ZipFile(caminho) as zf:
+        partes = _partes_das_abas(zf)
+        textos = None
+        digitais = {}
+        for aba in abas_de_ano(partes):
+            info = zf.getinfo(partes[aba])
+            indices = sorted({int(i) for i in _CELULA_TEXTO.findall(zf.read(info))})
+            if indices and textos is None:
+                textos = _textos_compartilhados(zf)
+            h = hashlib.sha1()
+            for i in indices:
+                h.update(textos[i].encode('utf-8') if i < len(textos) else b'')
+                h.update(b'\0')
+            digitais[aba] = (info.CRC, info.file_size, h.hexdigest())
+    return digitais
+
+
+def _ler_abas_paralelo(caminho, abas):
+    """Lê as abas alteradas, uma por thread (cada uma abre seu próprio leitor)."""
+    if len(abas) <= 1:
+        return ler_abas(caminho, abas)
+    resultado = {}
+    with ThreadPoolExecutor(max_workers=min(PLANILHA_PARALELISMO, len(abas))) as executor:
+        for parcial in executor.map(lambda aba: ler_abas(caminho, [aba]), abas):
+            resultado.update(parcial)
+    return resultado
+
+
 def carregar_dicionario_lotes():
     caminho_arquivo = _resolver_caminho_planilha()
     
@@ -42,7 +330,18 @@ def carregar_dicionario_lotes():
         print(f"   -> Caminho buscado: {caminho_arquivo}")
         return {}
 
-    # print(f"   > Lendo arquivo: ...{str(caminho_arquivo)[-40:]}")
+    # 1. Planilha igual à do último processamento: usa o mapa salvo
+    inicio = time.perf_counter()
+    try:
+        cache, inalterada, assinatura, conteudo = _mapa_em_cache(caminho_arquivo)
+    except Exception as e:
+        print(f"⚠️ Aviso: Não foi possível verificar o cache do mapa de lotes: {e}")
+        cache, inalterada, assinatura, conteudo = None, False, None, None
+    if inalterada:
+        mapa_salvo = _juntar_abas(cache['abas'])
+        print(f"✅ SUCESSO: {len(mapa_salvo)} lotes carregados do cache da planilha ({time.perf_counter() - inicio:.3f}s).")
+        return mapa_salvo
+    abas_salvas = cache['abas'] if cache else {}
 
     # 2. Clone Temporário 
     # (Mantemos essa prática para evitar travar o arquivo se ele estiver aberto no Excel localmente)
@@ -57,75 +356,34 @@ def carregar_dicionario_lotes():
 
     mapa_lote_massa = {}
     
-    # Abas que o sistema vai procurar
-    abas_para_ler = ['2023', '2024', '2025', '2026'] 
-    
     try:
-        # Abre o arquivo (usando engine openpyxl para .xlsx)
-        # Lemos o arquivo inteiro uma vez para pegar os nomes das abas, 
-        # mas para performance, o pandas já carrega sob demanda.
-        xls = pd.ExcelFile(caminho_clone, engine='openpyxl')
-        
-        for aba in abas_para_ler:
-            if aba not in xls.sheet_names:
-                continue
-                
-            try:
-                # header=1: Pula a primeira linha (títulos visuais) e pega o cabeçalho real
-                df = pd.read_excel(xls, sheet_name=aba, header=1)
-                
-                # Normaliza nomes das colunas (Maiúsculo e sem espaços)
-                df.columns = [str(col).strip().upper() for col in df.columns]
+        # 3. Só as abas de ano cuja digital mudou são lidas de novo
+        try:
+            digitais = digitais_das_abas(caminho_clone)
+        except Exception as e:
+            print(f"⚠️ Aviso: Não foi possível calcular as digitais das abas, lendo todas. Erro: {e}")
+            digitais = None
 
-                # Correção específica para abas onde a coluna MASSA pode estar deslocada
-                if 'MASSA' not in df.columns and len(df.columns) > 3:
-                    # Tenta pegar a 3ª coluna como Massa (índice 2)
-                    col_index_2 = df.columns[2] 
-                    df.rename(columns={col_index_2: 'MASSA'}, inplace=True)
+        if digitais is None:
+            abas = {aba: {'digital': None, 'mapa': mapa} for aba, mapa in ler_abas(caminho_clone).items()}
+        else:
+            abas = {
+                aba: abas_salvas[aba] for aba, digital in digitais.items()
+                if aba in abas_salvas and abas_salvas[aba]['digital'] == digital
+            }
+            alteradas = [aba for aba in digitais if aba not in abas]
+            if alteradas:
+                print(f"   > Lendo abas: {', '.join(alteradas)} ({len(abas)} sem alteração)")
+            for aba, mapa in _ler_abas_paralelo(caminho_clone, alteradas).items():
+                abas[aba] = {'digital': digitais[aba], 'mapa': mapa}
 
-                if 'LOTE' not in df.columns or 'MASSA' not in df.columns:
-                    # Se mesmo assim não achar, pula a aba
-                    continue
+        mapa_lote_massa = _juntar_abas(abas)
 
-                # --- NOVA LÓGICA: Captura da Coluna REOMETRO ---
-                # Procura por colunas que contenham "REOMETRO" (ex: "REOMETRO (ALTA)")
-                col_equip = None
-                for col in df.columns:
-                    if "REOMETRO" in col and "ALTA" in col:
-                        col_equip = col
-                        break
-
-                # Limpeza dos dados
-                df = df.dropna(subset=['LOTE', 'MASSA'])
-                df['LOTE'] = df['LOTE'].astype(str).str.strip().str.upper()
-                df['MASSA'] = df['MASSA'].astype(str).str.strip()
-                
-                # Filtra lixo (lotes com menos de 3 caracteres)
-                df = df[df['LOTE'].str.len() > 2] 
-                
-                # Itera para montar o dicionário rico
-                for _, row in df.iterrows():
-                    lote = str(row['LOTE']).strip().upper()
-                    if len(lote) < 3: continue
-                    
-                    massa = str(row['MASSA']).strip()
-                    
-                    # Captura o equipamento se a coluna existir e tiver valor
-                    equip = None
-                    if col_equip and pd.notna(row[col_equip]):
-                        val_equip = str(row[col_equip]).strip().upper()
-                        if "CINZA" in val_equip: equip = "CINZA"
-                        elif "PRETO" in val_equip: equip = "PRETO"
-                    
-                    mapa_lote_massa[lote] = {
-                        'massa': massa,
-                        'equipamento': equip
-                    }
-                
-            except Exception as e:
-                print(f"⚠️ Aviso na aba '{aba}': {e}")
-        
-        xls.close()
+        if mapa_lote_massa and assinatura:
+            _gravar_cache_mapa(caminho_arquivo, {
+                'versao': VERSAO_CACHE_MAPA, 'assinatura': assinatura,
+                'hash': conteudo, 'abas': abas
+            })
                 
     except Exception as e:
         print(f"❌ Erro crítico ao ler planilha Excel: {e}")
@@ -135,7 +393,7 @@ def carregar_dicionario_lotes():
             try: os.remove(caminho_clone)
             except: pass
 
-    print(f"✅ SUCESSO: {len(mapa_lote_massa)} lotes carregados da planilha.")
+    print(f"✅ SUCESSO: {len(mapa_lote_massa)} lotes carregados da planilha ({time.perf_counter() - inicio:.2f}s).")
     return mapa_lote_massa
 
 if __name__ == "__main__":
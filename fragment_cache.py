@@ -0,0 +1,91 @@
+from collections import OrderedDict
+from threading import Lock
+import zlib
+
+class FragmentCache:
+    """
+    Cache LRU de fragmentos HTML já renderizados (partials HTMX).
+    As chaves são atreladas à versão do snapshot: quando a versão muda,
+    todo o conteúdo anterior é descartado automaticamente.
+    """
+
+    def __init__(self, max_itens=256, max_size_mb=32, comprimir=True):
+        self.max_itens = max_itens
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.comprimir = comprimir
+        self.itens = OrderedDict()
+        self.versao = None
+        self.bytes_usados = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidacoes = 0
+
+    def _sincronizar_versao(self, versao):
+        # Chamado com o lock adquirido
+        if versao != self.versao:
+            if self.itens:
+                self.invalidacoes += 1
+                print(f"🗑️ Fragmentos descartados: snapshot {self.versao} -> {versao} ({len(self.itens)} itens)")
+            self.itens.clear()
+            self.bytes_usados = 0
+            self.versao = versao
+
+    def get(self, versao, chave):
+        """Retorna o HTML do fragmento ou None se não estiver em cache."""
+        with self.lock:
+            self._sincronizar_versao(versao)
+            bloco = self.itens.get(chave)
+            if bloco is None:
+                self.misses += 1
+                return None
+            self.itens.move_to_end(chave)
+            self.hits += 1
+
+        if self.comprimir:
+            return zlib.decompress(bloco).decode('utf-8')
+        return bloco.decode('utf-8')
+
+    def set(self, versao, chave, html):
+        bloco = html.encode('utf-8')
+        if self.comprimir:
+            bloco = zlib.compress(bloco, 1)
+        if len(bloco) > self.max_bytes:
+            return
+
+        with self.lock:
+            self._sincronizar_versao(versao)
+            anterior = self.itens.pop(chave, None)
+            if anterior is not None:
+                self.bytes_usados -= len(anterior)
+
+            self.itens[chave] = bloco
+            self.bytes_usados += len(bloco)
+
+            while self.itens and (len(self.itens) > self.max_itens or self.bytes_usados > self.max_bytes):
+                _, removido = self.itens.popitem(last=False)
+                self.bytes_usados -= len(removido)
+                self.evictions += 1
+
+    def invalidate(self):
+        with self.lock:
+            self.itens.clear()
+            self.bytes_usados = 0
+            self.invalidacoes += 1
+
+    def get_stats(self):
+        with self.lock:
+            consultas = self.hits + self.misses
+            return {
+                'itens': len(self.itens),
+                'versao': self.versao,
+                'tamanho_kb': round(self.bytes_usados / 1024, 1),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / consultas, 3) if consultas else 0.0,
+                'evictions': self.evictions,
+                'invalidacoes': self.invalidacoes,
+                'comprimido': self.comprimir
+            }
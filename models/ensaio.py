@@ -1,5 +1,6 @@
 from models.massa import Massa, Parametro
 from services.config_manager import carregar_regras_acao
+from services.curve_features import PARAMETROS_CURVA, PARAMETROS_CONFORMIDADE
 
 class Ensaio:
     def __init__(self, id_ensaio, massa_objeto: Massa, valores_medidos, lote, batch,
@@ -30,6 +31,9 @@ class Ensaio:
         self.tempo_configurado = None
         self.ids_agrupados = ids_agrupados if ids_agrupados is not None else [id_ensaio]
         self.equipamento_planilha = equipamento_planilha # 'CINZA', 'PRETO' ou None
+        self.caracteristicas_curva = {} # ML, MH, Ts1... extraídos da curva (vazio = ainda não extraídas)
+        self.curva_principal = None # COD_ENSAIO da curva usada nas características
+        self.conformidade_curva = {} # DesvioRMS/ForaBanda contra a curva de referência (vazio = sem referência)
 
         self.score_final = 0
         self.detalhes_score = []
@@ -129,6 +133,14 @@ class Ensaio:
         for nome_param, param in parametros_ativos.items():
             valor_medido = self.valores_medidos.get(nome_param)
 
+            # Parâmetros da curva só contam depois que a curva foi processada
+            if nome_param in PARAMETROS_CURVA and not self.caracteristicas_curva:
+                self.detalhes_score.append(f"{nome_param}: curva ainda não processada (ignorado)")
+                continue
+            if nome_param in PARAMETROS_CONFORMIDADE and not self.conformidade_curva:
+                self.detalhes_score.append(f"{nome_param}: sem curva de referência (ignorado)")
+                continue
+
             if valor_medido is None:
                 soma_pesos += param.peso
                 self.detalhes_score.append(f"{nome_param}: NAO MEDIDO (Nota 0)")
@@ -0,0 +1,143 @@
+import numpy as np
+
+# Métricas agregadas nos relatórios e a chave correspondente em Ensaio.valores_medidos
+_CHAVES_VALOR = {'ts2': 'Ts2', 't90': 'T90', 'visc': 'Viscosidade'}
+
+# Valores iguais ou abaixo do limite são tratados como "não medido"
+_LIMITE_MINIMO = {'ts2': 0, 't90': 0, 'visc': 0.1}
+
+CONTEXTOS = ('alta', 'baixa')
+
+
+def _stat_vazia():
+    return {'n': 0, 'media': None, 'min': None, 'max': None, 'desvio': None}
+
+
+def montar_colunas(lista_ensaios):
+    """
+    Extrai, em uma única passada, as colunas numéricas usadas pelos relatórios.
+    Retorna índices inteiros de massa e de (massa, lote), o contexto
+    (0 = alta, 1 = baixa) e um vetor float por métrica (NaN = ausente).
+    """
+    n = len(lista_ensaios)
+    idx_massa = np.empty(n, dtype=np.int64)
+    idx_lote = np.empty(n, dtype=np.int64)
+    contexto = np.empty(n, dtype=np.int64)
+    valores = {m: np.full(n, np.nan) for m in _CHAVES_VALOR}
+
+    chaves_massa = {}
+    chaves_lote = {}
+
+    for i, ensaio in enumerate(lista_ensaios):
+        nome = ensaio.massa.descricao
+        idx_massa[i] = chaves_massa.setdefault(nome, len(chaves_massa))
+        idx_lote[i] = chaves_lote.setdefault((nome, ensaio.lote), len(chaves_lote))
+        contexto[i] = 0 if (ensaio.temp_plato or 0) >= 175 else 1
+
+        vals = ensaio.valores_medidos
+        for metrica, chave in _CHAVES_VALOR.items():
+            v = vals.get(chave)
+            if v is not None:
+                valores[metrica][i] = v
+
+    return {
+        'idx_massa': idx_massa, 'chaves_massa': list(chaves_massa),
+        'idx_lote': idx_lote, 'chaves_lote': list(chaves_lote),
+        'contexto': contexto, 'valores': valores
+    }
+
+
+def estatisticas_por_grupo(grupos, valores, n_grupos):
+    """
+    Contagem, média, mínimo, máximo e desvio padrão amostral de 'valores'
+    agrupados pelos inteiros em 'grupos' (0..n_grupos-1), sem laços Python.
+    Grupos vazios recebem NaN; o desvio exige pelo menos 2 amostras.
+    """
+    n = np.bincount(grupos, minlength=n_grupos)
+    soma = np.bincount(grupos, weights=valores, minlength=n_grupos)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        media = soma / n
+        quad = np.bincount(grupos, weights=(valores - media[grupos]) ** 2, minlength=n_grupos)
+        desvio = np.sqrt(quad / (n - 1))
+    desvio[n < 2] = np.nan
+
+    minimo = np.full(n_grupos, np.nan)
+    maximo = np.full(n_grupos, np.nan)
+    if len(grupos):
+        ordem = np.argsort(grupos, kind='stable')
+        g = grupos[ordem]
+        v = valores[ordem]
+        inicios = np.flatnonzero(np.r_[True, g[1:] != g[:-1]])
+        minimo[g[inicios]] = np.minimum.reduceat(v, inicios)
+        maximo[g[inicios]] = np.maximum.reduceat(v, inicios)
+
+    return n, media, minimo, maximo, desvio
+
+
+def _agregar_metrica(idx, n_chaves, contexto, valores, limite, por_contexto):
+    validos = np.isfinite(valores) & (valores > limite)
+    grupos = idx[validos] * 2 + contexto[validos] if por_contexto else idx[validos]
+    n_grupos = n_chaves * 2 if por_contexto else n_chaves
+    return estatisticas_por_grupo(grupos, valores[validos], n_grupos)
+
+
+def _para_dict(resultado, g):
+    n, media, minimo, maximo, desvio = resultado
+    if n[g] == 0:
+        return _stat_vazia()
+    return {
+        'n': int(n[g]),
+        'media': float(media[g]),
+        'min': float(minimo[g]),
+        'max': float(maximo[g]),
+        'desvio': None if np.isnan(desvio[g]) else float(desvio[g])
+    }
+
+
+def _agregar_nivel(colunas, idx, chaves):
+    n_chaves = len(chaves)
+    contexto = colunas['contexto']
+    valores = colunas['valores']
+
+    por_metrica = {
+        'ts2': _agregar_metrica(idx, n_chaves, contexto, valores['ts2'], _LIMITE_MINIMO['ts2'], True),
+        't90': _agregar_metrica(idx, n_chaves, contexto, valores['t90'], _LIMITE_MINIMO['t90'], True),
+        'visc': _agregar_metrica(idx, n_chaves, contexto, valores['visc'], _LIMITE_MINIMO['visc'], False),
+    }
+
+    saida = {}
+    for i, chave in enumerate(chaves):
+        saida[chave] = {
+            ctx: {
+                'ts2': _para_dict(por_metrica['ts2'], i * 2 + c),
+                't90': _para_dict(por_metrica['t90'], i * 2 + c),
+            }
+            for c, ctx in enumerate(CONTEXTOS)
+        }
+        saida[chave]['visc'] = _para_dict(por_metrica['visc'], i)
+    return saida
+
+
+def agregar_relatorio(lista_ensaios):
+    """
+    Estatísticas de Ts2/T90 (por contexto alta/baixa) e Viscosidade para
+    cada massa e para cada (massa, lote), calculadas sobre as colunas do
+    snapshot em uma única passada vetorizada.
+
+    Retorna {'massas': {nome: stats}, 'lotes': {(nome, lote): stats}}, onde
+    stats = {'alta': {'ts2': s, 't90': s}, 'baixa': {...}, 'visc': s} e
+    s = {'n', 'media', 'min', 'max', 'desvio'}.
+    """
+    colunas = montar_colunas(lista_ensaios)
+    return {
+        'massas': _agregar_nivel(colunas, colunas['idx_massa'], colunas['chaves_massa']),
+        'lotes': _agregar_nivel(colunas, colunas['idx_lote'], colunas['chaves_lote'])
+    }
+
+
+def estatisticas_vazias():
+    """Estrutura de estatísticas sem dados (mesmo formato de agregar_relatorio)."""
+    saida = {ctx: {'ts2': _stat_vazia(), 't90': _stat_vazia()} for ctx in CONTEXTOS}
+    saida['visc'] = _stat_vazia()
+    return saida
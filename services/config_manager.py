@@ -1,33 +1,233 @@
 import json
 import os
+import sqlite3
+from threading import Lock
 
 from models.massa import Parametro
 
 CONFIG_FILE = "config_massas.json"
 REGRAS_FILE = "config_regras.json"
 
+# Specs das massas: tabela SQLite indexada por (cod_sankhya, perfil).
+# O config_massas.json vira apenas formato de importação/exportação.
+CONFIG_DB = os.getenv("CONFIG_MASSAS_DB", os.path.join("instance", "config_massas.db"))
+
+# Prefixos de perfil nas chaves das specs (ex.: "alta_cinza_Ts2"); os específicos primeiro
+PERFIS = ['alta_cinza', 'alta_preto', 'alta', 'baixa']
+
+_LOCK = Lock()
+_BANCO_PRONTO = False
+# Última leitura completa das specs e a versão do banco em que foi feita
+_CACHE_CONFIG = {'versao': None, 'dados': {}}
+
+
+def _separar_perfil(chave):
+    """'alta_cinza_Ts2' -> ('alta_cinza', 'Ts2'); chaves sem perfil -> ('', chave)."""
+    for perfil in PERFIS:
+        if chave.startswith(perfil + '_'):
+            return perfil, chave[len(perfil) + 1:]
+    return '', chave
+
+
+def _conectar():
+    global _BANCO_PRONTO
+    if not _BANCO_PRONTO:
+        with _LOCK:
+            if not _BANCO_PRONTO:
+                _criar_banco()
+                _BANCO_PRONTO = True
+    return sqlite3.connect(CONFIG_DB, timeout=30)
+
+
+def _criar_banco():
+    os.makedirs(os.path.dirname(CONFIG_DB) or '.', exist_ok=True)
+    conn = sqlite3.connect(CONFIG_DB, timeout=30)
+    try:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS specs (
+                cod_sankhya INTEGER NOT NULL,
+                perfil TEXT NOT NULL,
+                specs TEXT NOT NULL,
+                PRIMARY KEY (cod_sankhya, perfil)
+            );
+            CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta (chave, valor) VALUES ('versao', 0);
+        """)
+        conn.commit()
+
+        # Primeira execução: traz as specs do config_massas.json antigo, uma
+        # única vez. Bancos de antes da flag que já têm specs contam como migrados.
+        migrado = conn.execute("SELECT valor FROM meta WHERE chave = 'migrado'").fetchone()
+        if migrado is None:
+            vazio = conn.execute("SELECT COUNT(*) FROM specs").fetchone()[0] == 0
+            if vazio and os.path.exists(CONFIG_FILE):
+                dados = _specs_validas(_ler_json(CONFIG_FILE), CONFIG_FILE)
+                if dados:
+                    _gravar_produtos(conn, dados)
+                    print(f"📦 {len(dados)} configurações importadas de {CONFIG_FILE} para {CONFIG_DB}")
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO meta (chave, valor) VALUES ('migrado', 1)")
+    finally:
+        conn.close()
+
+
+def _gravar_produtos(conn, produtos, substituir_tudo=False):
+    """
+    Grava {cod_sankhya: specs} em uma única transação (uma linha por
+    produto/perfil) e incrementa a versão: ou tudo entra, ou nada.
+    Specs vazias ficam como uma linha sem perfil ('', '{}'), para que o
+    produto continue aparecendo (sem specs) em carregar_configuracoes.
+    """
+    with conn:
+        if substituir_tudo:
+            conn.execute("DELETE FROM specs")
+        for cod, specs in produtos.items():
+            por_perfil = {}
+            for chave, valor in specs.items():
+                perfil, nome = _separar_perfil(chave)
+                por_perfil.setdefault(perfil, {})[nome] = valor
+
+            conn.execute("DELETE FROM specs WHERE cod_sankhya = ?", (int(cod),))
+            conn.executemany(
+                "INSERT INTO specs (cod_sankhya, perfil, specs) VALUES (?, ?, ?)",
+                [(int(cod), perfil, json.dumps(valores)) for perfil, valores in por_perfil.items()]
+                or [(int(cod), '', '{}')]
+            )
+        conn.execute("UPDATE meta SET valor = valor + 1 WHERE chave = 'versao'")
+
+
+def _ler_versao(conn):
+    return conn.execute("SELECT valor FROM meta WHERE chave = 'versao'").fetchone()[0]
+
+
 def carregar_configuracoes():
-    """Lê o arquivo JSON e retorna um dicionário com as specs."""
-    if not os.path.exists(CONFIG_FILE):
-        return {}
+    """
+    Retorna um dicionário com as specs, no formato do config_massas.json
+    ({cod_sankhya (str): {chave: valor}}). Enquanto a versão não muda,
+    devolve a mesma leitura (não alterar o dicionário retornado).
+    """
     try:
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        conn = _conectar()
+        try:
+            conn.execute("BEGIN") # versão e linhas do mesmo instante
+            versao = _ler_versao(conn)
+            with _LOCK:
+                if _CACHE_CONFIG['versao'] == versao:
+                    return _CACHE_CONFIG['dados']
+
+            dados = {}
+            for cod, perfil, specs in conn.execute("SELECT cod_sankhya, perfil, specs FROM specs ORDER BY cod_sankhya"):
+                produto = dados.setdefault(str(cod), {})
+                for nome, valor in json.loads(specs).items():
+                    produto[f"{perfil}_{nome}" if perfil else nome] = valor
+        finally:
+            conn.close()
     except Exception as e:
         print(f"⚠️ Erro ao ler config: {e}")
         return {}
 
+    with _LOCK:
+        _CACHE_CONFIG['versao'] = versao
+        _CACHE_CONFIG['dados'] = dados
+    return dados
+
 def salvar_configuracao(cod_sankhya, specs):
     """
-    Salva/Atualiza as specs de um produto.
+    Salva/Atualiza as specs de um produto (só as linhas dele, em uma transação).
     """
-    dados = carregar_configuracoes()
-    dados[str(cod_sankhya)] = specs # Chave sempre string
-    
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(dados, f, indent=4)
+    conn = _conectar()
+    try:
+        _gravar_produtos(conn, {cod_sankhya: specs})
+    finally:
+        conn.close()
     print(f"💾 Configuração salva para o produto {cod_sankhya}")
 
+
+def _ler_json(caminho):
+    try:
+        with open(caminho, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except Exception as e:
+        print(f"⚠️ Erro ao ler {caminho}: {e}")
+        return {}
+
+
+def _validar_produto(cod, specs):
+    if not str(cod).strip().isdigit():
+        raise ValueError(f"código de produto inválido: {cod!r}")
+    if not isinstance(specs, dict):
+        raise ValueError(f"as specs do produto {cod} não são um objeto")
+
+
+def _validar_specs(dados):
+    """Confere o formato {cod_sankhya: {chave: valor}}; levanta ValueError se não bater."""
+    if not isinstance(dados, dict):
+        raise ValueError("o JSON deve ser um objeto {cod_sankhya: specs}")
+    for cod, specs in dados.items():
+        _validar_produto(cod, specs)
+
+
+def _specs_validas(dados, origem):
+    """
+    Só as entradas válidas de 'dados' (as demais são registradas no log).
+    Usado na migração: uma chave ruim do JSON antigo (ex.: "None") não pode
+    impedir a criação do banco.
+    """
+    if not isinstance(dados, dict):
+        print(f"⚠️ {origem} ignorado: não é um objeto {{cod_sankhya: specs}}")
+        return {}
+    validas = {}
+    for cod, specs in dados.items():
+        try:
+            _validar_produto(cod, specs)
+        except ValueError as e:
+            print(f"⚠️ {origem}: entrada ignorada ({e})")
+            continue
+        validas[cod] = specs
+    return validas
+
+
+def importar_configuracoes_json(arquivo=CONFIG_FILE, substituir=False):
+    """
+    Importa specs no formato do config_massas.json ('arquivo' é um caminho
+    ou um arquivo aberto, ex.: upload). Com 'substituir', o banco passa a
+    ter só o conteúdo do arquivo; senão, só os produtos do arquivo são
+    sobrescritos. JSON inválido levanta ValueError sem tocar no banco.
+    Retorna quantos produtos foram importados.
+    """
+    if hasattr(arquivo, 'read'):
+        dados = json.load(arquivo)
+    else:
+        with open(arquivo, 'r', encoding='utf-8') as f:
+            dados = json.load(f)
+    _validar_specs(dados)
+
+    conn = _conectar()
+    try:
+        _gravar_produtos(conn, dados, substituir_tudo=substituir)
+    finally:
+        conn.close()
+    print(f"📦 {len(dados)} configurações importadas")
+    return len(dados)
+
+
+def exportar_configuracoes_json(caminho=None):
+    """
+    Todas as specs no formato do config_massas.json. Sem 'caminho' devolve o
+    texto JSON; com ele, grava o arquivo (troca atômica) e devolve quantos
+    produtos foram exportados.
+    """
+    dados = carregar_configuracoes()
+    texto = json.dumps(dados, indent=4)
+    if caminho is None:
+        return texto
+    temporario = caminho + '.tmp'
+    with open(temporario, 'w', encoding='utf-8') as f:
+        f.write(texto)
+    os.replace(temporario, caminho)
+    print(f"💾 {len(dados)} configurações exportadas para {caminho}")
+    return len(dados)
+
 def aplicar_configuracoes_no_catalogo(catalogo_objetos):
     configs = carregar_configuracoes()
     count = 0
@@ -43,19 +243,10 @@ def aplicar_configuracoes_no_catalogo(catalogo_objetos):
                 
             for chave_param, valores in specs.items():
                 
-                # --- DETECÇÃO DE PERFIL ATUALIZADA ---
-                perfil = None
-                
-                # Prioridade para os específicos
-                if chave_param.startswith('alta_cinza_'): perfil = 'alta_cinza'
-                elif chave_param.startswith('alta_preto_'): perfil = 'alta_preto'
-                elif chave_param.startswith('alta_'): perfil = 'alta' # Legacy
-                elif chave_param.startswith('baixa_'): perfil = 'baixa'
+                # Perfil pelo prefixo ('alta' é o legado), nome real sem ele (ex: "alta_cinza_Ts2" -> "Ts2")
+                perfil, nome_real = _separar_perfil(chave_param)
                 
                 if perfil:
-                    # Remove o prefixo para obter o nome real (ex: "alta_cinza_Ts2" -> "Ts2")
-                    nome_real = chave_param.replace(f"{perfil}_", "")
-                    
                     # Caso Especial: Temperatura/Tempo Padrão
                     if nome_real in ["temp_padrao", "tempo_total"]:
                         produto.perfis[perfil][nome_real] = valores
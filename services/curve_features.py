@@ -0,0 +1,218 @@
+import warnings
+
+import numpy as np
+
+# Nomes dos parâmetros derivados da curva (usados em config_massas.json e em
+# Ensaio.valores_medidos). Tempos na mesma unidade de TEMPO da curva e
+# torques em lb.in; TaxaCura em lb.in por unidade de tempo.
+PARAMETROS_CURVA = ['ML', 'MH', 'Ts1', 'Tc50', 'TaxaCura', 'Reversao']
+
+# Conformidade com a curva de referência da massa/perfil: desvio RMS em
+# relação à mediana e maior saída da banda de tolerância (lb.in)
+PARAMETROS_CONFORMIDADE = ['DesvioRMS', 'ForaBanda']
+
+# Acréscimo de torque sobre o ML que define o ts1
+DELTA_TS1 = 1.0
+
+# Curva de referência: pontos da grade de tempo comum, largura da banda em
+# desvios robustos (MAD escalado) e largura mínima da banda (lb.in)
+GRADE_PONTOS = 256
+K_BANDA = 3.0
+BANDA_MINIMA = 0.1
+
+
+def _matriz_curvas(curvas):
+    """Empilha as curvas em matrizes (n_curvas x n_max) completadas com NaN."""
+    comprimentos = np.array([len(c['tempo']) for c in curvas], dtype=np.int64)
+    n_max = int(comprimentos.max())
+    tempo = np.full((len(curvas), n_max), np.nan)
+    torque = np.full((len(curvas), n_max), np.nan)
+    for i, curva in enumerate(curvas):
+        tempo[i, :comprimentos[i]] = curva['tempo']
+        torque[i, :comprimentos[i]] = curva['torque']
+    return tempo, torque, comprimentos
+
+
+def _cruzamento(tempo, torque, apos_ml, limiar):
+    """
+    Tempo (interpolado) em que cada curva cruza 'limiar' pela primeira vez
+    depois do ML. NaN para as curvas que não chegam ao limiar.
+    """
+    linhas = np.arange(len(torque))
+    with np.errstate(invalid='ignore'):
+        acima = apos_ml & (torque >= limiar[:, None])
+    cruzou = acima.any(axis=1)
+    k = acima.argmax(axis=1)
+    k0 = np.maximum(k - 1, 0)
+
+    t0, t1 = tempo[linhas, k0], tempo[linhas, k]
+    y0, y1 = torque[linhas, k0], torque[linhas, k]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fracao = np.where(y1 > y0, (limiar - y0) / (y1 - y0), 1.0)
+    t = t0 + np.clip(fracao, 0, 1) * (t1 - t0)
+    return np.where(cruzou, t, np.nan)
+
+
+def extrair_caracteristicas(curvas):
+    """
+    Calcula, de uma vez para todas as curvas de {COD_ENSAIO: curva}, os
+    parâmetros de PARAMETROS_CURVA:
+      ML/MH     torque mínimo / máximo
+      Ts1       tempo até ML + 1
+      Tc50      tempo até ML + 50% de (MH - ML)
+      TaxaCura  maior inclinação dTorque/dTempo
+      Reversao  queda do MH até o torque final
+    Retorna {COD_ENSAIO: {nome: valor ou None}}. Curvas com menos de dois
+    pontos ficam de fora.
+    """
+    ids = [c_id for c_id, c in curvas.items() if len(c['tempo']) >= 2]
+    if not ids:
+        return {}
+
+    tempo, torque, comprimentos = _matriz_curvas([curvas[c_id] for c_id in ids])
+    linhas = np.arange(len(ids))
+
+    i_ml = np.nanargmin(torque, axis=1)
+    ml = torque[linhas, i_ml]
+    mh = np.nanmax(torque, axis=1)
+    final = torque[linhas, comprimentos - 1]
+
+    apos_ml = np.arange(torque.shape[1])[None, :] >= i_ml[:, None]
+    ts1 = _cruzamento(tempo, torque, apos_ml, ml + DELTA_TS1)
+    tc50 = _cruzamento(tempo, torque, apos_ml, ml + 0.5 * (mh - ml))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dt = np.diff(tempo, axis=1)
+        inclinacao = np.diff(torque, axis=1) / dt
+    inclinacao[~(dt > 0)] = -np.inf
+    taxa = inclinacao.max(axis=1)
+    taxa[~np.isfinite(taxa)] = np.nan
+
+    colunas = {
+        'ML': ml, 'MH': mh, 'Ts1': ts1, 'Tc50': tc50,
+        'TaxaCura': taxa, 'Reversao': np.maximum(mh - final, 0)
+    }
+
+    saida = {}
+    for i, c_id in enumerate(ids):
+        saida[c_id] = {
+            nome: (float(valores[i]) if np.isfinite(valores[i]) else None)
+            for nome, valores in colunas.items()
+        }
+    return saida
+
+
+def aplicar_caracteristicas(lista_ensaios, caracteristicas):
+    """
+    Anexa a cada Ensaio as características da sua curva principal (a de
+    maior temperatura de platô entre os COD_ENSAIO agrupados, guardada em
+    ensaio.curva_principal) e as copia para valores_medidos, onde o score
+    as encontra pelo nome.
+
+    'caracteristicas' é {COD_ENSAIO: {'temp_plato': t, 'valores': {nome: v}}}.
+    Curva sem nenhum valor extraído (curta demais, sem pontos válidos) conta
+    como não processada: caracteristicas_curva fica vazio e o score ignora
+    os parâmetros da curva em vez de dar nota 0.
+    Retorna a lista de ensaios que ganharam características novas.
+    """
+    alterados = []
+    for ensaio in lista_ensaios:
+        candidatas = [
+            i for i in (getattr(ensaio, 'ids_agrupados', None) or [ensaio.id_ensaio])
+            if i in caracteristicas
+        ]
+        if not candidatas:
+            continue
+
+        ensaio.curva_principal = max(candidatas, key=lambda i: caracteristicas[i]['temp_plato'] or 0)
+        principal = caracteristicas[ensaio.curva_principal]['valores']
+        if all(v is None for v in principal.values()):
+            principal = {}
+        if principal == ensaio.caracteristicas_curva:
+            continue
+
+        ensaio.caracteristicas_curva = principal
+        _copiar_valores(ensaio, principal, PARAMETROS_CURVA)
+        alterados.append(ensaio)
+    return alterados
+
+
+def _copiar_valores(ensaio, valores, nomes):
+    for nome in nomes:
+        valor = valores.get(nome)
+        if valor is None:
+            ensaio.valores_medidos.pop(nome, None)
+        else:
+            ensaio.valores_medidos[nome] = valor
+
+
+# --- CURVA DE REFERÊNCIA ("CURVA DE OURO") ---
+
+def reamostrar(curvas, grade):
+    """
+    Matriz (n_curvas x len(grade)) com o torque de cada curva interpolado na
+    grade de tempo comum. Fora do intervalo medido de cada curva fica NaN.
+    """
+    matriz = np.full((len(curvas), len(grade)), np.nan)
+    for i, curva in enumerate(curvas):
+        if len(curva['tempo']) >= 2:
+            matriz[i] = np.interp(grade, curva['tempo'], curva['torque'], left=np.nan, right=np.nan)
+    return matriz
+
+
+def construir_referencia(curvas):
+    """
+    Curva de referência a partir de curvas aprovadas: reamostra todas em uma
+    grade de tempo comum (até a duração mediana) e toma, ponto a ponto, a
+    mediana e uma banda de K_BANDA desvios robustos (1.4826 * MAD).
+    """
+    duracao = float(np.median([c['tempo'][-1] for c in curvas if len(c['tempo'])]))
+    grade = np.linspace(0, duracao, GRADE_PONTOS)
+    matriz = reamostrar(curvas, grade)
+
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', RuntimeWarning) # colunas só com NaN (nenhuma curva chega lá)
+        mediana = np.nanmedian(matriz, axis=0)
+        mad = np.nanmedian(np.abs(matriz - mediana), axis=0) * 1.4826
+    banda = np.maximum(K_BANDA * np.nan_to_num(mad), BANDA_MINIMA)
+
+    return {
+        'grade': grade,
+        'mediana': mediana,
+        'inferior': mediana - banda,
+        'superior': mediana + banda,
+        'n_curvas': len(curvas)
+    }
+
+
+def pontuar_conformidade(curvas, referencia):
+    """
+    Compara todas as curvas com a referência de uma só vez. Retorna, na
+    ordem de 'curvas', {'DesvioRMS': v, 'ForaBanda': v}, ou {} quando a curva
+    não cobre nenhum ponto da grade (tratada como sem referência no score).
+    """
+    if not curvas:
+        return []
+    matriz = reamostrar(curvas, referencia['grade'])
+    cobertos = np.isfinite(matriz) & np.isfinite(referencia['mediana'])
+    tem_dados = cobertos.any(axis=1)
+
+    desvio = np.where(cobertos, matriz - referencia['mediana'], 0.0)
+    rms = np.sqrt((desvio ** 2).sum(axis=1) / np.maximum(cobertos.sum(axis=1), 1))
+
+    excesso = np.fmax(matriz - referencia['superior'], referencia['inferior'] - matriz)
+    fora = np.where(cobertos, np.maximum(excesso, 0), 0.0).max(axis=1)
+
+    return [
+        {'DesvioRMS': float(rms[i]), 'ForaBanda': float(fora[i])} if tem_dados[i] else {}
+        for i in range(len(curvas))
+    ]
+
+
+def aplicar_conformidade(ensaio, metricas):
+    """Anexa as métricas de conformidade ao Ensaio. Retorna True se mudaram."""
+    if metricas == ensaio.conformidade_curva:
+        return False
+    ensaio.conformidade_curva = metricas
+    _copiar_valores(ensaio, metricas, PARAMETROS_CONFORMIDADE)
+    return True
@@ -0,0 +1,560 @@
+import copy
+import json
+import os
+import struct
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from threading import Lock, Thread
+
+import numpy as np
+
+from connection import consultar_por_ids
+from services.curve_features import (
+    aplicar_caracteristicas, aplicar_conformidade, construir_referencia,
+    extrair_caracteristicas, pontuar_conformidade
+)
+from services.curve_store import CurveStore
+
+# Orçamento de memória do cache de curvas (MB)
+CACHE_CURVAS_MB = float(os.getenv("CACHE_CURVAS_MB", "128"))
+
+# Curvas mais novas que isso podem ser de ensaios ainda em andamento: não entram no cache
+IDADE_MINIMA_CACHE = timedelta(minutes=30)
+
+# Custo fixo aproximado de cada entrada (dict + metadados), somado ao tamanho dos arrays
+_OVERHEAD_ENTRADA = 256
+
+
+class CurveCache:
+    """
+    Cache LRU de curvas reométricas (TEMPO x TORQUE) por COD_ENSAIO,
+    limitado pelo total de bytes dos arrays armazenados.
+    Curvas de ensaios finalizados não mudam, então não há TTL.
+    """
+
+    def __init__(self, max_size_mb=128):
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.itens = OrderedDict()
+        self.bytes_usados = 0
+        self.lock = Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _tamanho(curva):
+        return curva['tempo'].nbytes + curva['torque'].nbytes + _OVERHEAD_ENTRADA
+
+    def get_many(self, ids):
+        """Retorna ({id: curva} encontrados, [ids faltantes])."""
+        encontrados = {}
+        faltantes = []
+        with self.lock:
+            for c_id in ids:
+                curva = self.itens.get(c_id)
+                if curva is None:
+                    faltantes.append(c_id)
+                    continue
+                self.itens.move_to_end(c_id)
+                encontrados[c_id] = curva
+            self.hits += len(encontrados)
+            self.misses += len(faltantes)
+        return encontrados, faltantes
+
+    def put(self, c_id, curva):
+        tamanho = self._tamanho(curva)
+        if tamanho > self.max_bytes:
+            return
+
+        with self.lock:
+            anterior = self.itens.pop(c_id, None)
+            if anterior is not None:
+                self.bytes_usados -= self._tamanho(anterior)
+
+            self.itens[c_id] = curva
+            self.bytes_usados += tamanho
+
+            while self.itens and self.bytes_usados > self.max_bytes:
+                _, removida = self.itens.popitem(last=False)
+                self.bytes_usados -= self._tamanho(removida)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.itens.clear()
+            self.bytes_usados = 0
+
+    def get_stats(self):
+        with self.lock:
+            consultas = self.hits + self.misses
+            return {
+                'curvas': len(self.itens),
+                'tamanho_mb': round(self.bytes_usados / (1024 * 1024), 2),
+                'limite_mb': round(self.max_bytes / (1024 * 1024), 2),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / consultas, 3) if consultas else 0.0,
+                'evictions': self.evictions
+            }
+
+
+_CACHE_CURVAS = CurveCache(max_size_mb=CACHE_CURVAS_MB)
+
+# Espelho local em disco (instance/curvas); None se não puder ser criado
+try:
+    _STORE_CURVAS = CurveStore()
+except Exception as e:
+    print(f"⚠️ Espelho local de curvas desativado: {e}")
+    _STORE_CURVAS = None
+
+# Quantas curvas o espelhamento em segundo plano busca por consulta / por ciclo
+ESPELHO_TAMANHO_LOTE = 200
+ESPELHO_MAX_POR_CICLO = int(os.getenv("CURVAS_ESPELHO_MAX_POR_CICLO", "5000"))
+# Um único worker por vez; 'pendente' guarda só o pedido do snapshot mais novo
+_ESPELHO_LOCK = Lock()
+_ESPELHO_ESTADO = {'rodando': False, 'pendente': None}
+
+
+def _curva_finalizada(data_ensaio):
+    if not data_ensaio or not hasattr(data_ensaio, 'year'):
+        return False
+    return datetime.now() - data_ensaio >= IDADE_MINIMA_CACHE
+
+
+def iterar_curvas_sql(ids):
+    """
+    Gera (COD_ENSAIO, curva) direto do SQL Server, uma curva por vez, à
+    medida que as linhas chegam. Serve para exportações e análises com
+    muitos IDs sem montar todas as curvas em memória.
+    """
+    query = '''
+        SELECT
+            V.COD_ENSAIO,
+            V.TEMPO,
+            V.TORQUE,
+            E.TEMP_PLATO_INF,
+            E.COD_GRUPO,
+            E.DATA
+        FROM dbo.ENSAIO_VALORES V
+        JOIN dbo.ENSAIO E ON V.COD_ENSAIO = E.COD_ENSAIO
+        WHERE {filtro}
+        ORDER BY V.COD_ENSAIO, V.TEMPO
+    '''
+
+    def _fechar(c_id, reg):
+        return c_id, {
+            'tempo': np.asarray(reg['tempo'], dtype=np.float64),
+            'torque': np.asarray(reg['torque'], dtype=np.float64),
+            'temp_plato': reg['temp_plato'],
+            'cod_grupo': reg['cod_grupo'],
+            'data': reg['data']
+        }
+
+    # As linhas vêm ordenadas por COD_ENSAIO: a curva fica completa quando o ID muda
+    atual = None
+    reg = None
+    for row in consultar_por_ids(query, 'V.COD_ENSAIO', ids):
+        c_id = int(row[0])
+        if c_id != atual:
+            if reg is not None:
+                yield _fechar(atual, reg)
+            atual = c_id
+            reg = {
+                'tempo': [], 'torque': [],
+                'temp_plato': float(row[3]) if row[3] else 0,
+                'cod_grupo': row[4],
+                'data': row[5]
+            }
+        reg['tempo'].append(float(row[1]))
+        reg['torque'].append(float(row[2]))
+    if reg is not None:
+        yield _fechar(atual, reg)
+
+
+def _buscar_curvas_sql(ids):
+    """Busca no SQL Server os pontos das curvas informadas, agrupados por COD_ENSAIO."""
+    return dict(iterar_curvas_sql(ids))
+
+
+def buscar_curvas(ids):
+    """
+    Retorna {COD_ENSAIO: curva} para os IDs pedidos, onde curva tem os arrays
+    'tempo' e 'torque' e os metadados 'temp_plato', 'cod_grupo' e 'data'.
+    Ordem de busca: cache em memória -> espelho local -> SQL Server
+    (só para os IDs que ainda não estão espelhados).
+    """
+    ids = [int(i) for i in ids]
+    curvas, faltantes = _CACHE_CURVAS.get_many(ids)
+
+    if faltantes and _STORE_CURVAS:
+        do_store, faltantes = _STORE_CURVAS.ler(faltantes)
+        for c_id, curva in do_store.items():
+            _CACHE_CURVAS.put(c_id, curva)
+        curvas.update(do_store)
+
+    if faltantes:
+        novas = _buscar_curvas_sql(faltantes)
+        finalizadas = {c_id: c for c_id, c in novas.items() if _curva_finalizada(c['data'])}
+        for c_id, curva in finalizadas.items():
+            _CACHE_CURVAS.put(c_id, curva)
+        if _STORE_CURVAS:
+            _STORE_CURVAS.gravar(finalizadas)
+        curvas.update(novas)
+
+    return curvas
+
+
+def espelhar_curvas(ids):
+    """
+    Copia para o espelho local as curvas finalizadas de 'ids' que ainda
+    não estão lá, em consultas de ESPELHO_TAMANHO_LOTE IDs.
+    Retorna quantas curvas foram gravadas.
+    """
+    if not _STORE_CURVAS:
+        return 0
+
+    ids = sorted({int(i) for i in ids})
+    existentes = _STORE_CURVAS.ids_existentes(ids)
+    pendentes = [i for i in ids if i not in existentes]
+    pendentes = pendentes[-ESPELHO_MAX_POR_CICLO:] # prioriza os ensaios mais novos
+
+    gravadas = 0
+    for i in range(0, len(pendentes), ESPELHO_TAMANHO_LOTE):
+        novas = _buscar_curvas_sql(pendentes[i:i + ESPELHO_TAMANHO_LOTE])
+        finalizadas = {c_id: c for c_id, c in novas.items() if _curva_finalizada(c['data'])}
+        gravadas += _STORE_CURVAS.gravar(finalizadas)
+    return gravadas
+
+
+def extrair_caracteristicas_pendentes():
+    """
+    Extrai (ML, MH, Ts1, Tc50, TaxaCura, Reversao) das curvas espelhadas que
+    ainda não têm características, em lotes de ESPELHO_TAMANHO_LOTE curvas
+    lidas direto do espelho. Retorna quantas curvas foram processadas.
+    """
+    if not _STORE_CURVAS:
+        return 0
+
+    processadas = 0
+    while processadas < ESPELHO_MAX_POR_CICLO:
+        ids = _STORE_CURVAS.ids_sem_caracteristicas(ESPELHO_TAMANHO_LOTE)
+        if not ids:
+            break
+        curvas, _ = _STORE_CURVAS.ler(ids)
+        extraidas = extrair_caracteristicas(curvas)
+        # Curvas sem pontos suficientes também são marcadas, para não voltarem à fila;
+        # sem nenhum valor, aplicar_caracteristicas as trata como não processadas
+        for c_id in ids:
+            extraidas.setdefault(c_id, {})
+        processadas += _STORE_CURVAS.gravar_caracteristicas(extraidas)
+    return processadas
+
+
+def ler_caracteristicas_curvas(ids):
+    """{COD_ENSAIO: {'temp_plato', 'valores'}} já extraídas no espelho local (sem ir ao SQL Server)."""
+    if not _STORE_CURVAS:
+        return {}
+    return _STORE_CURVAS.ler_caracteristicas(ids)
+
+
+# Curvas de referência por (cod_sankhya, perfil), refeitas a cada ciclo de espelhamento
+MIN_CURVAS_REFERENCIA = 5
+MAX_CURVAS_REFERENCIA = 200
+_REFERENCIAS = {}
+
+
+def _aprovado(ensaio):
+    """
+    Aprovado pelos parâmetros base. A conformidade fica de fora: se
+    DesvioRMS/ForaBanda estiverem nas specs, a ação já depende da referência
+    atual, e escolher as curvas da próxima referência por ela a faria
+    realimentar a si mesma.
+    """
+    if getattr(ensaio, 'conformidade_curva', None):
+        ensaio = copy.copy(ensaio)
+        ensaio.conformidade_curva = {} # calcular_score ignora DesvioRMS/ForaBanda
+        ensaio.calcular_score()
+    return str(getattr(ensaio, 'acao_recomendada', '')).startswith('LIBERAR')
+
+
+def atualizar_referencias(lista_ensaios):
+    """
+    Monta a curva de referência de cada (massa, perfil) com as curvas dos
+    lotes aprovados mais recentes e pontua a conformidade de todas as curvas
+    do grupo contra ela. As curvas vêm do espelho local (memmap).
+    Retorna a lista de ensaios cujas métricas de conformidade mudaram.
+    """
+    global _REFERENCIAS
+    if not _STORE_CURVAS:
+        return []
+
+    grupos = {}
+    for ensaio in lista_ensaios:
+        if getattr(ensaio, 'curva_principal', None) is None:
+            continue
+        chave = (ensaio.massa.cod_sankhya, getattr(ensaio, 'nome_perfil_usado', ''))
+        grupos.setdefault(chave, []).append(ensaio)
+
+    curvas, _ = _STORE_CURVAS.ler([e.curva_principal for ensaios in grupos.values() for e in ensaios])
+
+    referencias = {}
+    alterados = []
+    for chave, ensaios in grupos.items():
+        ensaios = [e for e in ensaios if e.curva_principal in curvas]
+        aprovados = sorted(
+            (e for e in ensaios if _aprovado(e)),
+            key=lambda e: e.data_hora or datetime.min, reverse=True
+        )[:MAX_CURVAS_REFERENCIA]
+
+        if len(aprovados) < MIN_CURVAS_REFERENCIA:
+            metricas = [{} for _ in ensaios]
+        else:
+            referencias[chave] = construir_referencia([curvas[e.curva_principal] for e in aprovados])
+            metricas = pontuar_conformidade([curvas[e.curva_principal] for e in ensaios], referencias[chave])
+
+        for ensaio, m in zip(ensaios, metricas):
+            if aplicar_conformidade(ensaio, m):
+                alterados.append(ensaio)
+
+    _REFERENCIAS = referencias
+    return alterados
+
+
+def obter_referencia(cod_sankhya, perfil):
+    """Curva de referência já calculada para (cod_sankhya, perfil) ou None."""
+    return _REFERENCIAS.get((cod_sankhya, perfil))
+
+
+def _ids_dos_ensaios(lista_ensaios):
+    return [i for e in lista_ensaios for i in (getattr(e, 'ids_agrupados', None) or [e.id_ensaio])]
+
+
+def _copiar_ensaio(ensaio):
+    """Cópia do Ensaio que pode ser recalculada sem tocar no original do snapshot."""
+    copia = copy.copy(ensaio)
+    copia.valores_medidos = dict(ensaio.valores_medidos)
+    return copia
+
+
+def _espelhar_snapshot(lista_ensaios, ao_atualizar):
+    """
+    Um ciclo de espelhamento para a lista de ensaios de um snapshot.
+    Características, conformidade e score são recalculados em cópias dos
+    ensaios; o snapshot publicado não é alterado aqui. As cópias que
+    mudaram vão para ao_atualizar(lista_ensaios, {id(original): copia}).
+    """
+    ids = _ids_dos_ensaios(lista_ensaios)
+
+    inicio = datetime.now()
+    gravadas = espelhar_curvas(ids)
+    extraidas = extrair_caracteristicas_pendentes()
+    if gravadas or extraidas:
+        segundos = (datetime.now() - inicio).total_seconds()
+        print(f"💽 Espelho de curvas: {gravadas} novas curvas gravadas, "
+              f"{extraidas} características extraídas em {segundos:.1f}s.")
+
+    copias = [_copiar_ensaio(e) for e in lista_ensaios]
+    # Sempre aplica o que já está no espelho: as características podem ter
+    # sido extraídas num ciclo anterior, para outro snapshot
+    alterados = aplicar_caracteristicas(copias, ler_caracteristicas_curvas(ids))
+    alterados = {id(e): e for e in alterados + atualizar_referencias(copias)}
+    if not alterados:
+        return
+
+    for ensaio in alterados.values():
+        ensaio.calcular_score()
+    if ao_atualizar:
+        ao_atualizar(lista_ensaios, {
+            id(original): copia
+            for original, copia in zip(lista_ensaios, copias) if id(copia) in alterados
+        })
+
+
+def _laco_espelhamento():
+    while True:
+        with _ESPELHO_LOCK:
+            pedido = _ESPELHO_ESTADO['pendente']
+            _ESPELHO_ESTADO['pendente'] = None
+            if pedido is None:
+                _ESPELHO_ESTADO['rodando'] = False
+                return
+        try:
+            _espelhar_snapshot(*pedido)
+        except Exception as e:
+            print(f"⚠️ Erro no espelhamento de curvas: {e}")
+
+
+def iniciar_espelhamento(lista_ensaios, ao_atualizar=None):
+    """
+    Dispara, em segundo plano, o espelhamento das curvas dos ensaios do
+    snapshot, a extração das características das curvas novas e a
+    pontuação contra as curvas de referência. Os ensaios recalculados são
+    entregues a ao_atualizar(lista_ensaios, substitutos), que decide se
+    ainda valem (ex.: CacheManager.substituir_ensaios).
+
+    Se um espelhamento já estiver rodando, o pedido fica na fila e é
+    executado em seguida; pedidos mais antigos ainda na fila são descartados
+    (só o snapshot mais novo interessa).
+    """
+    if not _STORE_CURVAS:
+        return
+
+    with _ESPELHO_LOCK:
+        _ESPELHO_ESTADO['pendente'] = (lista_ensaios, ao_atualizar)
+        if _ESPELHO_ESTADO['rodando']:
+            return
+        _ESPELHO_ESTADO['rodando'] = True
+
+    Thread(target=_laco_espelhamento, daemon=True).start()
+
+
+def get_stats_curvas():
+    stats = _CACHE_CURVAS.get_stats()
+    stats['referencias'] = len(_REFERENCIAS)
+    if _STORE_CURVAS:
+        stats['espelho'] = _STORE_CURVAS.get_stats()
+    return stats
+
+
+# --- REDUÇÃO DE PONTOS (LTTB) ---
+
+# Pontos por curva enviados ao gráfico quando o cliente não informa 'max_points'
+MAX_PONTOS_PADRAO = 500
+
+# Acréscimo de torque sobre o ML que define o ts2
+DELTA_TS2 = 2.0
+
+
+def indices_caracteristicos(tempo, torque):
+    """
+    Índices que não podem sumir na redução: extremos da curva, ML (torque
+    mínimo), MH (torque máximo) e os primeiros pontos após o ML que cruzam
+    ML + 2 (ts2) e ML + 90% de (MH - ML) (t90).
+    """
+    n = len(torque)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+
+    i_min = int(np.argmin(torque))
+    i_max = int(np.argmax(torque))
+    ml = torque[i_min]
+    mh = torque[i_max]
+
+    indices = [0, n - 1, i_min, i_max]
+    apos_ml = torque[i_min:]
+    for limiar in (ml + DELTA_TS2, ml + 0.9 * (mh - ml)):
+        cruzou = np.flatnonzero(apos_ml >= limiar)
+        if len(cruzou):
+            pos = i_min + int(cruzou[0])
+            indices.append(pos)
+            if pos > 0:
+                indices.append(pos - 1) # ponto anterior permite interpolar o cruzamento
+    return np.unique(np.asarray(indices, dtype=np.int64))
+
+
+def _escolher_por_bucket(x, y, idx, valido, a_x, a_y, c_x, c_y):
+    px = x[idx]
+    py = y[idx]
+    area = np.abs(
+        (a_x - c_x)[:, None] * (py - a_y[:, None])
+        - (a_x[:, None] - px) * (c_y - a_y)[:, None]
+    )
+    area[~valido] = -1
+    return idx[np.arange(len(idx)), area.argmax(axis=1)]
+
+
+def lttb_indices(x, y, n_saida):
+    """
+    Largest-Triangle-Three-Buckets vetorizado: retorna os índices dos
+    n_saida pontos que melhor preservam o formato da curva.
+
+    O LTTB clássico escolhe bucket a bucket usando o ponto selecionado no
+    bucket anterior como âncora. Aqui todos os buckets são resolvidos de uma
+    vez em duas passadas: a primeira usa a média do bucket anterior como
+    âncora e a segunda refina com os pontos escolhidos na primeira.
+    """
+    n = len(x)
+    if n_saida >= n or n_saida < 3:
+        return np.arange(n)
+
+    # Buckets sobre os pontos internos (o primeiro e o último são sempre mantidos)
+    bordas = np.linspace(1, n - 1, n_saida - 1).astype(np.int64)
+    inicios = bordas[:-1]
+    fins = bordas[1:]
+    tamanhos = fins - inicios
+
+    largura = int(tamanhos.max())
+    idx = inicios[:, None] + np.arange(largura)[None, :]
+    valido = idx < fins[:, None]
+    idx = np.where(valido, idx, fins[:, None] - 1)
+
+    soma_x = np.concatenate(([0.0], np.cumsum(x)))
+    soma_y = np.concatenate(([0.0], np.cumsum(y)))
+    media_x = (soma_x[fins] - soma_x[inicios]) / tamanhos
+    media_y = (soma_y[fins] - soma_y[inicios]) / tamanhos
+
+    # Terceiro vértice: média do próximo bucket (ou o último ponto)
+    c_x = np.append(media_x[1:], x[-1])
+    c_y = np.append(media_y[1:], y[-1])
+
+    a_x = np.insert(media_x[:-1], 0, x[0])
+    a_y = np.insert(media_y[:-1], 0, y[0])
+    escolhidos = _escolher_por_bucket(x, y, idx, valido, a_x, a_y, c_x, c_y)
+
+    a_x = np.insert(x[escolhidos[:-1]], 0, x[0])
+    a_y = np.insert(y[escolhidos[:-1]], 0, y[0])
+    escolhidos = _escolher_por_bucket(x, y, idx, valido, a_x, a_y, c_x, c_y)
+
+    return np.concatenate(([0], escolhidos, [n - 1]))
+
+
+def reduzir_curva(tempo, torque, max_pontos=MAX_PONTOS_PADRAO):
+    """
+    Reduz a curva para aproximadamente 'max_pontos' pontos com LTTB,
+    mantendo sempre os pontos característicos (ML, MH, ts2, t90).
+    max_pontos <= 0 devolve a curva original.
+    """
+    n = len(tempo)
+    if max_pontos <= 0 or n <= max_pontos:
+        return tempo, torque
+
+    fixos = indices_caracteristicos(tempo, torque)
+    orcamento = max(3, max_pontos - len(fixos))
+    indices = np.union1d(lttb_indices(tempo, torque, orcamento), fixos)
+    return tempo[indices], torque[indices]
+
+
+# --- FORMATO BINÁRIO COMPACTO ---
+
+# Layout: [uint32 LE tamanho do cabeçalho][cabeçalho JSON UTF-8, com espaços até
+# alinhar em 4 bytes][float32 LE: para cada série, n tempos seguidos de n torques].
+# Cada série do cabeçalho traz 'n' e 'offset' (em floats, a partir do início dos dados).
+MIME_CURVAS_BINARIO = 'application/octet-stream'
+
+
+def empacotar_series_binario(grupos):
+    """
+    Serializa {'reometria': [serie, ...], 'viscosidade': [...]} no formato
+    binário acima. Cada série é um dict com 'tempo' e 'torque' (arrays) e
+    demais chaves (label, tempType...) que vão para o cabeçalho.
+    """
+    cabecalho = {}
+    blocos = []
+    offset = 0
+    for nome_grupo, series in grupos.items():
+        cabecalho[nome_grupo] = []
+        for serie in series:
+            n = len(serie['tempo'])
+            meta = {k: v for k, v in serie.items() if k not in ('tempo', 'torque')}
+            meta.update({'n': n, 'offset': offset})
+            cabecalho[nome_grupo].append(meta)
+            blocos.append(np.asarray(serie['tempo'], dtype='<f4'))
+            blocos.append(np.asarray(serie['torque'], dtype='<f4'))
+            offset += 2 * n
+
+    texto = json.dumps(cabecalho, ensure_ascii=False).encode('utf-8')
+    texto += b' ' * (-(4 + len(texto)) % 4)
+
+    dados = np.concatenate(blocos).tobytes() if blocos else b''
+    return struct.pack('<I', len(texto)) + texto + dados
@@ -0,0 +1,237 @@
+import os
+import sqlite3
+from datetime import datetime
+from threading import Lock
+
+import numpy as np
+
+from services.curve_features import PARAMETROS_CURVA
+
+# Diretório padrão do espelho local de dbo.ENSAIO_VALORES
+DIRETORIO_PADRAO = os.getenv("CURVAS_STORE_DIR", os.path.join('instance', 'curvas'))
+
+_DTYPE = np.float32
+_BYTES_PONTO = np.dtype(_DTYPE).itemsize
+
+
+class CurveStore:
+    """
+    Espelho local e colunar das curvas de ensaio.
+
+    Os pontos ficam em dois arquivos append-only de float32 (tempo.f32 e
+    torque.f32), lidos via np.memmap; um índice SQLite guarda, por
+    COD_ENSAIO, o offset/quantidade de pontos e os metadados do ensaio.
+    A leitura devolve fatias do memmap, sem cópia.
+    """
+
+    def __init__(self, diretorio=DIRETORIO_PADRAO):
+        self.diretorio = diretorio
+        os.makedirs(diretorio, exist_ok=True)
+        self.caminho_tempo = os.path.join(diretorio, 'tempo.f32')
+        self.caminho_torque = os.path.join(diretorio, 'torque.f32')
+        self.caminho_indice = os.path.join(diretorio, 'indice.db')
+
+        self.lock = Lock()
+        self._mapas = None # (pontos_mapeados, memmap_tempo, memmap_torque)
+
+        conn = self._conectar()
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS curvas (
+                cod_ensaio INTEGER PRIMARY KEY,
+                offset_ponto INTEGER NOT NULL,
+                n_pontos INTEGER NOT NULL,
+                temp_plato REAL,
+                cod_grupo INTEGER,
+                data TEXT
+            )
+        """)
+        colunas = ', '.join(f"{nome} REAL" for nome in PARAMETROS_CURVA)
+        conn.execute(f"CREATE TABLE IF NOT EXISTS caracteristicas (cod_ensaio INTEGER PRIMARY KEY, {colunas})")
+        conn.commit()
+        conn.close()
+
+    def _conectar(self):
+        return sqlite3.connect(self.caminho_indice, timeout=30)
+
+    def _total_pontos(self):
+        if not os.path.exists(self.caminho_tempo):
+            return 0
+        return os.path.getsize(self.caminho_tempo) // _BYTES_PONTO
+
+    def _mapear(self, pontos_necessarios):
+        # Chamado com o lock adquirido. Remapeia quando o arquivo cresceu.
+        if self._mapas and self._mapas[0] >= pontos_necessarios:
+            return self._mapas
+        total = self._total_pontos()
+        if total == 0:
+            return None
+        tempo = np.memmap(self.caminho_tempo, dtype=_DTYPE, mode='r', shape=(total,))
+        torque = np.memmap(self.caminho_torque, dtype=_DTYPE, mode='r', shape=(total,))
+        self._mapas = (total, tempo, torque)
+        return self._mapas
+
+    def ids_existentes(self, ids):
+        """Subconjunto de 'ids' que já está espelhado."""
+        ids = [int(i) for i in ids]
+        existentes = set()
+        conn = self._conectar()
+        try:
+            for i in range(0, len(ids), 900):
+                parte = ids[i:i + 900]
+                placeholders = ','.join('?' * len(parte))
+                rows = conn.execute(
+                    f"SELECT cod_ensaio FROM curvas WHERE cod_ensaio IN ({placeholders})", parte
+                ).fetchall()
+                existentes.update(r[0] for r in rows)
+        finally:
+            conn.close()
+        return existentes
+
+    def ler(self, ids):
+        """Retorna ({id: curva} encontrados, [ids faltantes])."""
+        ids = [int(i) for i in ids]
+        conn = self._conectar()
+        try:
+            indice = {}
+            for i in range(0, len(ids), 900):
+                parte = ids[i:i + 900]
+                placeholders = ','.join('?' * len(parte))
+                rows = conn.execute(
+                    f"""SELECT cod_ensaio, offset_ponto, n_pontos, temp_plato, cod_grupo, data
+                        FROM curvas WHERE cod_ensaio IN ({placeholders})""", parte
+                ).fetchall()
+                for r in rows:
+                    indice[r[0]] = r
+        finally:
+            conn.close()
+
+        encontrados = {}
+        if indice:
+            fim_max = max(r[1] + r[2] for r in indice.values())
+            with self.lock:
+                mapas = self._mapear(fim_max)
+            if mapas:
+                _, tempo, torque = mapas
+                for c_id, (_, offset, n, temp_plato, cod_grupo, data) in indice.items():
+                    encontrados[c_id] = {
+                        'tempo': tempo[offset:offset + n],
+                        'torque': torque[offset:offset + n],
+                        'temp_plato': temp_plato or 0,
+                        'cod_grupo': cod_grupo,
+                        'data': datetime.fromisoformat(data) if data else None
+                    }
+
+        faltantes = [i for i in ids if i not in encontrados]
+        return encontrados, faltantes
+
+    def gravar(self, curvas):
+        """Acrescenta ao espelho as curvas ainda não gravadas. Retorna quantas entraram."""
+        if not curvas:
+            return 0
+
+        with self.lock:
+            novos = {c_id: c for c_id, c in curvas.items() if len(c['tempo'])}
+            ja_existem = self.ids_existentes(novos.keys())
+            novos = {c_id: c for c_id, c in novos.items() if c_id not in ja_existem}
+            if not novos:
+                return 0
+
+            offset = self._total_pontos()
+            registros = []
+            blocos_tempo = []
+            blocos_torque = []
+            for c_id, curva in novos.items():
+                n = len(curva['tempo'])
+                data = curva.get('data')
+                registros.append((
+                    int(c_id), offset, n,
+                    float(curva.get('temp_plato') or 0),
+                    curva.get('cod_grupo'),
+                    data.isoformat() if hasattr(data, 'isoformat') else None
+                ))
+                blocos_tempo.append(np.asarray(curva['tempo'], dtype=_DTYPE))
+                blocos_torque.append(np.asarray(curva['torque'], dtype=_DTYPE))
+                offset += n
+
+            # Dados primeiro, índice depois: uma falha no meio só deixa bytes órfãos
+            with open(self.caminho_tempo, 'ab') as f:
+                np.concatenate(blocos_tempo).tofile(f)
+            with open(self.caminho_torque, 'ab') as f:
+                np.concatenate(blocos_torque).tofile(f)
+
+            conn = self._conectar()
+            try:
+                conn.executemany("INSERT OR IGNORE INTO curvas VALUES (?, ?, ?, ?, ?, ?)", registros)
+                conn.commit()
+            finally:
+                conn.close()
+
+        return len(registros)
+
+    def ids_sem_caracteristicas(self, limite):
+        """Até 'limite' curvas espelhadas que ainda não tiveram as características extraídas."""
+        conn = self._conectar()
+        try:
+            rows = conn.execute("""
+                SELECT c.cod_ensaio FROM curvas c
+                LEFT JOIN caracteristicas f ON f.cod_ensaio = c.cod_ensaio
+                WHERE f.cod_ensaio IS NULL
+                ORDER BY c.cod_ensaio DESC
+                LIMIT ?
+            """, (limite,)).fetchall()
+        finally:
+            conn.close()
+        return [r[0] for r in rows]
+
+    def gravar_caracteristicas(self, caracteristicas):
+        """Grava {COD_ENSAIO: {nome: valor}} (substitui valores anteriores)."""
+        if not caracteristicas:
+            return 0
+        registros = [
+            (int(c_id), *(valores.get(nome) for nome in PARAMETROS_CURVA))
+            for c_id, valores in caracteristicas.items()
+        ]
+        placeholders = ', '.join('?' * (len(PARAMETROS_CURVA) + 1))
+        conn = self._conectar()
+        try:
+            conn.executemany(f"INSERT OR REPLACE INTO caracteristicas VALUES ({placeholders})", registros)
+            conn.commit()
+        finally:
+            conn.close()
+        return len(registros)
+
+    def ler_caracteristicas(self, ids):
+        """Retorna {COD_ENSAIO: {'temp_plato': t, 'valores': {nome: valor}}} dos ids que já têm características."""
+        ids = [int(i) for i in ids]
+        colunas = ', '.join(f"f.{nome}" for nome in PARAMETROS_CURVA)
+        saida = {}
+        conn = self._conectar()
+        try:
+            for i in range(0, len(ids), 900):
+                parte = ids[i:i + 900]
+                placeholders = ','.join('?' * len(parte))
+                rows = conn.execute(
+                    f"""SELECT f.cod_ensaio, c.temp_plato, {colunas}
+                        FROM caracteristicas f JOIN curvas c ON c.cod_ensaio = f.cod_ensaio
+                        WHERE f.cod_ensaio IN ({placeholders})""", parte
+                ).fetchall()
+                for r in rows:
+                    saida[r[0]] = {'temp_plato': r[1], 'valores': dict(zip(PARAMETROS_CURVA, r[2:]))}
+        finally:
+            conn.close()
+        return saida
+
+    def get_stats(self):
+        conn = self._conectar()
+        try:
+            total_curvas = conn.execute("SELECT COUNT(*) FROM curvas").fetchone()[0]
+            total_caracteristicas = conn.execute("SELECT COUNT(*) FROM caracteristicas").fetchone()[0]
+        finally:
+            conn.close()
+        total_pontos = self._total_pontos()
+        return {
+            'curvas': total_curvas,
+            'caracteristicas': total_caracteristicas,
+            'pontos': total_pontos,
+            'tamanho_mb': round(total_pontos * _BYTES_PONTO * 2 / (1024 * 1024), 2)
+        }
@@ -3,7 +3,8 @@ import re
 import json
 import os
 import pandas as pd
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from difflib import get_close_matches
 
 # Importação dos modelos e serviços existentes
@@ -13,6 +14,8 @@ from etl_planilha import carregar_dicionario_lotes
 from services.sankhya_service import importar_catalogo_sankhya
 from services.config_manager import aplicar_configuracoes_no_catalogo
 from services.learning_service import carregar_aprendizado  # <--- NOVA IMPORTAÇÃO
+from services.curve_features import aplicar_caracteristicas
+from services.curve_service import ler_caracteristicas_curvas
 
 # --- VARIÁVEIS DE REFERÊNCIA (CACHE DO MÓDULO) ---
 _CATALOGO_CODIGO = {}
@@ -156,37 +159,228 @@ def classificar_tipo_ensaio(ensaio, temp_plato):
     return "ALTA"
 
 
-# --- LÓGICA PRINCIPAL ---
+# --- EXTRAÇÃO (SQL SERVER) ---
 
-def processar_carga_dados(data_corte='2025-07-01'):
-    if not _CATALOGO_CODIGO:
-        carregar_referencias_estaticas()
+# Pushdown: o SQL Server já devolve uma linha por grupo bruto em vez de uma por ensaio.
+# Requer SQL Server 2017+ (STRING_AGG ... WITHIN GROUP); em versões anteriores, deixe 0.
+ETL_PUSHDOWN = os.getenv("ETL_PUSHDOWN", "0") == "1"
 
-    print(f"--- 🚀 ETL PROCESSOR: Iniciando carga SQL... ---")
-    start_time = datetime.now()
-    
-    conn = None
-    try:
-        conn = connect_to_database()
-        cursor = conn.cursor()
-        query = '''
+# A extração é dividida em partições de N meses, lidas em paralelo (conexões do pool).
+# Partições que terminaram há mais de ETL_PARTICAO_FECHADA_DIAS ficam em memória; a
+# cada carga uma consulta barata (COUNT + CHECKSUM_AGG) confere se mudaram no banco
+# (ensaio corrigido/apagado depois) e, de qualquer forma, são relidas após
+# ETL_PARTICAO_TTL_HORAS. As partições abertas são sempre relidas.
+ETL_PARTICAO_MESES = max(1, int(os.getenv("ETL_PARTICAO_MESES", "1")))
+ETL_PARALELISMO = max(1, int(os.getenv("ETL_PARALELISMO", "3")))
+ETL_PARTICAO_FECHADA_DIAS = int(os.getenv("ETL_PARTICAO_FECHADA_DIAS", "3"))
+ETL_PARTICAO_TTL = timedelta(hours=float(os.getenv("ETL_PARTICAO_TTL_HORAS", "24")))
+_FIM_ABERTO = datetime(9999, 12, 31)
+_CACHE_PARTICOES = {} # {(inicio, fim, pushdown): {'linhas', 'impressao', 'lida_em'}}
+
+_QUERY_IMPRESSAO_PARTICAO = '''
+        SELECT COUNT(*), CHECKSUM_AGG(BINARY_CHECKSUM(*))
+        FROM dbo.ENSAIO
+        WHERE DATA >= ? AND DATA < ?
+'''
+
+_QUERY_ENSAIOS = '''
         SELECT 
             COD_ENSAIO, NUMERO_LOTE, BATCH, DATA, 
             T2TEMPO as Ts2, T90TEMPO as T90, VISCOSIDADEFINALTORQUE as Viscosidade, 
             TEMP_PLATO_INF, COD_GRUPO, MAXIMO_TEMPO,
             CODIGO as CODIGO_REO, AMOSTRA
         FROM dbo.ENSAIO 
-        WHERE DATA >= ?
-        ORDER BY DATA DESC
-        '''
-        cursor.execute(query, (data_corte,))
+        WHERE DATA >= ? AND DATA < ?
+'''
+
+# Valores "com data" vêm empacotados como 'yyyy-mm-dd hh:mi:ss.mmm|valor' (estilo 121 ordena como texto),
+# o que permite pegar o mais antigo/mais novo com MIN/MAX dentro do GROUP BY.
+# As entradas do STRING_AGG são VARCHAR(MAX): com VARCHAR(n) o resultado é limitado
+# a 8000 bytes e grupos grandes fariam a consulta falhar (erro 9829).
+# Todas as listas saem ordenadas por DATA DESC, como no caminho sem pushdown: temps[0]
+# (temp_plato e tipo do ensaio) não pode depender da ordem em que o servidor agrega.
+_QUERY_ENSAIOS_AGRUPADOS = '''
+        SELECT
+            NUMERO_LOTE, AMOSTRA, BATCH, COD_GRUPO, CODIGO as CODIGO_REO,
+            MAX(DATA) as DATA,
+            COUNT(*) as N_LINHAS,
+            STRING_AGG(CAST(COD_ENSAIO AS VARCHAR(MAX)), ',') WITHIN GROUP (ORDER BY DATA DESC) as IDS,
+            MIN(CASE WHEN T2TEMPO <> 0 THEN CONVERT(CHAR(23), DATA, 121) + '|' + CONVERT(VARCHAR(40), CAST(T2TEMPO AS FLOAT), 3) END) as Ts2,
+            MIN(CASE WHEN T90TEMPO <> 0 THEN CONVERT(CHAR(23), DATA, 121) + '|' + CONVERT(VARCHAR(40), CAST(T90TEMPO AS FLOAT), 3) END) as T90,
+            MIN(CASE WHEN VISCOSIDADEFINALTORQUE <> 0 THEN CONVERT(CHAR(23), DATA, 121) + '|' + CONVERT(VARCHAR(40), CAST(VISCOSIDADEFINALTORQUE AS FLOAT), 3) END) as Viscosidade,
+            MAX(CASE WHEN MAXIMO_TEMPO <> 0 THEN CONVERT(CHAR(23), DATA, 121) + '|' + CONVERT(VARCHAR(40), CAST(MAXIMO_TEMPO AS FLOAT), 3) END) as MAXIMO_TEMPO,
+            STRING_AGG(CONVERT(VARCHAR(MAX), CAST(NULLIF(TEMP_PLATO_INF, 0) AS FLOAT), 3), ',') WITHIN GROUP (ORDER BY DATA DESC) as TEMPS,
+            STRING_AGG(CONVERT(VARCHAR(MAX), CAST(NULLIF(MAXIMO_TEMPO, 0) AS FLOAT), 3), ',') WITHIN GROUP (ORDER BY DATA DESC) as TEMPOS_MAX
+        FROM dbo.ENSAIO
+        WHERE DATA >= ? AND DATA < ?
+        GROUP BY NUMERO_LOTE, AMOSTRA, BATCH, COD_GRUPO, CODIGO, YEAR(DATA)
+'''
+
+def _distintos(valores):
+    saida = []
+    for v in valores:
+        if v and v not in saida: saida.append(v)
+    return saida
+
+def _linha_bruta(row):
+    """Uma linha de dbo.ENSAIO vira um 'grupo de um ensaio' no formato comum."""
+    data = row['DATA']
+    com_data = lambda v: (data, v) if v else None
+    v_max = safe_float(row['MAXIMO_TEMPO'])
+    row['ids'] = [row['COD_ENSAIO']]
+    row['n_linhas'] = 1
+    row['valores'] = {
+        'ts2': com_data(safe_float(row['Ts2'])),
+        't90': com_data(safe_float(row['T90'])),
+        'visc': com_data(safe_float(row['Viscosidade'])),
+        'temps': _distintos([safe_float(row['TEMP_PLATO_INF'])]),
+        'tempo_max': com_data(v_max),
+        'tempos_max': _distintos([v_max])
+    }
+    return row
+
+def _linha_agrupada(row):
+    """Linha da consulta agrupada (pushdown) no formato comum."""
+    def desempacotar(texto):
+        if not texto: return None
+        data, valor = texto.split('|', 1)
+        v = safe_float(valor)
+        return (data, v) if v else None
+
+    def lista(texto):
+        return _distintos(safe_float(v) for v in texto.split(',')) if texto else []
+
+    row['ids'] = [int(i) for i in row['IDS'].split(',')]
+    row['n_linhas'] = row['N_LINHAS']
+    row['valores'] = {
+        'ts2': desempacotar(row['Ts2']),
+        't90': desempacotar(row['T90']),
+        'visc': desempacotar(row['Viscosidade']),
+        'temps': lista(row['TEMPS']),
+        'tempo_max': desempacotar(row['MAXIMO_TEMPO']),
+        'tempos_max': lista(row['TEMPOS_MAX'])
+    }
+    return row
+
+def _particoes(data_corte, agora):
+    """Intervalos [inicio, fim) de ETL_PARTICAO_MESES meses, do mais novo para o mais antigo."""
+    inicio = datetime.strptime(str(data_corte)[:10], '%Y-%m-%d')
+    particoes = []
+    while inicio <= agora:
+        mes = inicio.month - 1 + ETL_PARTICAO_MESES
+        fim = datetime(inicio.year + mes // 12, mes % 12 + 1, 1)
+        particoes.append((inicio, fim if fim <= agora else _FIM_ABERTO))
+        inicio = fim
+    return particoes[::-1]
+
+def _impressao_particao(cursor, inicio, fim):
+    """(quantidade, checksum) das linhas de dbo.ENSAIO em [inicio, fim)."""
+    cursor.execute(_QUERY_IMPRESSAO_PARTICAO, (inicio, fim))
+    return tuple(cursor.fetchone())
+
+def _extrair_particao(inicio, fim, pushdown):
+    """Linhas da partição e a impressão digital lida na mesma conexão."""
+    query = _QUERY_ENSAIOS_AGRUPADOS if pushdown else _QUERY_ENSAIOS
+    normalizar = _linha_agrupada if pushdown else _linha_bruta
+
+    conn = None
+    try:
+        conn = connect_to_database()
+        cursor = conn.cursor()
+        impressao = _impressao_particao(cursor, inicio, fim)
+        cursor.execute(query, (inicio, fim))
         colunas = [c[0] for c in cursor.description]
-        resultados_brutos = [dict(zip(colunas, row)) for row in cursor.fetchall()]
+        linhas = [normalizar(dict(zip(colunas, row))) for row in cursor.fetchall()]
+    finally:
+        if conn: conn.close()
+
+    # Ordenação no Python (a do servidor não ajudava em nada): mais recente primeiro
+    linhas.sort(key=lambda r: r['DATA'], reverse=True)
+    return linhas, impressao
+
+def _particoes_validas(candidatas, agora):
+    """
+    Das partições em cache, as que podem ser reaproveitadas: dentro do TTL e
+    com a mesma impressão digital no banco. As demais saem do cache.
+    """
+    validas = {}
+    conn = None
+    try:
+        conn = connect_to_database()
+        cursor = conn.cursor()
+        for chave, entrada in candidatas.items():
+            if agora - entrada['lida_em'] <= ETL_PARTICAO_TTL \
+                    and _impressao_particao(cursor, chave[0], chave[1]) == entrada['impressao']:
+                validas[chave] = entrada['linhas']
+            else:
+                _CACHE_PARTICOES.pop(chave, None)
     except Exception as e:
-        print(f"❌ Erro Crítico no SQL: {e}")
-        return None
+        print(f"⚠️ Não foi possível validar as partições em cache ({e}); relendo todas.")
+        return {}
     finally:
         if conn: conn.close()
+    return validas
+
+def invalidar_particoes():
+    """Descarta as partições em cache: a próxima carga relê tudo do banco."""
+    _CACHE_PARTICOES.clear()
+
+def _extrair_ensaios(data_corte, pushdown):
+    """
+    Lê dbo.ENSAIO a partir de 'data_corte' e devolve linhas no formato
+    comum (ids, n_linhas, valores), do grupo mais recente para o mais antigo.
+    """
+    agora = datetime.now()
+    limite_fechada = agora - timedelta(days=ETL_PARTICAO_FECHADA_DIAS)
+    particoes = _particoes(data_corte, agora)
+
+    em_cache = {
+        (inicio, fim, pushdown): _CACHE_PARTICOES[(inicio, fim, pushdown)]
+        for inicio, fim in particoes if (inicio, fim, pushdown) in _CACHE_PARTICOES
+    }
+    validas = _particoes_validas(em_cache, agora) if em_cache else {}
+
+    resultados = {}
+    pendentes = []
+    for inicio, fim in particoes:
+        linhas = validas.get((inicio, fim, pushdown))
+        if linhas is None:
+            pendentes.append((inicio, fim))
+        else:
+            resultados[(inicio, fim)] = linhas
+
+    with ThreadPoolExecutor(max_workers=ETL_PARALELISMO) as executor:
+        futuros = {p: executor.submit(_extrair_particao, p[0], p[1], pushdown) for p in pendentes}
+        for (inicio, fim), futuro in futuros.items():
+            linhas, impressao = futuro.result()
+            resultados[(inicio, fim)] = linhas
+            if fim <= limite_fechada:
+                _CACHE_PARTICOES[(inicio, fim, pushdown)] = {
+                    'linhas': linhas, 'impressao': impressao, 'lida_em': agora
+                }
+
+    print(f"   > {len(particoes)} partições de {ETL_PARTICAO_MESES} mês(es): "
+          f"{len(pendentes)} consultadas, {len(particoes) - len(pendentes)} em cache.")
+    return [linha for p in particoes for linha in resultados[p]]
+
+
+# --- LÓGICA PRINCIPAL ---
+
+def processar_carga_dados(data_corte='2025-07-01', pushdown=None):
+    if not _CATALOGO_CODIGO:
+        carregar_referencias_estaticas()
+
+    if pushdown is None:
+        pushdown = ETL_PUSHDOWN
+
+    print(f"--- 🚀 ETL PROCESSOR: Iniciando carga SQL{' (agrupada no servidor)' if pushdown else ''}... ---")
+    start_time = datetime.now()
+    
+    try:
+        resultados_brutos = _extrair_ensaios(data_corte, pushdown)
+    except Exception as e:
+        print(f"❌ Erro Crítico no SQL: {e}")
+        return None
 
     dados_agrupados = {} 
     
@@ -302,24 +496,28 @@ def processar_carga_dados(data_corte='2025-07-01'):
         if reg['metodo_id'] == "FANTASMA" and metodo_id != "FANTASMA":
             reg['metodo_id'] = metodo_id
             
-        reg['ids_ensaio'].append(row['COD_ENSAIO'])
+        reg['ids_ensaio'].extend(row['ids'])
         reg['grupos'].add(grupo)
         if not reg['massa'] and produto: reg['massa'] = produto
             
-        v_ts2 = safe_float(row['Ts2'])
-        v_t90 = safe_float(row['T90'])
-        v_visc = safe_float(row['Viscosidade'])
-        v_temp = safe_float(row['TEMP_PLATO_INF'])
-        v_max = safe_float(row['MAXIMO_TEMPO'])
-        
-        if v_ts2: reg['ts2'] = v_ts2
-        if v_t90: reg['t90'] = v_t90
-        if v_visc: reg['visc'] = v_visc
-        if v_temp and v_temp not in reg['temps']: reg['temps'].append(v_temp)
-        if v_max:
-            if not reg['tempo_max']: reg['tempo_max'] = v_max
+        # Valores vêm como (data, valor): Ts2/T90/Visc ficam com a medição mais antiga
+        # (empates: o último processado), o tempo máximo com a mais recente (empates: o primeiro)
+        vals = row['valores']
+        for chave in ('ts2', 't90', 'visc'):
+            if vals[chave] and (reg[chave] is None or vals[chave][0] <= reg[chave][0]):
+                reg[chave] = vals[chave]
+        if vals['tempo_max'] and (reg['tempo_max'] is None or vals['tempo_max'][0] > reg['tempo_max'][0]):
+            reg['tempo_max'] = vals['tempo_max']
+        for v_temp in vals['temps']:
+            if v_temp not in reg['temps']: reg['temps'].append(v_temp)
+        for v_max in vals['tempos_max']:
             if v_max not in reg['tempos_max']: reg['tempos_max'].append(v_max)
 
+    # Descarta as datas usadas no desempate
+    for reg in dados_agrupados.values():
+        for chave in ('ts2', 't90', 'visc', 'tempo_max'):
+            if reg[chave]: reg[chave] = reg[chave][1]
+
     # --- 📊 NOVO BLOCO: CÁLCULO DE MÉDIAS ESTATÍSTICAS POR LOTE ---
     acumuladores = {
         'visc': {},
@@ -352,6 +550,15 @@ def processar_carga_dados(data_corte='2025-07-01'):
 
     # -------------------------------------------------------------
 
+    # Características das curvas (ML, MH, Ts1...) já extraídas no espelho local
+    try:
+        caracteristicas = ler_caracteristicas_curvas(
+            [i for dados in dados_agrupados.values() if dados['massa'] for i in dados['ids_ensaio']]
+        )
+    except Exception as e:
+        print(f"⚠️ Características de curva indisponíveis: {e}")
+        caracteristicas = {}
+
     lista_final = []
     materiais_set = set()
     
@@ -406,6 +613,7 @@ def processar_carga_dados(data_corte='2025-07-01'):
             'Visc': medias_por_lote['visc'].get(lote_atual)
         }
         
+        aplicar_caracteristicas([novo_ensaio], caracteristicas)
         novo_ensaio.calcular_score()
         novo_ensaio.tipo_ensaio = classificar_tipo_ensaio(novo_ensaio, temp_princ)
         
@@ -420,7 +628,7 @@ def processar_carga_dados(data_corte='2025-07-01'):
         'dados': lista_final,
         'materiais': sorted(list(materiais_set), key=lambda m: m.descricao),
         'ultimo_update': datetime.now(),
-        'total_registros_brutos': len(resultados_brutos)
+        'total_registros_brutos': sum(r['n_linhas'] for r in resultados_brutos)
     }
 
 def get_catalogo_codigo():
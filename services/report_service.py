@@ -1,9 +1,16 @@
 from collections import defaultdict
-import statistics
+from threading import Lock
 from datetime import datetime
 
+from services.aggregation_service import agregar_relatorio, estatisticas_vazias
+
+# --- MEMO DA ÁRVORE COMPLETA (POR VERSÃO DO SNAPSHOT) ---
+_ARVORE_MEMO = {'versao': None, 'arvore': []}
+_ARVORE_LOCK = Lock()
+
 def gerar_estrutura_relatorio(lista_ensaios, busca='', ordenar_por='nome', ordem='asc'):
     arvore = {}
+    ensaios_incluidos = []
     
     for ensaio in lista_ensaios:
         nome_massa = ensaio.massa.descricao
@@ -22,7 +29,7 @@ def gerar_estrutura_relatorio(lista_ensaios, busca='', ordenar_por='nome', ordem
                 'kpi': {
                     'total_batches': 0, 'aprovados': 0, 'score_soma': 0, 'score_medio': 0, 'taxa_aprovacao': 0
                 },
-                'stats_raw': {'visc': [], 'alta': {'ts2': [], 't90': []}, 'baixa': {'ts2': [], 't90': []}},
+                'estatisticas': {},
                 'medias_gerais': {}
             }
             
@@ -62,13 +69,10 @@ def gerar_estrutura_relatorio(lista_ensaios, busca='', ordenar_por='nome', ordem
         if "LIBERAR" in ensaio.acao_recomendada:
             massa_node['kpi']['aprovados'] += 1
 
-        # Coleta de Stats (igual anterior)
-        vals = ensaio.valores_medidos
-        temp = ensaio.temp_plato or 0
-        contexto = 'alta' if temp >= 175 else 'baixa'
-        if vals.get('Ts2'): massa_node['stats_raw'][contexto]['ts2'].append(vals['Ts2'])
-        if vals.get('T90'): massa_node['stats_raw'][contexto]['t90'].append(vals['T90'])
-        if vals.get('Viscosidade'): massa_node['stats_raw']['visc'].append(vals['Viscosidade'])
+        ensaios_incluidos.append(ensaio)
+
+    # Estatísticas (n, média, mín, máx, desvio) de massas e lotes em uma passada vetorizada
+    estatisticas = agregar_relatorio(ensaios_incluidos)
 
     # Finalização
     lista_final = []
@@ -82,6 +86,7 @@ def gerar_estrutura_relatorio(lista_ensaios, busca='', ordenar_por='nome', ordem
         
         # FINALIZAÇÃO KPIs DOS LOTES (Cálculo de médias individuais)
         for lote in massa_node['lotes'].values():
+            lote['estatisticas'] = estatisticas['lotes'].get((massa_node['nome'], lote['numero']), estatisticas_vazias())
             qtd_lote = lote['kpi_lote']['total']
             if qtd_lote > 0:
                 lote['kpi_lote']['score_medio'] = lote['kpi_lote']['score_soma'] / qtd_lote
@@ -99,24 +104,71 @@ def gerar_estrutura_relatorio(lista_ensaios, busca='', ordenar_por='nome', ordem
             )
         )
 
-        # Médias Gerais Massa (igual anterior)
-        def safe_mean(lista): return statistics.mean(lista) if lista else None
-        raw = massa_node['stats_raw']
+        # Médias Gerais Massa
+        st = estatisticas['massas'].get(massa_node['nome'], estatisticas_vazias())
+        massa_node['estatisticas'] = st
         massa_node['medias_gerais'] = {
-            'visc': safe_mean(raw['visc']),
-            'alta_ts2': safe_mean(raw['alta']['ts2']), 'alta_t90': safe_mean(raw['alta']['t90']),
-            'baixa_ts2': safe_mean(raw['baixa']['ts2']), 'baixa_t90': safe_mean(raw['baixa']['t90']),
-            'qtd_alta': len(raw['alta']['ts2']) + len(raw['alta']['t90']),
-            'qtd_baixa': len(raw['baixa']['ts2']) + len(raw['baixa']['t90'])
+            'visc': st['visc']['media'],
+            'alta_ts2': st['alta']['ts2']['media'], 'alta_t90': st['alta']['t90']['media'],
+            'baixa_ts2': st['baixa']['ts2']['media'], 'baixa_t90': st['baixa']['t90']['media'],
+            'qtd_alta': st['alta']['ts2']['n'] + st['alta']['t90']['n'],
+            'qtd_baixa': st['baixa']['ts2']['n'] + st['baixa']['t90']['n']
         }
         massa_node['qtd_lotes_unicos'] = len(massa_node['lotes'])
         lista_final.append(massa_node)
 
-    # Ordenação (igual anterior)
-    reverse = (ordem == 'desc')
-    if ordenar_por == 'aprovacao': lista_final.sort(key=lambda x: x['kpi']['taxa_aprovacao'], reverse=reverse)
-    elif ordenar_por == 'score': lista_final.sort(key=lambda x: x['kpi']['score_medio'], reverse=reverse)
-    elif ordenar_por == 'cod': lista_final.sort(key=lambda x: x['cod'], reverse=reverse)
-    else: lista_final.sort(key=lambda x: x['nome'], reverse=reverse)
-            
+    _ordenar_massas(lista_final, ordenar_por, ordem)
     return lista_final
+
+
+def _ordenar_massas(lista, ordenar_por='nome', ordem='asc'):
+    reverse = (ordem == 'desc')
+    if ordenar_por == 'aprovacao': lista.sort(key=lambda x: x['kpi']['taxa_aprovacao'], reverse=reverse)
+    elif ordenar_por == 'score': lista.sort(key=lambda x: x['kpi']['score_medio'], reverse=reverse)
+    elif ordenar_por == 'cod': lista.sort(key=lambda x: x['cod'], reverse=reverse)
+    else: lista.sort(key=lambda x: x['nome'], reverse=reverse)
+
+
+# --- ÁRVORE MEMOIZADA E PROJEÇÕES ---
+
+def obter_arvore_relatorio(dados_cache):
+    """
+    Retorna a árvore completa (massa -> lote -> batch) do snapshot atual.
+    A árvore só é reconstruída quando a 'versao' do cache muda; as rotas
+    devem tratá-la como somente leitura e usar as projeções abaixo.
+    """
+    versao = dados_cache.get('versao')
+    with _ARVORE_LOCK:
+        if versao is None or _ARVORE_MEMO['versao'] != versao:
+            _ARVORE_MEMO['arvore'] = gerar_estrutura_relatorio(dados_cache['dados'])
+            _ARVORE_MEMO['versao'] = versao
+        return _ARVORE_MEMO['arvore']
+
+def projetar_relatorio(arvore, busca='', ordenar_por='nome', ordem='asc'):
+    """Filtra e ordena a lista de massas sem tocar nos nós da árvore."""
+    lista = list(arvore)
+    if busca:
+        termo = busca.upper()
+        lista = [m for m in lista if termo in m['nome'].upper() or termo in str(m['cod'])]
+    _ordenar_massas(lista, ordenar_por, ordem)
+    return lista
+
+def obter_no_massa(arvore, cod_sankhya):
+    for massa_node in arvore:
+        if massa_node['cod'] == cod_sankhya:
+            return massa_node
+    return None
+
+def obter_nos_massa(arvore, cod_sankhya):
+    """Todos os nós com o cod_sankhya (a árvore agrupa por descrição, que pode variar)."""
+    return [massa_node for massa_node in arvore if massa_node['cod'] == cod_sankhya]
+
+def obter_no_lote(massa_node, numero_lote):
+    if not massa_node: return None
+    lote_node = massa_node['lotes'].get(numero_lote)
+    if lote_node is None:
+        # Lotes podem ter sido gravados com outro tipo (int vs str)
+        for chave, node in massa_node['lotes'].items():
+            if str(chave) == str(numero_lote):
+                return node
+    return lote_node
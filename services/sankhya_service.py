@@ -3,6 +3,9 @@ from models.dissolucao import Dissolucao
 from models.massa import Massa
 from models.materia_prima import MateriaPrima
 from dotenv import load_dotenv
+from threading import Lock
+from sql_metrics import ConexaoInstrumentada
+import json
 import os
 
 load_dotenv()
@@ -13,69 +16,180 @@ DB_USER = os.getenv("ORACLE_DB_USER")
 DB_PASSWORD = os.getenv("ORACLE_DB_PASSWORD")
 DB_DSN = os.getenv("ORACLE_DB_DSN")
 
+# Modo thick (Instant Client) por padrao quando ORACLE_LIB_DIR esta definido; senao thin.
+# ORACLE_THICK=1/0 forca um dos modos.
+MODO_THICK = os.getenv("ORACLE_THICK", "1" if LIB_DIR else "0") == "1"
+
+# Sessoes simultaneas no pool
+POOL_MAX = int(os.getenv("ORACLE_POOL_MAX", "4"))
+# Linhas trazidas por round-trip na leitura do catalogo (TGFPRO tem alguns milhares de produtos)
+ARRAYSIZE_CATALOGO = int(os.getenv("ORACLE_ARRAYSIZE", "2000"))
+
+_POOL = None
+_POOL_LOCK = Lock()
+
+def _obter_pool():
+    """Cria o pool de sessoes (e inicializa o client thick, se configurado) uma unica vez."""
+    global _POOL
+    if _POOL is None:
+        with _POOL_LOCK:
+            if _POOL is None:
+                if MODO_THICK:
+                    oracledb.init_oracle_client(lib_dir=LIB_DIR or None)
+                _POOL = oracledb.create_pool(
+                    user=DB_USER, password=DB_PASSWORD, dsn=DB_DSN,
+                    min=1, max=POOL_MAX, increment=1
+                )
+                modo = "thin" if oracledb.is_thin_mode() else "thick"
+                print(f"Pool Sankhya criado ({modo}, max {POOL_MAX} sessoes)")
+    return _POOL
+
 def get_connection():
+    """Sessao emprestada do pool; close() a devolve."""
+    return ConexaoInstrumentada(_obter_pool().acquire(), 'oracle')
+
+def get_stats_pool_sankhya():
+    if _POOL is None:
+        return {'status': 'nao_criado'}
+    return {'abertas': _POOL.opened, 'em_uso': _POOL.busy, 'max': _POOL.max,
+            'modo': 'thin' if oracledb.is_thin_mode() else 'thick'}
+
+# Filtro dos produtos importados (mesmo para a carga completa e para a impressao digital)
+_FILTRO_CATALOGO = """
+    FROM SANKHYA.TGFPRO PRO
+    WHERE PRO.ATIVO = 'S'
+      AND (PRO.CODGRUPOPROD BETWEEN 10000000 AND 18999999)
+      AND (
+            PRO.CODGRUPOPROD BETWEEN 16010100 AND 16011200
+         OR PRO.CODGRUPOPROD BETWEEN 18010100 AND 18010700
+         OR PRO.CODGRUPOPROD = 18010900
+         OR PRO.CODGRUPOPROD = 18010800
+      )
+"""
+
+# Copia local do catalogo: {'impressao': [...], 'produtos': [[cod, desc, grupo], ...]}
+CATALOGO_CACHE_FILE = os.getenv("CATALOGO_CACHE_FILE", os.path.join("instance", "catalogo_sankhya.json"))
+
+# Ultimas linhas do catalogo lidas nesta execucao: (impressao, [[cod, desc, grupo], ...])
+_CATALOGO_MEMORIA = None
+
+def _criar_produto(cod, desc, grupo):
+    # Classificacao por grupo Sankhya; apenas MateriaPrima, Massa e Dissolucao sao importados
+    if grupo == 18010800:
+        return Dissolucao(cod, desc)
+    if 18010100 <= grupo <= 18010700 or grupo == 18010900:
+        return Massa(cod, desc)
+    if 16010100 <= grupo <= 16011200:
+        return MateriaPrima(cod, desc)
+    return None
+
+def _montar_catalogo(linhas):
+    """
+    Monta os dicionarios a partir de [(cod, desc, grupo)]. Os objetos sao
+    sempre novos: specs aplicadas e correcoes locais (ex.: descricao) gravadas
+    nos objetos de uma carga nao passam para a seguinte nem alteram os
+    ensaios do snapshot que ainda esta no ar.
+    """
+    catalogo_cod = {}
+    catalogo_nome = {}
+    for cod, desc, grupo in linhas:
+        obj = _criar_produto(cod, desc, grupo)
+        if obj is None:
+            continue
+        catalogo_cod[cod] = obj
+        catalogo_nome[desc.upper()] = obj
+    return catalogo_cod, catalogo_nome
+
+def _impressao_digital(cursor):
+    """Quantidade de produtos + soma de hashes de CODPROD/DESCRPROD/CODGRUPOPROD (consulta barata)."""
+    cursor.execute(f"""
+    SELECT COUNT(*), SUM(ORA_HASH(PRO.CODPROD || '|' || TRIM(PRO.DESCRPROD) || '|' || PRO.CODGRUPOPROD))
+    {_FILTRO_CATALOGO}
+    """)
+    quantidade, soma = cursor.fetchone()
+    return [int(quantidade or 0), int(soma or 0)]
+
+def _ler_cache_disco():
     try:
-        oracledb.init_oracle_client(lib_dir=LIB_DIR)
-    except:
-        pass
-    return oracledb.connect(user=DB_USER, password=DB_PASSWORD, dsn=DB_DSN)
+        with open(CATALOGO_CACHE_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(f"Cache local do catalogo ignorado: {e}")
+        return None
+
+def _gravar_cache_disco(impressao, linhas):
+    try:
+        os.makedirs(os.path.dirname(CATALOGO_CACHE_FILE) or '.', exist_ok=True)
+        temporario = CATALOGO_CACHE_FILE + '.tmp'
+        with open(temporario, 'w', encoding='utf-8') as f:
+            json.dump({'impressao': impressao, 'produtos': linhas}, f)
+        os.replace(temporario, CATALOGO_CACHE_FILE)
+    except Exception as e:
+        print(f"Nao foi possivel gravar o cache do catalogo: {e}")
 
 def importar_catalogo_sankhya():
     """
     Retorna dois dicionarios:
     1. catalogo_cod: { 26791: ObjetoProduto }
     2. catalogo_nome: { "CAMELBACK STD": ObjetoProduto }
+
+    Antes da carga completa compara a impressao digital do catalogo com a da
+    copia local; se nada mudou, reaproveita as linhas ja em memoria (ou a
+    copia) sem baixar o TGFPRO. Sem conexao, usa a copia local.
     """
+    global _CATALOGO_MEMORIA
     print("--- SANKHYA: Importando Catalogo de Produtos... ---")
     
-    query = """
+    query = f"""
     SELECT 
         PRO.CODPROD,
         PRO.DESCRPROD,
         PRO.CODGRUPOPROD
-    FROM SANKHYA.TGFPRO PRO
-    WHERE PRO.ATIVO = 'S'
-      AND (PRO.CODGRUPOPROD BETWEEN 10000000 AND 18999999)
-      AND (
-            PRO.CODGRUPOPROD BETWEEN 16010100 AND 16011200
-         OR PRO.CODGRUPOPROD BETWEEN 18010100 AND 18010700
-         OR PRO.CODGRUPOPROD = 18010900
-         OR PRO.CODGRUPOPROD = 18010800
-      )
+    {_FILTRO_CATALOGO}
     """
     
-    catalogo_cod = {}
-    catalogo_nome = {}
-    
+    cache_disco = _ler_cache_disco()
+
+    conn = None
     try:
         conn = get_connection()
         cursor = conn.cursor()
+        impressao = _impressao_digital(cursor)
+
+        if _CATALOGO_MEMORIA and _CATALOGO_MEMORIA[0] == impressao:
+            catalogo_cod, catalogo_nome = _montar_catalogo(_CATALOGO_MEMORIA[1])
+            print(f"Catalogo inalterado: {len(catalogo_cod)} produtos (memoria).")
+            return catalogo_cod, catalogo_nome
+
+        if cache_disco and cache_disco.get('impressao') == impressao:
+            _CATALOGO_MEMORIA = (impressao, cache_disco['produtos'])
+            catalogo_cod, catalogo_nome = _montar_catalogo(cache_disco['produtos'])
+            print(f"Catalogo inalterado: {len(catalogo_cod)} produtos (cache local).")
+            return catalogo_cod, catalogo_nome
+
+        cursor.arraysize = ARRAYSIZE_CATALOGO
+        cursor.prefetchrows = ARRAYSIZE_CATALOGO + 1
         cursor.execute(query)
-        
-        for row in cursor:
-            cod = row[0]
-            desc = str(row[1]).strip()
-            grupo = row[2]
-            
-            obj = None
-
-            # Classificacao por grupo Sankhya; apenas MateriaPrima, Massa e Dissolucao sao importados
-            if grupo == 18010800:
-                obj = Dissolucao(cod, desc)
-            elif 18010100 <= grupo <= 18010700 or grupo == 18010900:
-                obj = Massa(cod, desc)
-            elif 16010100 <= grupo <= 16011200:
-                obj = MateriaPrima(cod, desc)
-            
-            if obj:
-                catalogo_cod[cod] = obj
-                catalogo_nome[desc.upper()] = obj
-        
-        conn.close()
+        linhas = [[row[0], str(row[1]).strip(), row[2]] for row in cursor]
+
+        catalogo_cod, catalogo_nome = _montar_catalogo(linhas)
+        _CATALOGO_MEMORIA = (impressao, linhas)
+        _gravar_cache_disco(impressao, linhas)
         print(f"Catalogo sincronizado: {len(catalogo_cod)} produtos carregados.")
         
     except Exception as e:
         print(f"Erro ao conectar no Sankhya: {e}")
+        if _CATALOGO_MEMORIA:
+            return _montar_catalogo(_CATALOGO_MEMORIA[1])
+        if cache_disco:
+            _CATALOGO_MEMORIA = (cache_disco.get('impressao'), cache_disco['produtos'])
+            catalogo_cod, catalogo_nome = _montar_catalogo(cache_disco['produtos'])
+            print(f"Usando copia local do catalogo: {len(catalogo_cod)} produtos.")
+            return catalogo_cod, catalogo_nome
         return {}, {}
+    finally:
+        if conn: conn.close() # devolve a sessao ao pool
         
     return catalogo_cod, catalogo_nome
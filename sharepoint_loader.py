@@ -1,5 +1,15 @@
+import base64
+import errno
+import hashlib
+import json
 import os
+import shutil
+import time
 import urllib.parse
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from threading import Lock
+import numpy as np
 import requests
 from dotenv import load_dotenv
 
@@ -12,8 +22,43 @@ TENANT_ID = os.getenv("SHAREPOINT_TENANT_ID") or os.getenv("TENANT_ID")
 CLIENT_ID = os.getenv("SHAREPOINT_CLIENT_ID")
 CLIENT_SECRET = os.getenv("SHAREPOINT_CLIENT_SECRET")
 
+# Enderecos do login e do Graph (substituiveis para testes com um servidor local)
+LOGIN_URL = os.getenv("SHAREPOINT_LOGIN_URL", "https://login.microsoftonline.com").rstrip("/")
+GRAPH_URL = os.getenv("SHAREPOINT_GRAPH_URL", "https://graph.microsoft.com/v1.0").rstrip("/")
+
+# SHAREPOINT_DEBUG=1 mostra os caminhos usados na consulta ao Graph
+DEBUG = os.getenv("SHAREPOINT_DEBUG", "0") == "1"
+
+# IDs de site/drive resolvidos, guardados entre execucoes (por URL_SITE)
+IDS_CACHE_FILE = os.getenv("SHAREPOINT_IDS_CACHE", os.path.join("instance", "sharepoint_ids.json"))
+
+# O token e renovado esta quantidade de segundos antes de expirar
+TOKEN_MARGEM_SEGUNDOS = 300
+
+# Download em blocos: tentativas (retomando de onde parou) e tamanho do bloco lido
+# da rede. Se a conexao cai, o bloco incompleto em andamento se perde (o requests so
+# entrega blocos cheios): a retomada pede de novo no maximo DOWNLOAD_BLOCO bytes.
+DOWNLOAD_TENTATIVAS = 5
+DOWNLOAD_BLOCO = 64 * 1024
+# Bloco de leitura do arquivo local no calculo do hash
+HASH_BLOCO = 1024 * 1024
+
+# Respostas temporarias (throttling/indisponibilidade): espera o Retry-After e repete
+STATUS_REPETIR = (429, 500, 502, 503, 504)
+ESPERA_MAX_SEGUNDOS = 60
+
+# Sessao HTTP compartilhada (keep-alive entre token, metadados e download)
+_SESSAO = requests.Session()
+_TOKEN = {"valor": None, "expira_em": 0.0}
+# Uma sincronizacao por vez (token, IDs e o arquivo .part sao compartilhados)
+_LOCK = Lock()
+
+
+def _obter_token_graph(renovar=False) -> str:
+    """Token do Graph (client credentials), reaproveitado ate perto do expires_in."""
+    if not renovar and _TOKEN["valor"] and time.monotonic() < _TOKEN["expira_em"]:
+        return _TOKEN["valor"]
 
-def _obter_token_graph() -> str:
     missing = [
         nome
         for nome, valor in [
@@ -26,7 +71,7 @@ def _obter_token_graph() -> str:
     if missing:
         raise ValueError(f"Variaveis faltando no .env: {', '.join(missing)}")
 
-    token_url = f"https://login.microsoftonline.com/{TENANT_ID}/oauth2/v2.0/token"
+    token_url = f"{LOGIN_URL}/{TENANT_ID}/oauth2/v2.0/token"
     data = {
         "client_id": CLIENT_ID,
         "client_secret": CLIENT_SECRET,
@@ -34,15 +79,40 @@ def _obter_token_graph() -> str:
         "scope": "https://graph.microsoft.com/.default",
     }
 
-    resp = requests.post(token_url, data=data, timeout=30)
+    resp = _SESSAO.post(token_url, data=data, timeout=30)
     resp.raise_for_status()
     token_info = resp.json()
     token = token_info.get("access_token", "")
-    print("DEBUG token_len:", len(token))
+
+    validade = float(token_info.get("expires_in") or 3599)
+    _TOKEN["valor"] = token
+    _TOKEN["expira_em"] = time.monotonic() + max(validade - TOKEN_MARGEM_SEGUNDOS, 0)
     return token
 
 
-def _resolver_site_e_drive(headers):
+def _ler_ids_salvos():
+    try:
+        with open(IDS_CACHE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _gravar_ids(ids):
+    try:
+        os.makedirs(os.path.dirname(IDS_CACHE_FILE) or ".", exist_ok=True)
+        with open(IDS_CACHE_FILE, "w", encoding="utf-8") as f:
+            json.dump(ids, f, indent=2)
+    except OSError as e:
+        print(f"Aviso: nao foi possivel gravar os IDs do SharePoint: {e}")
+
+
+def _resolver_site_e_drive(headers, renovar=False):
+    """
+    (site_path, drive_id) do URL_SITE. Os IDs nao mudam: ficam salvos em
+    IDS_CACHE_FILE e so sao consultados no Graph na primeira vez ou quando
+    'renovar' (ex.: o drive salvo deixou de responder).
+    """
     if not URL_SITE:
         raise ValueError("URL_SITE_SHAREPOINT nao encontrada no .env")
 
@@ -52,18 +122,26 @@ def _resolver_site_e_drive(headers):
     if not site_hostname or not site_path:
         raise ValueError("URL_SITE_SHAREPOINT invalida")
 
-    site_url = f"https://graph.microsoft.com/v1.0/sites/{site_hostname}:{site_path}"
-    site_resp = requests.get(site_url, headers=headers, timeout=30)
+    ids = _ler_ids_salvos()
+    salvo = ids.get(URL_SITE)
+    if salvo and not renovar:
+        return site_path, salvo["drive_id"]
+
+    site_url = f"{GRAPH_URL}/sites/{site_hostname}:{site_path}"
+    site_resp = _SESSAO.get(site_url, headers=headers, timeout=30)
     site_resp.raise_for_status()
     site_id = site_resp.json().get("id")
 
-    drive_resp = requests.get(
-        f"https://graph.microsoft.com/v1.0/sites/{site_id}/drive",
+    drive_resp = _SESSAO.get(
+        f"{GRAPH_URL}/sites/{site_id}/drive",
         headers=headers,
         timeout=30,
     )
     drive_resp.raise_for_status()
     drive_id = drive_resp.json().get("id")
+
+    ids[URL_SITE] = {"site_id": site_id, "drive_id": drive_id}
+    _gravar_ids(ids)
     return site_path, drive_id
 
 
@@ -91,38 +169,265 @@ def _montar_caminho_drive(site_path: str) -> str:
     return urllib.parse.quote(caminho, safe="/")
 
 
-def baixar_excel_sharepoint(nome_destino="cache_reg403.xlsx"):
-    print(f"--- Conectando ao SharePoint via Graph: {URL_SITE} ---")
+def _arquivo_metadados(nome_destino):
+    return nome_destino + ".graph.json"
+
+
+def _obter_metadados(item_url, headers):
+    """eTag/cTag/tamanho do driveItem, sem baixar o conteudo."""
+    resp = _SESSAO.get(item_url, headers=headers, timeout=30)
+    resp.raise_for_status()
+    item = resp.json()
+    metadados = {chave: item.get(chave) for chave in ("id", "eTag", "cTag", "size", "lastModifiedDateTime")}
+    metadados["hashes"] = (item.get("file") or {}).get("hashes") or {}
+    # URL pre-autenticada e de curta duracao: usada so neste download, nao vai para o .graph.json
+    metadados["downloadUrl"] = item.get("@microsoft.graph.downloadUrl")
+    return metadados
+
+
+def _ler_metadados_locais(nome_destino):
     try:
-        token = _obter_token_graph()
-        headers = {"Authorization": f"Bearer {token}"}
+        with open(_arquivo_metadados(nome_destino), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _gravar_metadados_locais(nome_destino, metadados):
+    try:
+        with open(_arquivo_metadados(nome_destino), "w", encoding="utf-8") as f:
+            json.dump(metadados, f)
+    except OSError as e:
+        print(f"Aviso: nao foi possivel gravar os metadados do download: {e}")
+
+
+def _copia_local_atual(nome_destino, metadados):
+    """
+    True se o arquivo local corresponde ao driveItem: mesmo cTag (muda so
+    quando o conteudo muda; na falta dele, o eTag) e mesmo tamanho.
+    """
+    locais = _ler_metadados_locais(nome_destino)
+    if not locais or not os.path.exists(nome_destino):
+        return False
+    if os.path.getsize(nome_destino) != metadados.get("size"):
+        return False
+    chave = "cTag" if metadados.get("cTag") else "eTag"
+    return bool(metadados.get(chave)) and locais.get(chave) == metadados.get(chave)
+
+
+class _QuickXorHash:
+    """
+    quickXorHash do SharePoint/OneDrive (file.hashes.quickXorHash): cada byte
+    e XORado em um registrador circular de 160 bits, 11 bits adiante do
+    anterior; no final o tamanho e XORado nos ultimos 8 bytes.
+    """
+    LARGURA = 160
+    PASSO = 11
 
-        site_path, drive_id = _resolver_site_e_drive(headers)
+    def __init__(self):
+        self.estado = 0
+        self.tamanho = 0
+
+    def update(self, dados):
+        if not dados:
+            return
+        # Bytes que caem na mesma posicao do registrador (a cada 160) sao XORados juntos
+        vetor = np.frombuffer(dados, dtype=np.uint8)
+        vetor = np.concatenate([vetor, np.zeros(-len(vetor) % self.LARGURA, dtype=np.uint8)])
+        colunas = np.bitwise_xor.reduce(vetor.reshape(-1, self.LARGURA), axis=0)
+
+        inicio = self.tamanho * self.PASSO
+        mascara = (1 << self.LARGURA) - 1
+        for i in np.flatnonzero(colunas):
+            byte = int(colunas[i])
+            bit = (inicio + self.PASSO * int(i)) % self.LARGURA
+            self.estado ^= ((byte << bit) | (byte >> (self.LARGURA - bit))) & mascara
+        self.tamanho += len(dados)
+
+    def digest_base64(self):
+        resultado = bytearray(self.estado.to_bytes(self.LARGURA // 8, "little"))
+        for i, byte in enumerate(self.tamanho.to_bytes(8, "little")):
+            resultado[-8 + i] ^= byte
+        return base64.b64encode(bytes(resultado)).decode("ascii")
+
+
+def _hash_do_arquivo(caminho, hashes):
+    """(nome, valor calculado, valor esperado) para o melhor hash informado pelo Graph, ou None."""
+    if hashes.get("sha256Hash"):
+        nome, h = "sha256Hash", hashlib.sha256()
+    elif hashes.get("sha1Hash"):
+        nome, h = "sha1Hash", hashlib.sha1()
+    elif hashes.get("quickXorHash"):
+        nome, h = "quickXorHash", _QuickXorHash()
+    else:
+        return None
+
+    with open(caminho, "rb") as f:
+        for bloco in iter(lambda: f.read(HASH_BLOCO), b""):
+            h.update(bloco)
+    calculado = h.digest_base64() if nome == "quickXorHash" else h.hexdigest().upper()
+    esperado = hashes[nome] if nome == "quickXorHash" else hashes[nome].upper()
+    return nome, calculado, esperado
+
+
+def _verificar_download(caminho, metadados):
+    tamanho = os.path.getsize(caminho)
+    if metadados.get("size") is not None and tamanho != metadados["size"]:
+        raise IOError(f"Download incompleto: {tamanho} de {metadados['size']} bytes")
+    verificacao = _hash_do_arquivo(caminho, metadados.get("hashes") or {})
+    if verificacao and verificacao[1] != verificacao[2]:
+        raise IOError(f"Checksum invalido ({verificacao[0]}): {verificacao[1]} != {verificacao[2]}")
+
+
+def _espera_retry_after(resp, tentativa):
+    """Segundos ate a proxima tentativa: Retry-After (segundos ou data HTTP) ou backoff exponencial."""
+    valor = resp.headers.get("Retry-After")
+    espera = None
+    if valor:
+        try:
+            espera = float(valor)
+        except ValueError:
+            try:
+                espera = (parsedate_to_datetime(valor) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                espera = None
+    if espera is None:
+        espera = 2 ** tentativa
+    return min(max(espera, 0), ESPERA_MAX_SEGUNDOS)
+
+
+def _baixar_em_blocos(url, headers, parcial, metadados):
+    """
+    Baixa 'url' em stream para o arquivo 'parcial'. Se a conexao cair,
+    tenta de novo pedindo so o restante (Range); se o servidor devolver o
+    arquivo inteiro (200) em vez do pedaco (206), recomeca do zero.
+    Respostas 429/5xx sao repetidas apos o Retry-After.
+    """
+    if os.path.exists(parcial):
+        os.remove(parcial)
+
+    for tentativa in range(1, DOWNLOAD_TENTATIVAS + 1):
+        ja_baixado = os.path.getsize(parcial) if os.path.exists(parcial) else 0
+        cabecalhos = dict(headers)
+        if ja_baixado:
+            cabecalhos["Range"] = f"bytes={ja_baixado}-"
+        try:
+            with _SESSAO.get(url, headers=cabecalhos, stream=True, timeout=60) as resp:
+                if resp.status_code == 416 and ja_baixado == metadados.get("size"):
+                    return # ja estava completo
+                if resp.status_code in STATUS_REPETIR and tentativa < DOWNLOAD_TENTATIVAS:
+                    espera = _espera_retry_after(resp, tentativa)
+                    print(f"\n   > HTTP {resp.status_code} no download. Nova tentativa em {espera:.0f}s...", end=" ")
+                    time.sleep(espera)
+                    continue
+                resp.raise_for_status()
+                continua = (
+                    ja_baixado and resp.status_code == 206
+                    and resp.headers.get("Content-Range", "").startswith(f"bytes {ja_baixado}-")
+                )
+                with open(parcial, "ab" if continua else "wb") as f:
+                    for bloco in resp.iter_content(DOWNLOAD_BLOCO):
+                        f.write(bloco)
+            return
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            if tentativa == DOWNLOAD_TENTATIVAS:
+                raise
+            print(f"\n   > Download interrompido ({e}). Retomando (tentativa {tentativa + 1})...", end=" ")
+
+
+def _substituir_destino(parcial, nome_destino):
+    try:
+        os.replace(parcial, nome_destino)
+    except OSError as e:
+        # Bind mount de arquivo unico: rename sobre ele falha com EBUSY (ou EXDEV)
+        if e.errno not in (errno.EBUSY, errno.EXDEV):
+            raise
+        shutil.copyfile(parcial, nome_destino)
+        os.remove(parcial)
+
+
+def _baixar_arquivo(item_url, headers, nome_destino, metadados):
+    """
+    Download em stream para <destino>.part, conferido (tamanho e hash do
+    Graph) e so entao movido sobre o destino com os.replace: o ETL nunca ve
+    uma planilha pela metade, e a memoria nao cresce com o arquivo.
+    Se o destino nao pode ser substituido por rename (ex.: arquivo montado
+    sozinho como volume no Docker), o .part ja conferido e copiado por cima.
+    """
+    parcial = nome_destino + ".part"
+    if metadados.get("downloadUrl"):
+        # URL pre-autenticada: nao leva o token
+        url, headers = metadados["downloadUrl"], {}
+    else:
+        url = f"{item_url}:/content"
+
+    try:
+        _baixar_em_blocos(url, headers, parcial, metadados)
+        _verificar_download(parcial, metadados)
+        _substituir_destino(parcial, nome_destino)
+    except Exception:
+        if os.path.exists(parcial):
+            os.remove(parcial)
+        raise
+
+
+def _localizar_item():
+    """
+    (item_url, headers, metadados) do arquivo no drive. Com token e IDs em
+    cache e uma unica requisicao; se ela for recusada (token revogado, drive
+    movido), renova token e IDs e tenta mais uma vez.
+    """
+    for tentativa in range(2):
+        renovar = tentativa > 0
+        headers = {"Authorization": f"Bearer {_obter_token_graph(renovar=renovar)}"}
+        site_path, drive_id = _resolver_site_e_drive(headers, renovar=renovar)
         caminho_drive = _montar_caminho_drive(site_path)
 
-        print("DEBUG site_path:", site_path)
-        print("DEBUG CAMINHO_ARQUIVO (.env):", CAMINHO_ARQUIVO)
-        print("DEBUG caminho_drive (para o Graph):", caminho_drive)
+        if DEBUG:
+            print("DEBUG site_path:", site_path)
+            print("DEBUG CAMINHO_ARQUIVO (.env):", CAMINHO_ARQUIVO)
+            print("DEBUG caminho_drive (para o Graph):", caminho_drive)
 
+        item_url = f"{GRAPH_URL}/drives/{drive_id}/root:/{caminho_drive}"
+        try:
+            return item_url, headers, _obter_metadados(item_url, headers)
+        except requests.HTTPError as http_err:
+            status = http_err.response.status_code if http_err.response is not None else None
+            if renovar or status not in (401, 403, 404):
+                raise
+            print(f"   > Graph recusou o token/IDs em cache (HTTP {status}). Renovando...")
 
-        download_url = (
-            f"https://graph.microsoft.com/v1.0/drives/{drive_id}/root:/{caminho_drive}:/content"
-        )
-        print(f"   > Baixando: {os.path.basename(CAMINHO_ARQUIVO)} ...", end=" ")
-        resp = requests.get(download_url, headers=headers, timeout=60)
-        resp.raise_for_status()
 
-        with open(nome_destino, "wb") as destino:
-            destino.write(resp.content)
+def baixar_excel_sharepoint(nome_destino="cache_reg403.xlsx"):
+    """
+    Sincroniza a planilha com o SharePoint. Retorna (caminho, baixado):
+    caminho e None se falhou; baixado e False quando a copia local ja
+    estava atualizada (cTag igual) e nada foi transferido.
+    """
+    with _LOCK:
+        return _sincronizar(nome_destino)
+
+
+def _sincronizar(nome_destino):
+    print(f"--- Conectando ao SharePoint via Graph: {URL_SITE} ---")
+    try:
+        item_url, headers, metadados = _localizar_item()
+        if _copia_local_atual(nome_destino, metadados):
+            print(f"   > {os.path.basename(CAMINHO_ARQUIVO)} sem alteracoes no SharePoint (cTag igual). Download ignorado.")
+            return nome_destino, False
+
+        print(f"   > Baixando: {os.path.basename(CAMINHO_ARQUIVO)} ...", end=" ")
+        _baixar_arquivo(item_url, headers, nome_destino, metadados)
+        _gravar_metadados_locais(nome_destino, {k: v for k, v in metadados.items() if k != "downloadUrl"})
 
         print("ok.")
-        return nome_destino
+        return nome_destino, True
     except requests.HTTPError as http_err:
-        status = http_err.response.status_code if http_err.response else "n/d"
+        status = http_err.response.status_code if http_err.response is not None else "n/d"
         print(f"\nErro HTTP {status}: {http_err}")
     except Exception as e:
         print(f"\nErro no download: {e}")
-    return None
+    return None, False
 
 
 if __name__ == "__main__":
@@ -0,0 +1,231 @@
+from collections import deque
+from datetime import datetime
+from threading import Lock, current_thread
+import os
+import re
+import time
+
+# Comandos mais lentos que isso (ms) vão para o log de consultas lentas
+SQL_LENTA_MS = float(os.getenv("SQL_LENTA_MS", "1000"))
+SQL_LENTA_ARQUIVO = os.getenv("SQL_LENTA_ARQUIVO", os.path.join("instance", "sql_lento.log"))
+
+# Amostras de latência guardadas por comando (para os percentis)
+_AMOSTRAS_POR_COMANDO = 500
+
+
+def _rota_atual():
+    """Endpoint Flask que disparou o comando, ou o nome da thread fora de requisições."""
+    try:
+        from flask import has_request_context, request
+        if has_request_context():
+            return request.endpoint or request.path
+    except Exception:
+        pass
+    return current_thread().name
+
+
+def _normalizar(sql):
+    """Chave do comando: espaços colapsados e listas de '?' resumidas."""
+    texto = re.sub(r'\s+', ' ', sql).strip()
+    texto = re.sub(r'\?(\s*,\s*\?)+', '?...', texto)
+    return texto[:160]
+
+
+def _bytes_estimados(linha):
+    return sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in linha)
+
+
+def _percentil(ordenados, p):
+    if not ordenados:
+        return None
+    k = min(len(ordenados) - 1, int(round(p / 100 * (len(ordenados) - 1))))
+    return round(ordenados[k], 1)
+
+
+class MonitorSQL:
+    """
+    Estatísticas por comando SQL (latência, linhas, bytes estimados e rotas
+    de origem) e log das execuções acima de SQL_LENTA_MS.
+    """
+
+    def __init__(self, limite_lenta_ms=1000, arquivo_lentas=None):
+        self.limite_lenta_ms = limite_lenta_ms
+        self.arquivo_lentas = arquivo_lentas
+        self.comandos = {}
+        self.lentas = deque(maxlen=50)
+        self.lock = Lock()
+
+    def registrar(self, banco, sql, ms, linhas, bytes_lidos, rota):
+        chave = (banco, _normalizar(sql))
+        with self.lock:
+            reg = self.comandos.get(chave)
+            if reg is None:
+                reg = self.comandos[chave] = {
+                    'execucoes': 0, 'ms_total': 0.0, 'linhas': 0, 'bytes': 0,
+                    'amostras': deque(maxlen=_AMOSTRAS_POR_COMANDO), 'rotas': {}
+                }
+            reg['execucoes'] += 1
+            reg['ms_total'] += ms
+            reg['linhas'] += linhas
+            reg['bytes'] += bytes_lidos
+            reg['amostras'].append(ms)
+            reg['rotas'][rota] = reg['rotas'].get(rota, 0) + 1
+
+            if ms < self.limite_lenta_ms:
+                return
+            evento = {
+                'quando': datetime.now().isoformat(timespec='seconds'),
+                'banco': banco, 'ms': round(ms, 1), 'linhas': linhas,
+                'bytes': bytes_lidos, 'rota': rota, 'sql': chave[1]
+            }
+            self.lentas.append(evento)
+
+        print(f"🐢 SQL lento ({banco}, {ms:.0f} ms, {linhas} linhas, rota {rota}): {chave[1][:80]}")
+        if self.arquivo_lentas:
+            try:
+                os.makedirs(os.path.dirname(self.arquivo_lentas) or '.', exist_ok=True)
+                with open(self.arquivo_lentas, 'a', encoding='utf-8') as f:
+                    f.write(f"{evento['quando']}\t{banco}\t{evento['ms']}ms\t{linhas} linhas\t"
+                            f"{bytes_lidos} bytes\t{rota}\t{chave[1]}\n")
+            except Exception as e:
+                print(f"⚠️ Não foi possível gravar o log de SQL lento: {e}")
+
+    def get_stats(self):
+        with self.lock:
+            comandos = []
+            for (banco, sql), reg in self.comandos.items():
+                ordenados = sorted(reg['amostras'])
+                comandos.append({
+                    'banco': banco,
+                    'sql': sql,
+                    'execucoes': reg['execucoes'],
+                    'ms_medio': round(reg['ms_total'] / reg['execucoes'], 1),
+                    'p50_ms': _percentil(ordenados, 50),
+                    'p95_ms': _percentil(ordenados, 95),
+                    'p99_ms': _percentil(ordenados, 99),
+                    'max_ms': round(ordenados[-1], 1),
+                    'linhas': reg['linhas'],
+                    'bytes_estimados': reg['bytes'],
+                    'rotas': dict(reg['rotas'])
+                })
+            comandos.sort(key=lambda c: c['ms_medio'] * c['execucoes'], reverse=True)
+            return {
+                'limite_lenta_ms': self.limite_lenta_ms,
+                'comandos': comandos,
+                'lentas_recentes': list(self.lentas)
+            }
+
+
+monitor_sql = MonitorSQL(SQL_LENTA_MS, SQL_LENTA_ARQUIVO)
+
+
+class CursorInstrumentado:
+    """
+    Envolve um cursor DB-API (pyodbc / oracledb). Cada execute() abre uma
+    medição que soma o tempo de execução e dos fetches seguintes; ela é
+    registrada quando o resultado termina, no próximo execute() ou no close().
+    """
+
+    def __init__(self, cursor, banco):
+        object.__setattr__(self, '_cursor', cursor)
+        object.__setattr__(self, '_banco', banco)
+        object.__setattr__(self, '_medicao', None)
+
+    def __getattr__(self, nome):
+        return getattr(self._cursor, nome)
+
+    def __setattr__(self, nome, valor):
+        setattr(self._cursor, nome, valor)
+
+    def _finalizar(self):
+        medicao = self._medicao
+        if medicao is not None:
+            object.__setattr__(self, '_medicao', None)
+            monitor_sql.registrar(self._banco, medicao['sql'], medicao['ms'],
+                                  medicao['linhas'], medicao['bytes'], medicao['rota'])
+
+    def _medir(self, sql, funcao, *args):
+        self._finalizar()
+        inicio = time.perf_counter()
+        try:
+            funcao(*args)
+        except Exception:
+            self._abrir_medicao(sql, inicio)
+            self._finalizar()
+            raise
+        self._abrir_medicao(sql, inicio)
+        if self._cursor.description is None:
+            self._finalizar() # sem resultado (INSERT, DDL...)
+        return self
+
+    def _abrir_medicao(self, sql, inicio):
+        object.__setattr__(self, '_medicao', {
+            'sql': sql, 'ms': (time.perf_counter() - inicio) * 1000,
+            'linhas': 0, 'bytes': 0, 'rota': _rota_atual()
+        })
+
+    def execute(self, sql, *params):
+        return self._medir(sql, self._cursor.execute, sql, *params)
+
+    def executemany(self, sql, params):
+        return self._medir(sql, self._cursor.executemany, sql, params)
+
+    def _contar(self, linhas, inicio, terminou):
+        medicao = self._medicao
+        if medicao is not None:
+            medicao['ms'] += (time.perf_counter() - inicio) * 1000
+            if linhas:
+                medicao['linhas'] += len(linhas)
+                medicao['bytes'] += _bytes_estimados(linhas[0]) * len(linhas)
+        if terminou:
+            self._finalizar()
+
+    def fetchone(self):
+        inicio = time.perf_counter()
+        linha = self._cursor.fetchone()
+        self._contar([linha] if linha is not None else [], inicio, linha is None)
+        return linha
+
+    def fetchmany(self, tamanho=None):
+        inicio = time.perf_counter()
+        linhas = self._cursor.fetchmany(tamanho) if tamanho is not None else self._cursor.fetchmany()
+        self._contar(linhas, inicio, not linhas)
+        return linhas
+
+    def fetchall(self):
+        inicio = time.perf_counter()
+        linhas = self._cursor.fetchall()
+        self._contar(linhas, inicio, True)
+        return linhas
+
+    def __iter__(self):
+        while True:
+            linhas = self.fetchmany(max(getattr(self._cursor, 'arraysize', 0) or 0, 500))
+            if not linhas:
+                return
+            yield from linhas
+
+    def close(self):
+        self._finalizar()
+        self._cursor.close()
+
+    def __del__(self):
+        # Resultado lido só em parte (ex.: um fetchone): registra o que foi medido
+        try:
+            self._finalizar()
+        except Exception:
+            pass
+
+
+class ConexaoInstrumentada:
+    """Conexão cujo cursor() devolve CursorInstrumentado; o resto é repassado."""
+
+    def __init__(self, conn, banco):
+        self._conn = conn
+        self._banco = banco
+
+    def __getattr__(self, nome):
+        return getattr(self._conn, nome)
+
+    def cursor(self):
+        return CursorInstrumentado(self._conn.cursor(), self._banco)
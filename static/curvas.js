@@ -0,0 +1,97 @@
+// --- LEITURA DO FORMATO BINÁRIO DE CURVAS (/api/grafico?format=bin) ---
+// Layout: [uint32 LE tamanho do cabeçalho][cabeçalho JSON][float32 LE: n tempos + n torques por série]
+
+function decodificarCurvasBinario(buffer) {
+    const view = new DataView(buffer);
+    const tamanhoCabecalho = view.getUint32(0, true);
+    const cabecalho = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 4, tamanhoCabecalho)));
+    const valores = new Float32Array(buffer, 4 + tamanhoCabecalho);
+
+    const montarDatasets = (series) => (series || []).map(s => {
+        const tempo = valores.subarray(s.offset, s.offset + s.n);
+        const torque = valores.subarray(s.offset + s.n, s.offset + 2 * s.n);
+        const data = new Array(s.n);
+        for (let i = 0; i < s.n; i++) {
+            data[i] = { x: tempo[i], y: torque[i] };
+        }
+        return {
+            label: s.label,
+            tempType: s.tempType,
+            data: data,
+            pointRadius: 0,
+            borderWidth: 2,
+            tension: 0.4,
+            fill: false,
+            borderColor: s.tempType === 'ALTA' ? '#dc3545' : '#0d6efd'
+        };
+    });
+
+    const resultado = {};
+    Object.keys(cabecalho).forEach(grupo => {
+        resultado[grupo] = montarDatasets(cabecalho[grupo]);
+    });
+    return resultado;
+}
+
+// Busca as curvas em formato binário e devolve { reometria: [...], viscosidade: [...] }
+// no mesmo formato de datasets do Chart.js usado pela resposta JSON.
+async function carregarCurvasBinario(url) {
+    const sep = url.includes('?') ? '&' : '?';
+    const response = await fetch(`${url}${sep}format=bin`);
+
+    const tipo = response.headers.get('Content-Type') || '';
+    if (tipo.includes('application/json')) {
+        // Erros (e a resposta vazia) continuam vindo em JSON
+        const data = await response.json();
+        if (!response.ok || data.error) {
+            throw new Error(data.error || "Erro desconhecido ao comunicar com o servidor");
+        }
+        return data;
+    }
+    if (!response.ok) {
+        throw new Error(`Erro HTTP ${response.status}`);
+    }
+
+    return decodificarCurvasBinario(await response.arrayBuffer());
+}
+
+// --- LEITURA EM STREAMING (/api/grafico/stream, NDJSON) ---
+// Chama aoReceberDataset(grupo, dataset) a cada linha recebida e devolve o
+// resumo final ({ fim: true, total: n }). 'ids' longos vão no corpo (POST).
+async function carregarCurvasStream(url, aoReceberDataset, ids = null) {
+    const response = ids
+        ? await fetch(url, { method: 'POST', body: new URLSearchParams({ ids: ids.join(',') }) })
+        : await fetch(url);
+    if (!response.ok) {
+        let mensagem = `Erro HTTP ${response.status}`;
+        try { mensagem = (await response.json()).error || mensagem; } catch (err) { /* corpo não-JSON */ }
+        throw new Error(mensagem);
+    }
+
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let pendente = '';
+    let resumo = null;
+
+    const processarLinha = (linha) => {
+        if (!linha.trim()) return;
+        const msg = JSON.parse(linha);
+        if (msg.error) throw new Error(msg.error);
+        if (msg.fim) resumo = msg;
+        else aoReceberDataset(msg.grupo, msg.dataset);
+    };
+
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        pendente += decoder.decode(value, { stream: true });
+        const linhas = pendente.split('\n');
+        pendente = linhas.pop();
+        linhas.forEach(processarLinha);
+    }
+    processarLinha(pendente + decoder.decode());
+    if (!resumo) {
+        throw new Error("Resposta interrompida antes do fim (verifique os logs do servidor)");
+    }
+    return resumo;
+}
@@ -294,7 +294,8 @@ async function abrirGraficoComparativo() {
     const selecionados = Array.from(document.querySelectorAll('.curve-selector:checked')).map(cb => cb.value);
     
     if (selecionados.length > 10) {
-        alert("Por favor, selecione no máximo 10 curvas para não travar a visualização.");
+        // Seleções grandes: curvas chegam em streaming e são desenhadas aos poucos
+        abrirGraficoStream('/api/grafico/stream', `${selecionados.length} ensaios`, selecionados);
         return;
     }
 
@@ -304,18 +305,8 @@ async function abrirGraficoComparativo() {
 
     // Chama a API
     try {
-        const response = await fetch(`/api/grafico?ids=${selecionados.join(',')}`);
-        const data = await response.json();
-
-        if (!response.ok) {
-            // Lança erro com a mensagem vinda da API ou uma genérica
-            throw new Error(data.error || "Erro desconhecido ao comunicar com o servidor");
-        }
-
-        if (data.error) {
-            alert("Aviso do Servidor: " + data.error);
-            return;
-        }
+        // Formato binário (float32) - ver static/curvas.js
+        const data = await carregarCurvasBinario(`/api/grafico?ids=${selecionados.join(',')}`);
 
         // Atualiza Título com os Materiais (Agrupamento)
         const materialsText = data.materiais ? data.materiais.join(' | ') : 'Vários Materiais';
@@ -344,6 +335,78 @@ async function abrirGraficoComparativo() {
     }
 }
 
+// 2b. Seleções grandes: desenha cada curva assim que ela chega (NDJSON)
+async function abrirGraficoStream(url, descricao, ids = null) {
+    const modal = new bootstrap.Modal(document.getElementById('chartModal'));
+    modal.show();
+
+    const titulo = document.getElementById('modalMateriaisTitle');
+    titulo.textContent = `Comparando: ${descricao} (carregando...)`;
+    document.getElementById('containerReo').style.display = 'none';
+    document.getElementById('containerVisc').style.display = 'none';
+    document.getElementById('msgVazio').classList.add('d-none');
+
+    chartInstanceReo = criarGraficoBase('chartReo', chartInstanceReo, [], 'Torque (lb.in)');
+    chartInstanceVisc = criarGraficoBase('chartVisc', chartInstanceVisc, [], 'Mooney (MU)');
+
+    const graficos = {
+        reometria: { chart: chartInstanceReo, container: 'containerReo' },
+        viscosidade: { chart: chartInstanceVisc, container: 'containerVisc' }
+    };
+
+    // Agrupa as atualizações do Chart.js em no máximo uma por frame
+    let agendado = false;
+    const redesenhar = () => {
+        agendado = false;
+        chartInstanceReo.update('none');
+        chartInstanceVisc.update('none');
+    };
+
+    try {
+        const resumo = await carregarCurvasStream(url, (grupo, dataset) => {
+            const alvo = graficos[grupo];
+            if (!alvo) return;
+            const cor = CORES_GRAFICO[alvo.chart.data.datasets.length % CORES_GRAFICO.length];
+            dataset.borderColor = cor;
+            dataset.backgroundColor = cor;
+            alvo.chart.data.datasets.push(dataset);
+            document.getElementById(alvo.container).style.display = 'block';
+            if (!agendado) {
+                agendado = true;
+                requestAnimationFrame(redesenhar);
+            }
+        }, ids);
+        redesenhar();
+
+        const total = resumo.total;
+        titulo.textContent = `Comparando: ${total} curvas`
+            + (resumo.ignoradas ? ` (${resumo.ignoradas} sem dados válidos)` : '');
+        document.getElementById('msgVazio').classList.toggle('d-none', total > 0);
+
+    } catch (err) {
+        console.error(err);
+        alert("Erro ao carregar dados do gráfico: " + err.message);
+    }
+}
+
+// 2c. Todas as curvas de um material no período dos filtros (Cód. + datas)
+function abrirGraficoPeriodo(botao) {
+    const form = botao.closest('form');
+    const codigo = form.querySelector('[name="codigo_filter"]').value.trim();
+    if (!codigo) {
+        alert("Informe o código do material (Cód.) para plotar as curvas do período.");
+        return;
+    }
+    const params = new URLSearchParams({ codigo_filter: codigo });
+    const inicio = form.querySelector('[name="date_start"]').value;
+    const fim = form.querySelector('[name="date_end"]').value;
+    if (inicio) params.set('date_start', inicio);
+    if (fim) params.set('date_end', fim);
+
+    const periodo = inicio || fim ? ` (${inicio || '...'} a ${fim || '...'})` : '';
+    abrirGraficoStream(`/api/grafico/stream?${params}`, `material ${codigo}${periodo}`);
+}
+
 // 3. Função Genérica para Criar Gráficos com Chart.js
 function criarGraficoBase(canvasId, chartInstance, datasets, yLabel) {
     const ctx = document.getElementById(canvasId).getContext('2d');
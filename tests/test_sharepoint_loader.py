@@ -0,0 +1,254 @@
+"""
+Testes do sharepoint_loader contra um servidor HTTP local que imita o login
+e o Graph (token, site, drive, driveItem e download).
+
+    python -m unittest tests.test_sharepoint_loader
+"""
+import errno
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+import sharepoint_loader
+
+URL_SITE = "https://empresa.sharepoint.com/sites/lab"
+CAMINHO = "Shared Documents/REG 403.xlsx"
+
+
+class _EstadoGraph:
+    def __init__(self):
+        self.dados = os.urandom(300_000)
+        self.ctag = 1
+        self.drive_id = "DRIVE-1"
+        self.tokens_emitidos = 0
+        self.tokens_revogados = set()
+        self.hash_errado = False
+        self.cortar_download_em = None # bytes enviados antes de derrubar a conexao (1x)
+        self.respostas_temporarias = [] # status devolvidos antes do download (ex.: 429)
+        self.requisicoes = [] # (metodo, caminho, cabecalhos)
+
+    def pedidos(self, prefixo):
+        return [r for r in self.requisicoes if r[1].startswith(prefixo)]
+
+
+class _GraphFalso(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    estado = None
+
+    def log_message(self, *args):
+        pass
+
+    def _json(self, obj, status=200):
+        corpo = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(corpo)))
+        self.end_headers()
+        self.wfile.write(corpo)
+
+    def do_POST(self):
+        self.estado.requisicoes.append(("POST", self.path, dict(self.headers)))
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.estado.tokens_emitidos += 1
+        self._json({"access_token": f"token-{self.estado.tokens_emitidos}", "expires_in": 3600})
+
+    def do_GET(self):
+        estado = self.estado
+        caminho = urllib.parse.unquote(self.path)
+        estado.requisicoes.append(("GET", caminho, dict(self.headers)))
+
+        if caminho.startswith("/download"):
+            return self._download()
+
+        token = self.headers.get("Authorization", "").split(" ")[-1]
+        if token in estado.tokens_revogados:
+            return self._json({"error": "InvalidAuthenticationToken"}, 401)
+        if caminho.startswith("/graph/sites/") and caminho.endswith("/drive"):
+            return self._json({"id": estado.drive_id})
+        if caminho.startswith("/graph/sites/"):
+            return self._json({"id": "SITE-1"})
+        if caminho.startswith(f"/graph/drives/{estado.drive_id}/root:/"):
+            sha256 = hashlib.sha256(estado.dados).hexdigest()
+            return self._json({
+                "id": "ITEM-1",
+                "eTag": f"e{estado.ctag}",
+                "cTag": f"c{estado.ctag}",
+                "size": len(estado.dados),
+                "file": {"hashes": {"sha256Hash": "0" * 64 if estado.hash_errado else sha256}},
+                "@microsoft.graph.downloadUrl": f"http://127.0.0.1:{self.server.server_port}/download",
+            })
+        return self._json({"error": "itemNotFound"}, 404)
+
+    def _download(self):
+        estado = self.estado
+        if estado.respostas_temporarias:
+            status = estado.respostas_temporarias.pop(0)
+            self.send_response(status)
+            self.send_header("Retry-After", "0")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        inicio = 0
+        faixa = self.headers.get("Range")
+        if faixa:
+            inicio = int(faixa.split("=")[1].split("-")[0])
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {inicio}-{len(estado.dados) - 1}/{len(estado.dados)}")
+        else:
+            self.send_response(200)
+        restante = estado.dados[inicio:]
+        self.send_header("Content-Length", str(len(restante)))
+        self.end_headers()
+
+        if estado.cortar_download_em is not None:
+            # Conexao cai no meio: o cliente recebe so o comeco do corpo
+            self.wfile.write(restante[:estado.cortar_download_em])
+            self.wfile.flush()
+            estado.cortar_download_em = None
+            self.close_connection = True
+            return
+        self.wfile.write(restante)
+
+
+class SincronizacaoSharePointTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.servidor = ThreadingHTTPServer(("127.0.0.1", 0), _GraphFalso)
+        threading.Thread(target=cls.servidor.serve_forever, daemon=True).start()
+        cls.base = f"http://127.0.0.1:{cls.servidor.server_port}"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.servidor.shutdown()
+        cls.servidor.server_close()
+
+    def setUp(self):
+        self.estado = _EstadoGraph()
+        _GraphFalso.estado = self.estado
+
+        pasta = tempfile.TemporaryDirectory()
+        self.addCleanup(pasta.cleanup)
+        self.destino = os.path.join(pasta.name, "reg403.xlsx")
+        self.ids_cache = os.path.join(pasta.name, "sharepoint_ids.json")
+
+        configuracao = {
+            "URL_SITE": URL_SITE,
+            "CAMINHO_ARQUIVO": CAMINHO,
+            "TENANT_ID": "tenant",
+            "CLIENT_ID": "cliente",
+            "CLIENT_SECRET": "segredo",
+            "LOGIN_URL": self.base,
+            "GRAPH_URL": self.base + "/graph",
+            "IDS_CACHE_FILE": self.ids_cache,
+        }
+        for nome, valor in configuracao.items():
+            patcher = mock.patch.object(sharepoint_loader, nome, valor)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        sharepoint_loader._TOKEN.update(valor=None, expira_em=0.0)
+
+    def _sincronizar(self):
+        self.estado.requisicoes.clear()
+        return sharepoint_loader.baixar_excel_sharepoint(self.destino)
+
+    def _conteudo_local(self):
+        with open(self.destino, "rb") as f:
+            return f.read()
+
+    def test_ctag_igual_nao_baixa_de_novo(self):
+        self.assertEqual(self._sincronizar(), (self.destino, True))
+
+        self.assertEqual(self._sincronizar(), (self.destino, False))
+        self.assertEqual(self.estado.pedidos("/download"), [])
+        self.assertEqual(self._conteudo_local(), self.estado.dados)
+
+        self.estado.dados = os.urandom(200_000)
+        self.estado.ctag += 1
+        self.assertEqual(self._sincronizar(), (self.destino, True))
+        self.assertEqual(self._conteudo_local(), self.estado.dados)
+
+    def test_conexao_cai_e_download_continua_com_range(self):
+        self.estado.cortar_download_em = 100_000
+
+        self.assertEqual(self._sincronizar(), (self.destino, True))
+
+        downloads = self.estado.pedidos("/download")
+        self.assertEqual(len(downloads), 2)
+        self.assertNotIn("Range", downloads[0][2])
+        # Retoma do que ja estava no .part (blocos completos recebidos antes da queda)
+        retomado_de = int(downloads[1][2]["Range"].split("=")[1].rstrip("-"))
+        self.assertGreater(retomado_de, 100_000 - sharepoint_loader.DOWNLOAD_BLOCO)
+        self.assertLessEqual(retomado_de, 100_000)
+        self.assertEqual(self._conteudo_local(), self.estado.dados)
+        self.assertFalse(os.path.exists(self.destino + ".part"))
+
+    def test_checksum_invalido_mantem_planilha_anterior(self):
+        self._sincronizar()
+        anterior = self._conteudo_local()
+
+        self.estado.dados = os.urandom(250_000)
+        self.estado.ctag += 1
+        self.estado.hash_errado = True
+
+        self.assertEqual(self._sincronizar(), (None, False))
+        self.assertEqual(self._conteudo_local(), anterior)
+        self.assertFalse(os.path.exists(self.destino + ".part"))
+
+        # Na proxima sincronizacao valida o arquivo novo entra normalmente
+        self.estado.hash_errado = False
+        self.assertEqual(self._sincronizar(), (self.destino, True))
+        self.assertEqual(self._conteudo_local(), self.estado.dados)
+
+    def test_destino_montado_como_volume_recebe_copia(self):
+        self._sincronizar()
+        self.estado.dados = os.urandom(150_000)
+        self.estado.ctag += 1
+
+        # Arquivo montado sozinho (bind mount do docker-compose): rename sobre ele da EBUSY
+        def replace_ocupado(origem, destino):
+            raise OSError(errno.EBUSY, "Device or resource busy", destino)
+
+        with mock.patch.object(sharepoint_loader.os, "replace", side_effect=replace_ocupado):
+            self.assertEqual(self._sincronizar(), (self.destino, True))
+
+        self.assertEqual(self._conteudo_local(), self.estado.dados)
+        self.assertFalse(os.path.exists(self.destino + ".part"))
+
+    def test_401_renova_token_e_ids_em_cache(self):
+        self._sincronizar()
+        with open(self.ids_cache, encoding="utf-8") as f:
+            self.assertEqual(json.load(f)[URL_SITE]["drive_id"], "DRIVE-1")
+
+        # Token revogado e drive movido: a requisicao com o cache falha com 401
+        self.estado.tokens_revogados.add(sharepoint_loader._TOKEN["valor"])
+        self.estado.drive_id = "DRIVE-2"
+        self.estado.dados = os.urandom(100_000)
+        self.estado.ctag += 1
+
+        self.assertEqual(self._sincronizar(), (self.destino, True))
+        self.assertEqual(len(self.estado.pedidos("/tenant/oauth2")), 1)
+        self.assertEqual(len(self.estado.pedidos("/graph/sites/")), 2) # site e drive de novo
+        with open(self.ids_cache, encoding="utf-8") as f:
+            self.assertEqual(json.load(f)[URL_SITE]["drive_id"], "DRIVE-2")
+        self.assertEqual(self._conteudo_local(), self.estado.dados)
+
+    def test_429_e_503_respeitam_retry_after(self):
+        self.estado.respostas_temporarias = [429, 503]
+
+        with mock.patch.object(sharepoint_loader.time, "sleep") as dormir:
+            self.assertEqual(self._sincronizar(), (self.destino, True))
+
+        self.assertEqual([c.args[0] for c in dormir.call_args_list], [0, 0])
+        self.assertEqual(len(self.estado.pedidos("/download")), 3)
+        self.assertEqual(self._conteudo_local(), self.estado.dados)
+
+
+if __name__ == "__main__":
+    unittest.main()